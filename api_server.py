@@ -18,14 +18,30 @@ import numpy as np
 import soundfile as sf
 
 from indextts.infer_vllm import IndexTTS
+from indextts.utils.audio_encoding import RESPONSE_FORMATS, encode_audio, stream_encoded_audio, validate_response_format
+from indextts.utils.batch_jobs import BatchJobManager
+from indextts.utils.admission import AdmissionController, AdmissionRejected
+from indextts.utils.generation_config import parse_generation_config
+from indextts.utils.metrics import render_metrics, stage_timer
+from indextts.utils.request_context import RequestCancelled, RequestContext, run_until_disconnected
 
 tts = None
+batch_jobs = None
+admission = None
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global tts
+    global tts, batch_jobs, admission
+    admission = AdmissionController(args.admission_capacity_s, max_queue=args.admission_max_queue,
+                                    queue_timeout=args.admission_queue_timeout_s,
+                                    mel_tokens_per_text_token=args.admission_mel_tokens_per_text_token)
     cfg_path = os.path.join(args.model_dir, "config.yaml")
-    tts = IndexTTS(model_dir=args.model_dir, cfg_path=cfg_path, gpu_memory_utilization=args.gpu_memory_utilization)
+    tts = IndexTTS(model_dir=args.model_dir, cfg_path=cfg_path, gpu_memory_utilization=args.gpu_memory_utilization,
+                   vocoder_max_batch_size=args.vocoder_max_batch_size, vocoder_batch_wait_ms=args.vocoder_batch_wait_ms,
+                   speaker_cache_dir=args.speaker_cache_dir,
+                   conditioning_cache_size=args.conditioning_cache_size, conditioning_cache_mb=args.conditioning_cache_mb,
+                   max_tokens_ratio=args.max_tokens_ratio, max_tokens_margin=args.max_tokens_margin,
+                   enable_prefix_caching=not args.disable_prefix_caching)
 
     current_file_path = os.path.abspath(__file__)
     cur_dir = os.path.dirname(current_file_path)
@@ -38,12 +54,49 @@ async def lifespan(app: FastAPI):
             for audio_path in audio_paths:
                 audio_paths_.append(os.path.join(cur_dir, audio_path))
             tts.registry_speaker(speaker, audio_paths_)
+    batch_jobs = BatchJobManager(args.batch_jobs_dir, synthesize_batch_item, executor=tts.executors.audio_io,
+                                 max_concurrent_items=args.batch_max_concurrent_items, root=args.batch_root)
+    # 继续上次进程退出时未完成的批量任务
+    await batch_jobs.resume()
     yield
+    tts.executors.shutdown()
     # Clean up the ML models and release the resources
     # ml_models.clear()
 
 app = FastAPI(lifespan=lifespan)
 
+
+async def synthesize_batch_item(item: dict):
+    """批量任务中的一条：character 使用预注册角色，否则使用 audio_paths 中的参考音频
+
+    与在线请求共用准入控制；被拒绝时等待 Retry-After 后重试，而不是把条目记为失败。
+    """
+    generation_config = parse_generation_config(item)
+    cost = admission.estimate_cost(item["text"])
+    while True:
+        try:
+            await admission.acquire(cost)
+            break
+        except AdmissionRejected as ex:
+            await asyncio.sleep(ex.retry_after)
+    context = RequestContext()
+    try:
+        if item.get("character"):
+            return await tts.infer_with_ref_audio_embed(item["character"], item["text"], request_context=context,
+                                                        generation_config=generation_config)
+        return await tts.infer(item["audio_paths"], item["text"], request_context=context, generation_config=generation_config)
+    except asyncio.CancelledError:
+        await context.abort(tts.gpt.llm, "batch job cancelled")
+        raise
+    finally:
+        admission.release(cost)
+
+
+def encode_wav(wav, sr) -> bytes:
+    with stage_timer("encode"), io.BytesIO() as wav_buffer:
+        sf.write(wav_buffer, wav, sr, format='WAV')
+        return wav_buffer.getvalue()
+
 # 添加CORS中间件配置
 app.add_middleware(
     CORSMiddleware,
@@ -53,6 +106,31 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+def cancelled_response(ex: RequestCancelled):
+    # 499: 客户端已断开（nginx 约定），504: 超过 --request_timeout
+    print(f">> request cancelled: {ex.reason}")
+    return JSONResponse(
+        status_code=504 if ex.reason == "deadline exceeded" else 499,
+        content={
+            "status": "cancelled",
+            "error": ex.reason
+        }
+    )
+
+
+def rejected_response(ex: AdmissionRejected):
+    # 429: 超过 --admission_capacity_s 且排队已满 / 排队超时，Retry-After 为预计的排空时间
+    return JSONResponse(
+        status_code=429,
+        headers={"Retry-After": str(ex.retry_after)},
+        content={
+            "status": "rejected",
+            "error": ex.reason,
+            "retry_after": ex.retry_after
+        }
+    )
+
 @app.get("/health")
 async def health_check():
     """健康检查接口"""
@@ -72,7 +150,9 @@ async def health_check():
             content={
                 "status": "healthy",
                 "message": "Service is running",
-                "timestamp": time.time()
+                "timestamp": time.time(),
+                "conditioning_cache": tts.conditioning_cache.stats(),
+                "admission": admission.stats(),
             }
         )
     except Exception as ex:
@@ -84,9 +164,17 @@ async def health_check():
             }
         )
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 指标：各阶段耗时直方图、RTF、在途请求 / 句子数、生成音频时长"""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+
 
 @app.post("/tts_url", responses={
     200: {"content": {"application/octet-stream": {}}},
+    400: {"content": {"application/json": {}}},
     500: {"content": {"application/json": {}}}
 })
 async def tts_api_url(request: Request):
@@ -94,17 +182,28 @@ async def tts_api_url(request: Request):
         data = await request.json()
         text = data["text"]
         audio_paths = data["audio_paths"]
-        seed = data.get("seed", 8)
+        # 采样参数按请求生效，/tts_url 未传 seed 时沿用原来的默认值 8
+        generation_config = parse_generation_config(data)
+        generation_config.setdefault("seed", 8)
+    except (KeyError, TypeError, ValueError) as ex:
+        return JSONResponse(status_code=400, content={"status": "error", "error": f"invalid request: {ex!r}"})
 
+    try:
         global tts
-        sr, wav = await tts.infer(audio_paths, text, seed=seed)
+        # 客户端断开或超时时 abort 该请求在 vllm 中的所有句子
+        context = RequestContext(timeout=args.request_timeout)
+        async with admission.admit(admission.estimate_cost(text)):
+            sr, wav = await run_until_disconnected(request, tts.infer(audio_paths, text, request_context=context, generation_config=generation_config), context, tts.gpt.llm)
         
-        with io.BytesIO() as wav_buffer:
-            sf.write(wav_buffer, wav, sr, format='WAV')
-            wav_bytes = wav_buffer.getvalue()
+        # wav 编码放到 audio_io 线程池，不阻塞事件循环
+        wav_bytes = await tts.executors.run_audio_io(encode_wav, wav, sr)
 
         return Response(content=wav_bytes, media_type="audio/wav")
-    
+
+    except RequestCancelled as ex:
+        return cancelled_response(ex)
+    except AdmissionRejected as ex:
+        return rejected_response(ex)
     except Exception as ex:
         tb_str = ''.join(traceback.format_exception(type(ex), ex, ex.__traceback__))
         return JSONResponse(
@@ -118,6 +217,7 @@ async def tts_api_url(request: Request):
 
 @app.post("/tts", responses={
     200: {"content": {"application/octet-stream": {}}},
+    400: {"content": {"application/json": {}}},
     500: {"content": {"application/json": {}}}
 })
 async def tts_api(request: Request):
@@ -125,16 +225,25 @@ async def tts_api(request: Request):
         data = await request.json()
         text = data["text"]
         character = data["character"]
+        generation_config = parse_generation_config(data)
+    except (KeyError, TypeError, ValueError) as ex:
+        return JSONResponse(status_code=400, content={"status": "error", "error": f"invalid request: {ex!r}"})
 
+    try:
         global tts
-        sr, wav = await tts.infer_with_ref_audio_embed(character, text)
+        context = RequestContext(timeout=args.request_timeout)
+        async with admission.admit(admission.estimate_cost(text)):
+            sr, wav = await run_until_disconnected(request, tts.infer_with_ref_audio_embed(character, text, request_context=context, generation_config=generation_config), context, tts.gpt.llm)
         
-        with io.BytesIO() as wav_buffer:
-            sf.write(wav_buffer, wav, sr, format='WAV')
-            wav_bytes = wav_buffer.getvalue()
+        # wav 编码放到 audio_io 线程池，不阻塞事件循环
+        wav_bytes = await tts.executors.run_audio_io(encode_wav, wav, sr)
 
         return Response(content=wav_bytes, media_type="audio/wav")
-    
+
+    except RequestCancelled as ex:
+        return cancelled_response(ex)
+    except AdmissionRejected as ex:
+        return rejected_response(ex)
     except Exception as ex:
         tb_str = ''.join(traceback.format_exception(type(ex), ex, ex.__traceback__))
         print(tb_str)
@@ -162,28 +271,137 @@ async def tts_voices():
 
 
 
+@app.post("/batch/jobs")
+async def batch_job_submit(request: Request):
+    """提交离线批量任务，立即返回任务状态
+
+    请求体：{"manifest": 服务器上的 JSONL 路径 | "items": [...], "output_dir": ..., "response_format": "wav" | "flac"}，
+    manifest 每行 {"id"?, "text", "character" | "audio_paths", "output"?, 采样参数...}；
+    manifest、output_dir 与各条目的 audio_paths 相对 --batch_root 解析，不在其下的路径返回 400
+    """
+    try:
+        data = await request.json()
+        items = data.get("items")
+        if items is None:
+            def read_manifest(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    return [json.loads(line) for line in f if line.strip()]
+            items = await tts.executors.run_audio_io(read_manifest, batch_jobs.resolve(data["manifest"]))
+        for item in items:
+            if item.get("character") and item["character"] not in tts.speaker_dict:
+                raise ValueError(f"Character {item['character']} not found")
+            if not item.get("character") and not item.get("audio_paths"):
+                raise ValueError(f"item {item.get('id')}: character or audio_paths is required")
+            parse_generation_config(item)
+        job = await batch_jobs.submit(items, data["output_dir"], response_format=data.get("response_format") or "wav")
+        return JSONResponse(status_code=200, content=job.stats())
+    except (AttributeError, KeyError, TypeError, ValueError, OSError) as ex:
+        return JSONResponse(status_code=400, content={"status": "error", "error": f"invalid batch job: {ex!r}"})
+
+
+@app.get("/batch/jobs")
+async def batch_job_list():
+    return batch_jobs.list_jobs()
+
+
+@app.get("/batch/jobs/{job_id}")
+async def batch_job_status(job_id: str):
+    """任务进度：done / failed / pending 条数、已生成音频时长、吞吐与预计剩余时间"""
+    job = batch_jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"status": "error", "error": f"job {job_id} not found"})
+    return job.stats()
+
+
+@app.post("/batch/jobs/{job_id}/cancel")
+async def batch_job_cancel(job_id: str):
+    if batch_jobs.get(job_id) is None:
+        return JSONResponse(status_code=404, content={"status": "error", "error": f"job {job_id} not found"})
+    return (await batch_jobs.cancel(job_id)).stats()
+
+
+@app.post("/batch/jobs/{job_id}/resume")
+async def batch_job_resume(job_id: str):
+    """继续已取消的任务，或重试已结束任务中失败的条目"""
+    if batch_jobs.get(job_id) is None:
+        return JSONResponse(status_code=404, content={"status": "error", "error": f"job {job_id} not found"})
+    return batch_jobs.restart(job_id).stats()
+
+
 @app.post("/audio/speech", responses={
     200: {"content": {"application/octet-stream": {}}},
+    400: {"content": {"application/json": {}}},
     500: {"content": {"application/json": {}}}
 })
 async def tts_api_openai(request: Request):
-    """ OpenAI competible API, see: https://api.openai.com/v1/audio/speech """
+    """ OpenAI competible API, see: https://api.openai.com/v1/audio/speech
+
+    response_format: mp3 / opus / aac / flac / wav / pcm，默认 wav（兼容旧客户端）
+    speed: 0.25 ~ 4.0，通过 ffmpeg atempo 变速，不改变音高
+    stream: true 时逐句编码并以 chunked 方式返回
+    """
     try:
         data = await request.json()
         text = data["input"]
         character = data["voice"]
         #model param is omitted
         _model = data["model"]
+        response_format = data.get("response_format") or "wav"
+        speed = float(data.get("speed") or 1.0)
+        stream = data.get("stream", False)
+        if isinstance(stream, str) and stream.lower() in ["true", "false"]:
+            stream = stream.lower() == "true"
+        if stream is None:
+            stream = False
+        if not isinstance(stream, bool):
+            raise ValueError(f"invalid stream: {stream!r}, expected true or false")
+        # 流式响应在返回 200 之后才开始合成，未知的 voice 需要在此之前检查
+        if character not in tts.speaker_dict:
+            raise ValueError(f"voice {character} not found")
+        validate_response_format(response_format, speed)
+        generation_config = parse_generation_config(data)
+    except (KeyError, TypeError, ValueError) as ex:
+        return JSONResponse(status_code=400, content={"status": "error", "error": f"invalid request: {ex!r}"})
 
-        global tts
-        sr, wav = await tts.infer_with_ref_audio_embed(character, text)
-        
-        with io.BytesIO() as wav_buffer:
-            sf.write(wav_buffer, wav, sr, format='WAV')
-            wav_bytes = wav_buffer.getvalue()
+    context = RequestContext(timeout=args.request_timeout)
+    media_type = RESPONSE_FORMATS[response_format]
 
-        return Response(content=wav_bytes, media_type="audio/wav")
-    
+    if stream:
+        async def pcm_chunks():
+            async for _, wav in tts.stream_infer_with_ref_audio_embed(character, text, request_context=context,
+                                                                      generation_config=generation_config):
+                yield wav
+
+        async def generate_audio():
+            try:
+                async for chunk in stream_encoded_audio(pcm_chunks(), 24000, response_format, speed):
+                    yield chunk
+            except RequestCancelled as ex:
+                print(f">> /audio/speech stream cancelled: {ex.reason}")
+            finally:
+                # 客户端断开时 starlette 会取消本生成器，abort 掉该请求仍在 vllm 中运行的句子
+                await context.abort(tts.gpt.llm, "client disconnected")
+
+        try:
+            # 在返回响应之前等待准入，被拒绝时仍可以返回 429；名额在流结束时归还
+            content = await admission.admit_stream(admission.estimate_cost(text), generate_audio())
+        except AdmissionRejected as ex:
+            return rejected_response(ex)
+        return StreamingResponse(content=content, media_type=media_type, headers={"Cache-Control": "no-cache"})
+
+    try:
+        async with admission.admit(admission.estimate_cost(text)):
+            sr, wav = await run_until_disconnected(request, tts.infer_with_ref_audio_embed(character, text, request_context=context, generation_config=generation_config), context, tts.gpt.llm)
+
+        # 编码（含 ffmpeg 子进程）放到 audio_io 线程池，不阻塞事件循环
+        audio_bytes = await tts.executors.run_audio_io(encode_audio, wav, sr, response_format, speed)
+
+        return Response(content=audio_bytes, media_type=media_type)
+
+    except RequestCancelled as ex:
+        return cancelled_response(ex)
+    except AdmissionRejected as ex:
+        return rejected_response(ex)
     except Exception as ex:
         tb_str = ''.join(traceback.format_exception(type(ex), ex, ex.__traceback__))
         print(tb_str)
@@ -202,6 +420,27 @@ if __name__ == "__main__":
     parser.add_argument("--port", type=int, default=11996)
     parser.add_argument("--model_dir", type=str, default="/path/to/IndexTeam/Index-TTS")
     parser.add_argument("--gpu_memory_utilization", type=float, default=0.25)
+    parser.add_argument("--vocoder_max_batch_size", type=int, default=8, help="Max sentences per BigVGAN batch, 1 disables batching")
+    parser.add_argument("--vocoder_batch_wait_ms", type=float, default=5.0, help="Time window to gather a BigVGAN batch")
+    parser.add_argument("--speaker_cache_dir", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets/speaker_cache"),
+                        help="Directory to persist registered speaker features, empty string disables it")
+    parser.add_argument("--conditioning_cache_size", type=int, default=64, help="Max reference audios kept in the conditioning LRU, 0 disables it")
+    parser.add_argument("--conditioning_cache_mb", type=float, default=512, help="Max size in MB of the conditioning LRU")
+    parser.add_argument("--max_tokens_ratio", type=float, default=10.0, help="Per-sentence mel token budget per text token, 0 disables it")
+    parser.add_argument("--max_tokens_margin", type=int, default=50, help="Constant added to the per-sentence mel token budget")
+    parser.add_argument("--disable_prefix_caching", action="store_true", help="Disable vllm prefix caching of the speaker conditioning block")
+    parser.add_argument("--request_timeout", type=float, default=0, help="Abort a request after this many seconds, 0 disables the deadline")
+    parser.add_argument("--admission_capacity_s", type=float, default=0,
+                        help="Estimated seconds of audio allowed in flight before requests queue, 0 disables admission control")
+    parser.add_argument("--admission_max_queue", type=int, default=64, help="Requests allowed to wait for admission, more get 429")
+    parser.add_argument("--admission_queue_timeout_s", type=float, default=30, help="Seconds a request may wait for admission before 429")
+    parser.add_argument("--admission_mel_tokens_per_text_token", type=float, default=5.0,
+                        help="Expected mel tokens per text token used to estimate the cost of a request")
+    parser.add_argument("--batch_jobs_dir", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets/batch_jobs"),
+                        help="Directory persisting batch job manifests and progress, unfinished jobs resume on startup")
+    parser.add_argument("--batch_max_concurrent_items", type=int, default=32, help="Batch job items synthesized at the same time")
+    parser.add_argument("--batch_root", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets/batch_data"),
+                        help="Directory batch job manifest and output_dir paths are resolved under, paths outside it are rejected")
     args = parser.parse_args()
 
     uvicorn.run(app=app, host=args.host, port=args.port)
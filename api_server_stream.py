@@ -1,11 +1,12 @@
 
 import os
+import tempfile
 # os.environ["CUDA_VISIBLE_DEVICES"] = "7"
 
 import asyncio
 import io
 import traceback
-from fastapi import FastAPI, Request, Response
+from fastapi import FastAPI, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.responses import JSONResponse, StreamingResponse
 from contextlib import asynccontextmanager
 import uvicorn
@@ -18,18 +19,37 @@ import soundfile as sf
 
 from indextts.gpt.perceiver import print_once
 # from indextts.infer_vllm import IndexTTS
-from indextts.infer_vllm_stream import IndexTTS
+from indextts.infer_vllm_stream import SPLIT_MODES, IndexTTS
+from indextts.utils.audio_encoding import FRAME_HEADER, SAMPLE_FORMATS, encode_pcm_chunk, raw_media_type
+from indextts.utils.audio_fetcher import AudioFetcher
+from indextts.utils.admission import AdmissionController, AdmissionRejected
+from indextts.utils.generation_config import parse_generation_config
+from indextts.utils.metrics import observe_stage, render_metrics, stage_timer
+from indextts.utils.request_context import RequestCancelled, RequestContext, run_until_disconnected
 
 
 
 
 tts = None
+audio_fetcher = None
+admission = None
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global tts
+    global tts, audio_fetcher, admission
+    admission = AdmissionController(args.admission_capacity_s, max_queue=args.admission_max_queue,
+                                    queue_timeout=args.admission_queue_timeout_s,
+                                    mel_tokens_per_text_token=args.admission_mel_tokens_per_text_token)
     cfg_path = os.path.join(args.model_dir, "config.yaml")
-    tts = IndexTTS(model_dir=args.model_dir, cfg_path=cfg_path, gpu_memory_utilization=args.gpu_memory_utilization)
+    tts = IndexTTS(model_dir=args.model_dir, cfg_path=cfg_path, gpu_memory_utilization=args.gpu_memory_utilization,
+                   vocoder_max_batch_size=args.vocoder_max_batch_size, vocoder_batch_wait_ms=args.vocoder_batch_wait_ms,
+                   speaker_cache_dir=args.speaker_cache_dir,
+                   conditioning_cache_size=args.conditioning_cache_size, conditioning_cache_mb=args.conditioning_cache_mb,
+                   max_tokens_ratio=args.max_tokens_ratio, max_tokens_margin=args.max_tokens_margin,
+                   enable_prefix_caching=not args.disable_prefix_caching,
+                   stream_lookahead_sentences=args.stream_lookahead_sentences,
+                   stream_left_context=args.stream_left_context if args.stream_left_context >= 0 else None,
+                   stream_lookahead_frames=args.stream_lookahead_frames, stream_crossfade_frames=args.stream_crossfade_frames)
 
     current_file_path = os.path.abspath(__file__)
     cur_dir = os.path.dirname(current_file_path)
@@ -39,22 +59,27 @@ async def lifespan(app: FastAPI):
 
         for speaker, audio_paths in speaker_dict.items():
             tts.registry_speaker(speaker, audio_paths)
+    audio_fetcher = AudioFetcher(args.audio_cache_dir, max_bytes=int(args.audio_cache_mb * 1024 * 1024),
+                                 revalidate_after=args.audio_cache_revalidate_s, executor=tts.executors.audio_io)
     yield
+    await audio_fetcher.close()
+    tts.executors.shutdown()
     # Clean up the ML models and release the resources
     # ml_models.clear()
 
 app = FastAPI(lifespan=lifespan)
 
+
+def encode_wav(wav, sr) -> bytes:
+    with stage_timer("encode"), io.BytesIO() as wav_buffer:
+        sf.write(wav_buffer, wav, sr, format='WAV')
+        return wav_buffer.getvalue()
+
+
+
 # 20250708 lsp 下载音频文件
 async def download_audio(url: str) -> str:
-    """下载音频到临时文件，返回本地路径"""
-    import requests
-    from pathlib import Path
-    import tempfile
-    from urllib.parse import unquote, urlparse
-    import os
-    from datetime import datetime
-
+    """本地路径直接返回，http(s) URL 通过 audio_fetcher 下载（按内容缓存），返回本地路径"""
     # 检查是否是本地文件路径（包括file://协议或普通路径）
     if url.startswith('file://'):
         # 处理file://协议
@@ -69,33 +94,89 @@ async def download_audio(url: str) -> str:
             return url
         else:
             raise FileNotFoundError(f"本地文件不存在: {url}")
-    
-    # 从 URL 中提取文件名
-    parsed_url = urlparse(url)
-    original_filename = unquote(os.path.basename(parsed_url.path))
-    # 如果 URL 没有文件名，则生成时间戳文件名
-    if not original_filename:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        original_filename = f"tts_audio_{timestamp}.wav"
 
-        # 创建临时文件路径
-    temp_dir = Path(tempfile.gettempdir())
-    local_path = temp_dir / original_filename
-    print(f"下载临时文件 url={url} path={str(local_path)}")
+    # 推理读取参考音频之前文件不会被淘汰，用完后需 release_audio
+    return await audio_fetcher.acquire(url)
+
+
+async def download_audios(urls):
+    """并发下载多段参考音频，任一失败时释放其余已取得的文件"""
+    results = await asyncio.gather(*[download_audio(url) for url in urls], return_exceptions=True)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        release_audio([result for result in results if not isinstance(result, BaseException)])
+        raise errors[0]
+    return list(results)
+
 
-    # 下载文件
-    response = requests.get(url, stream=True)
-    response.raise_for_status()  # 检查 HTTP 错误
-    with open(local_path, "wb") as f:
-        for chunk in response.iter_content(chunk_size=8192):
-            f.write(chunk)
+def release_audio(audio_paths):
+    """释放 download_audio 从缓存中取得的文件，本地路径忽略"""
+    for path in audio_paths or []:
+        if os.path.dirname(os.path.abspath(path)) == os.path.abspath(audio_fetcher.cache_dir):
+            audio_fetcher.release(path)
 
-    return str(local_path)
+
+
+
+def cancelled_response(ex: RequestCancelled):
+    # 499: 客户端已断开（nginx 约定），504: 超过 --request_timeout
+    print(f">> request cancelled: {ex.reason}")
+    return JSONResponse(
+        status_code=504 if ex.reason == "deadline exceeded" else 499,
+        content={
+            "status": "cancelled",
+            "error": ex.reason
+        }
+    )
+
+
+def rejected_response(ex: AdmissionRejected):
+    # 429: 超过 --admission_capacity_s 且排队已满 / 排队超时，Retry-After 为预计的排空时间
+    return JSONResponse(
+        status_code=429,
+        headers={"Retry-After": str(ex.retry_after)},
+        content={
+            "status": "rejected",
+            "error": ex.reason,
+            "retry_after": ex.retry_after
+        }
+    )
+
+@app.get("/health")
+async def health_check():
+    """健康检查接口"""
+    global tts
+    if tts is None:
+        return JSONResponse(
+            status_code=503,
+            content={
+                "status": "unhealthy",
+                "message": "TTS model not initialized"
+            }
+        )
+    return JSONResponse(
+        status_code=200,
+        content={
+            "status": "healthy",
+            "message": "Service is running",
+            "timestamp": time.time(),
+            "conditioning_cache": tts.conditioning_cache.stats(),
+            "admission": admission.stats(),
+            "audio_cache": audio_fetcher.stats(),
+        }
+    )
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 指标：各阶段耗时直方图、RTF、在途请求 / 句子数、生成音频时长"""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
 
 
 
 @app.post("/tts_url", responses={
     200: {"content": {"application/octet-stream": {}}},
+    400: {"content": {"application/json": {}}},
     500: {"content": {"application/json": {}}}
 })
 async def tts_api_url(request: Request):
@@ -106,19 +187,33 @@ async def tts_api_url(request: Request):
         # 20250708 lsp 本地文件改为兼容网络文件
         # audio_paths = data["audio_paths"]
         audio_urls =  data["audio_paths"]
-        audio_paths = [await download_audio(url) for url in audio_urls]
+        generation_config = parse_generation_config(data)
+    except (KeyError, TypeError, ValueError) as ex:
+        return JSONResponse(status_code=400, content={"status": "error", "error": f"invalid request: {ex!r}"})
+
+    try:
+        audio_paths = await download_audios(audio_urls)
 
         print(f"tts_api_url audio_paths={audio_paths}\ntext={text} ")
 
         global tts
-        sr, wav = await tts.infer(audio_paths, text)
+        # 客户端断开或超时时 abort 该请求在 vllm 中的所有句子
+        context = RequestContext(timeout=args.request_timeout)
+        try:
+            async with admission.admit(admission.estimate_cost(text)):
+                sr, wav = await run_until_disconnected(request, tts.infer(audio_paths, text, request_context=context, generation_config=generation_config), context, tts.gpt.llm)
+        finally:
+            release_audio(audio_paths)
 
-        with io.BytesIO() as wav_buffer:
-            sf.write(wav_buffer, wav, sr, format='WAV')
-            wav_bytes = wav_buffer.getvalue()
+        # wav 编码放到 audio_io 线程池，不阻塞事件循环
+        wav_bytes = await tts.executors.run_audio_io(encode_wav, wav, sr)
 
         return Response(content=wav_bytes, media_type="audio/wav")
-    
+
+    except RequestCancelled as ex:
+        return cancelled_response(ex)
+    except AdmissionRejected as ex:
+        return rejected_response(ex)
     except Exception as ex:
         tb_str = ''.join(traceback.format_exception(type(ex), ex, ex.__traceback__))
         return JSONResponse(
@@ -130,63 +225,275 @@ async def tts_api_url(request: Request):
         )
 
 
-@app.post("/tts_live_stream")
+@app.post("/tts_live_stream", responses={
+    200: {"content": {"audio/x-raw": {}}},
+    400: {"content": {"application/json": {}}},
+    429: {"content": {"application/json": {}}}
+})
 async def tts_live_stream(request: Request):
+    request_start_time = time.perf_counter()
     try:
-        from io import BytesIO
-
         data = await request.json()
         text = data["text"]
         character = data.get("character")
-        
+        # >0 时按 mel token 粒度流式输出，降低首包延迟
+        chunk_tokens = int(data.get("chunk_tokens", args.stream_chunk_tokens))
+        # fast_first: 首段在逗号等子句边界截短，进一步降低首包延迟
+        split_mode = data.get("split_mode") or args.stream_split_mode
+        if split_mode not in SPLIT_MODES:
+            raise ValueError(f"invalid split_mode: {split_mode}, expected one of {SPLIT_MODES}")
+        # pcm16（默认）/ float32；framing=true 时每块前加 FRAME_HEADER（seq、采样点数、句子序号）
+        sample_format = data.get("sample_format") or args.stream_sample_format
+        if sample_format not in SAMPLE_FORMATS:
+            raise ValueError(f"invalid sample_format: {sample_format}, expected one of {list(SAMPLE_FORMATS)}")
+        framing = bool(data.get("framing", False))
+        generation_config = parse_generation_config(data)
+        audio_urls = None if character else data["audio_paths"]
+    except (KeyError, TypeError, ValueError) as ex:
+        return JSONResponse(status_code=400, content={"status": "error", "error": f"invalid request: {ex!r}"})
+
+    try:
         if character:
             # 使用预注册的角色特征
             if character not in tts.speaker_dict:
                 return {"error": f"Character {character} not found"}
-            audio_paths = None  # 不需要音频路径
+            audio_paths = []  # 不需要音频路径
         else:
             # 使用传入的音频路径
-            audio_urls = data["audio_paths"]
-            audio_paths = [await download_audio(url) for url in audio_urls]
+            audio_paths = await download_audios(audio_urls)
 
         print(f"tts_live_stream character={character} audio_paths={audio_paths}\ntext={text} ")
 
+        context = RequestContext(timeout=args.request_timeout)
+
         async def generate_audio_frames():
             if character:
                 # 使用新的stream_infer_with_character方法
-                async for sr, pcm_data in tts.stream_infer_with_character(character, text):
-                    # 将PCM数据转换为float32格式（适合Web Audio API）
-                    pcm_float = pcm_data.astype(np.float32) / 32767.0
-
-                    # 使用RAW格式输出，不带WAV头
-                    with BytesIO() as bio:
-                        sf.write(bio, pcm_float, sr, format='RAW', subtype='FLOAT')
-                        yield bio.getvalue()
+                stream = tts.stream_infer_with_character(character, text, request_context=context, chunk_tokens=chunk_tokens,
+                                                         generation_config=generation_config, split_mode=split_mode,
+                                                         return_sentence_index=True)
             else:
-                async for sr, pcm_data in tts.stream_infer(audio_paths, text):
-                    # 将PCM数据转换为float32格式（适合Web Audio API）
-                    pcm_float = pcm_data.astype(np.float32) / 32767.0
-
-                    # 使用RAW格式输出，不带WAV头
-                    with BytesIO() as bio:
-                        sf.write(bio, pcm_float, sr, format='RAW', subtype='FLOAT')
-                        yield bio.getvalue()
-
+                stream = tts.stream_infer(audio_paths, text, request_context=context, chunk_tokens=chunk_tokens,
+                                          generation_config=generation_config, split_mode=split_mode,
+                                          return_sentence_index=True)
+            seq = 0
+            try:
+                async for sr, sentence_index, pcm_data in stream:
+                    # RAW 格式输出，不带 WAV 头，直接发送 numpy buffer
+                    chunk = encode_pcm_chunk(pcm_data, sample_format)
+                    if seq == 0:
+                        observe_stage("first_chunk", time.perf_counter() - request_start_time)
+                    if framing:
+                        yield FRAME_HEADER.pack(seq, len(pcm_data), sentence_index)
+                    seq += 1
+                    yield chunk
+            except RequestCancelled as ex:
+                print(f">> tts_live_stream cancelled: {ex.reason}")
+            finally:
+                # 客户端断开时 starlette 会取消本生成器，abort 掉该请求仍在 vllm 中运行的句子
+                release_audio(audio_paths)
+                await context.abort(tts.gpt.llm, "client disconnected")
+
+        # 在返回响应之前等待准入，被拒绝时仍可以返回 429；名额在流结束时归还
+        try:
+            content = await admission.admit_stream(admission.estimate_cost(text), generate_audio_frames())
+        except BaseException:
+            release_audio(audio_paths)
+            raise
         return StreamingResponse(
-            content=generate_audio_frames(),
+            content=content,
             media_type="audio/x-raw",
             headers={
-                "Content-Type": "audio/x-raw; rate=24000; channels=1",
+                "Content-Type": raw_media_type(24000, sample_format),
+                "X-Audio-Framing": "seq,samples,sentence_index;uint32le" if framing else "none",
                 "Cache-Control": "no-cache",
                 "Connection": "keep-alive",
             }
         )
 
+    except AdmissionRejected as ex:
+        return rejected_response(ex)
     except Exception as ex:
         return {"error": str(ex)}
 
+@app.websocket("/tts_ws")
+async def tts_websocket(websocket: WebSocket):
+    """双向流式接口：客户端逐段推送文本（如 LLM 的逐 token 输出），服务端边收边分句，句子一完整就开始合成
+
+    客户端消息（JSON 文本帧）：
+        {"type": "start", "character": ..., "chunk_tokens"?, "sample_format"?, "framing"?, 采样参数...}  开始一段语音
+        {"type": "text", "text": ...}  追加文本增量
+        {"type": "end"}  本段文本结束
+        {"type": "cancel"}  中止正在合成的语音，并丢弃已 start 但尚未开始合成的语音
+    服务端消息：
+        {"type": "start", "utterance_id", "sample_rate", "sample_format"}，随后为二进制音频帧
+        （framing 时带 FRAME_HEADER），合成结束后 {"type": "end", "utterance_id", "sentences", "audio_seconds"}；
+        出错 / 被取消时 {"type": "error" | "cancelled", "utterance_id", "error"}（cancel 时没有可中止的语音，
+        utterance_id 为 null），
+        超过准入控制被拒绝时 {"type": "error", "utterance_id", "error", "retry_after"}
+    一个连接上可以依次发送多段语音，按开始顺序合成、输出；前一段仍在合成时就可以开始推送下一段的文本。
+    """
+    await websocket.accept()
+    send_lock = asyncio.Lock()
+    utterances = asyncio.Queue()  # (utterance_id, config, text_queue)，按 start 顺序
+    text_queue = None  # 正在接收文本的语音
+    texts = None  # 正在接收文本的语音已收到的文本，用于准入控制估算代价
+    active = {}  # 正在合成的 {"task", "context"}
+
+    async def send_json(message):
+        async with send_lock:
+            await websocket.send_text(json.dumps(message, ensure_ascii=False))
+
+    async def send_bytes(data):
+        async with send_lock:
+            await websocket.send_bytes(data)
+
+    async def text_deltas(queue, budget):
+        # 已消费文本的代价超过已申请的名额时追加，按增量累计 token 数（跨增量的单词会多计，偏保守）
+        text_tokens = 0
+        while True:
+            delta = await queue.get()
+            if delta is None:
+                return
+            text_tokens += admission.count_text_tokens(delta)
+            cost = admission.tokens_cost(text_tokens)
+            if cost > budget["cost"]:
+                admission.charge(cost - budget["cost"])
+                budget["cost"] = cost
+            yield delta
+
+    async def synthesize(utterance_id, config, queue):
+        # 开始合成时文本通常尚未到齐：先按已收到文本的代价与 --admission_ws_reserve_s 中的较大者申请，
+        # 之后文本超出时追加；在 task 内等待准入，排队时也可以被 cancel，结束或取消时归还累计的代价
+        budget = {"cost": max(admission.estimate_cost("".join(config["texts"])), args.admission_ws_reserve_s)}
+        await admission.acquire(budget["cost"])
+        try:
+            await synthesize_admitted(utterance_id, config, queue, budget)
+        finally:
+            admission.release(budget["cost"])
+
+    async def synthesize_admitted(utterance_id, config, queue, budget):
+        context = active["context"]
+        sample_format = config["sample_format"]
+        await send_json({"type": "start", "utterance_id": utterance_id, "sample_rate": 24000, "sample_format": sample_format})
+        request_start_time = time.perf_counter()
+        seq, num_samples, num_sentences = 0, 0, 0
+        stream = tts.stream_infer_with_character(config["character"], text_deltas(queue, budget), request_context=context,
+                                                 chunk_tokens=config["chunk_tokens"],
+                                                 generation_config=config["generation_config"],
+                                                 return_sentence_index=True)
+        async for sr, sentence_index, pcm_data in stream:
+            chunk = encode_pcm_chunk(pcm_data, sample_format)
+            if seq == 0:
+                observe_stage("first_chunk", time.perf_counter() - request_start_time)
+            if config["framing"]:
+                chunk = FRAME_HEADER.pack(seq, len(pcm_data), sentence_index) + chunk
+            await send_bytes(chunk)
+            seq += 1
+            num_samples += len(pcm_data)
+            num_sentences = sentence_index + 1
+        await send_json({"type": "end", "utterance_id": utterance_id, "sentences": num_sentences,
+                         "audio_seconds": num_samples / 24000})
+
+    async def run_utterances():
+        # 逐段合成，保证同一连接上音频帧的顺序与语音的开始顺序一致
+        while True:
+            utterance_id, config, queue = await utterances.get()
+            context = RequestContext(timeout=args.request_timeout)
+            task = asyncio.ensure_future(synthesize(utterance_id, config, queue))
+            active.update(task=task, context=context)
+            try:
+                await task
+            except asyncio.CancelledError:
+                if not active.get("cancelled_by_client"):
+                    raise  # run_utterances 本身被取消（连接断开）
+                await send_json({"type": "cancelled", "utterance_id": utterance_id, "error": "cancelled by client"})
+            except RequestCancelled as ex:
+                await send_json({"type": "cancelled", "utterance_id": utterance_id, "error": ex.reason})
+            except AdmissionRejected as ex:
+                await send_json({"type": "error", "utterance_id": utterance_id, "error": ex.reason,
+                                 "retry_after": ex.retry_after})
+            except Exception as ex:
+                traceback.print_exc()
+                await send_json({"type": "error", "utterance_id": utterance_id, "error": str(ex)})
+            finally:
+                active.clear()
+                await context.abort(tts.gpt.llm, "utterance finished")
+
+    async def cancel_active():
+        # 中止正在合成的语音，丢弃尚未开始的语音；之后的 text 需要先发送新的 start
+        nonlocal text_queue, texts
+        text_queue, texts = None, None
+        cancelled = []
+        while not utterances.empty():
+            cancelled.append(utterances.get_nowait()[0])
+        for utterance_id in cancelled:
+            await send_json({"type": "cancelled", "utterance_id": utterance_id, "error": "cancelled by client"})
+        task, context = active.get("task"), active.get("context")
+        if task is not None and not task.done():
+            # 正在合成的语音由 run_utterances 回复 cancelled
+            active["cancelled_by_client"] = True
+            task.cancel()
+            await context.abort(tts.gpt.llm, "cancelled by client")
+        elif not cancelled:
+            await send_json({"type": "cancelled", "utterance_id": None, "error": "no active utterance"})
+
+    worker = asyncio.ensure_future(run_utterances())
+    next_utterance_id = 0
+    try:
+        while True:
+            try:
+                message = json.loads(await websocket.receive_text())
+                message_type = message.get("type")
+                if message_type == "start":
+                    character = message.get("character")
+                    if character not in tts.speaker_dict:
+                        raise ValueError(f"Character {character} not found")
+                    sample_format = message.get("sample_format") or args.stream_sample_format
+                    if sample_format not in SAMPLE_FORMATS:
+                        raise ValueError(f"invalid sample_format: {sample_format}, expected one of {list(SAMPLE_FORMATS)}")
+                    config = {
+                        "character": character,
+                        "chunk_tokens": int(message.get("chunk_tokens", args.stream_chunk_tokens)),
+                        "sample_format": sample_format,
+                        "framing": bool(message.get("framing", False)),
+                        "generation_config": parse_generation_config(message),
+                        "texts": [],
+                    }
+                    if text_queue is not None:
+                        text_queue.put_nowait(None)  # 未发送 end 的上一段视为文本结束
+                    text_queue = asyncio.Queue()
+                    texts = config["texts"]
+                    utterances.put_nowait((next_utterance_id, config, text_queue))
+                    next_utterance_id += 1
+                elif message_type == "text":
+                    if text_queue is None:
+                        raise ValueError("text received before start")
+                    delta = str(message.get("text", ""))
+                    texts.append(delta)
+                    text_queue.put_nowait(delta)
+                elif message_type == "end":
+                    if text_queue is not None:
+                        text_queue.put_nowait(None)
+                        text_queue = None
+                elif message_type == "cancel":
+                    await cancel_active()
+                else:
+                    raise ValueError(f"invalid message type: {message_type}")
+            except (ValueError, TypeError, KeyError) as ex:
+                await send_json({"type": "error", "error": str(ex)})
+    except WebSocketDisconnect:
+        print(">> tts_websocket client disconnected")
+    finally:
+        # 连接断开：停止后续语音，abort 仍在 vllm 中运行的句子
+        worker.cancel()
+        if active.get("context") is not None:
+            await active["context"].abort(tts.gpt.llm, "client disconnected")
+
+
 @app.post("/tts", responses={
     200: {"content": {"application/octet-stream": {}}},
+    400: {"content": {"application/json": {}}},
     500: {"content": {"application/json": {}}}
 })
 async def tts_api(request: Request):
@@ -194,16 +501,25 @@ async def tts_api(request: Request):
         data = await request.json()
         text = data["text"]
         character = data["character"]
+        generation_config = parse_generation_config(data)
+    except (KeyError, TypeError, ValueError) as ex:
+        return JSONResponse(status_code=400, content={"status": "error", "error": f"invalid request: {ex!r}"})
 
+    try:
         global tts
-        sr, wav = await tts.infer_with_ref_audio_embed(character, text)
+        context = RequestContext(timeout=args.request_timeout)
+        async with admission.admit(admission.estimate_cost(text)):
+            sr, wav = await run_until_disconnected(request, tts.infer_with_ref_audio_embed(character, text, request_context=context, generation_config=generation_config), context, tts.gpt.llm)
         
-        with io.BytesIO() as wav_buffer:
-            sf.write(wav_buffer, wav, sr, format='WAV')
-            wav_bytes = wav_buffer.getvalue()
+        # wav 编码放到 audio_io 线程池，不阻塞事件循环
+        wav_bytes = await tts.executors.run_audio_io(encode_wav, wav, sr)
 
         return Response(content=wav_bytes, media_type="audio/wav")
-    
+
+    except RequestCancelled as ex:
+        return cancelled_response(ex)
+    except AdmissionRejected as ex:
+        return rejected_response(ex)
     except Exception as ex:
         tb_str = ''.join(traceback.format_exception(type(ex), ex, ex.__traceback__))
         print(tb_str)
@@ -221,6 +537,38 @@ if __name__ == "__main__":
     parser.add_argument("--port", type=int, default=7860)
     parser.add_argument("--model_dir", type=str, default="/data/wts/index-tts-vllm/pretrain/IndexTeam/IndexTTS-1.5")
     parser.add_argument("--gpu_memory_utilization", type=float, default=0.25)
+    parser.add_argument("--vocoder_max_batch_size", type=int, default=8, help="Max sentences per BigVGAN batch, 1 disables batching")
+    parser.add_argument("--vocoder_batch_wait_ms", type=float, default=5.0, help="Time window to gather a BigVGAN batch")
+    parser.add_argument("--speaker_cache_dir", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets/speaker_cache"),
+                        help="Directory to persist registered speaker features, empty string disables it")
+    parser.add_argument("--conditioning_cache_size", type=int, default=64, help="Max reference audios kept in the conditioning LRU, 0 disables it")
+    parser.add_argument("--audio_cache_dir", type=str, default=os.path.join(tempfile.gettempdir(), "indextts_audio_cache"),
+                        help="Directory caching reference audio downloaded from audio_paths URLs")
+    parser.add_argument("--audio_cache_mb", type=float, default=1024, help="Max size in MB of the downloaded audio cache")
+    parser.add_argument("--audio_cache_revalidate_s", type=float, default=60,
+                        help="Seconds a cached URL is used before revalidating it with ETag / Last-Modified, 0 revalidates every request")
+    parser.add_argument("--conditioning_cache_mb", type=float, default=512, help="Max size in MB of the conditioning LRU")
+    parser.add_argument("--max_tokens_ratio", type=float, default=10.0, help="Per-sentence mel token budget per text token, 0 disables it")
+    parser.add_argument("--max_tokens_margin", type=int, default=50, help="Constant added to the per-sentence mel token budget")
+    parser.add_argument("--disable_prefix_caching", action="store_true", help="Disable vllm prefix caching of the speaker conditioning block")
+    parser.add_argument("--request_timeout", type=float, default=0, help="Abort a request after this many seconds, 0 disables the deadline")
+    parser.add_argument("--admission_capacity_s", type=float, default=0,
+                        help="Estimated seconds of audio allowed in flight before requests queue, 0 disables admission control")
+    parser.add_argument("--admission_max_queue", type=int, default=64, help="Requests allowed to wait for admission, more get 429")
+    parser.add_argument("--admission_queue_timeout_s", type=float, default=30, help="Seconds a request may wait for admission before 429")
+    parser.add_argument("--admission_mel_tokens_per_text_token", type=float, default=5.0,
+                        help="Expected mel tokens per text token used to estimate the cost of a request")
+    parser.add_argument("--admission_ws_reserve_s", type=float, default=10.0,
+                        help="Seconds of audio reserved for each /tts_ws utterance before its text has arrived")
+    parser.add_argument("--stream_lookahead_sentences", type=int, default=2, help="Sentences decoded ahead of the one being streamed, 0 disables pipelining")
+    parser.add_argument("--stream_split_mode", type=str, default="sentence", choices=SPLIT_MODES,
+                        help="Default sentence splitting of /tts_live_stream, fast_first cuts the first segment short")
+    parser.add_argument("--stream_sample_format", type=str, default="pcm16", choices=list(SAMPLE_FORMATS),
+                        help="Default sample format of /tts_live_stream")
+    parser.add_argument("--stream_chunk_tokens", type=int, default=0, help="Default mel tokens per chunk for /tts_live_stream, 0 streams whole sentences")
+    parser.add_argument("--stream_left_context", type=int, default=-1, help="Latent frames of left context per vocoded chunk, -1 uses the BigVGAN receptive field")
+    parser.add_argument("--stream_lookahead_frames", type=int, default=4, help="Latent frames held back from each chunk as right context")
+    parser.add_argument("--stream_crossfade_frames", type=int, default=2, help="Latent frames crossfaded between adjacent chunks")
     args = parser.parse_args()
 
     uvicorn.run(app=app, host=args.host, port=args.port)
\ No newline at end of file
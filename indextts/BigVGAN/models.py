@@ -3,11 +3,14 @@
 
 # Adapted from https://github.com/jik876/hifi-gan under the MIT license.
 #   LICENSE is in incl_licenses directory.
+import math
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import Conv1d, Conv2d, ConvTranspose1d
 from torch.nn.utils import remove_weight_norm, spectral_norm, weight_norm
+from torch.nn.utils.rnn import pad_sequence
 
 import indextts.BigVGAN.activations as activations
 
@@ -198,13 +201,33 @@ class BigVGAN(torch.nn.Module):
 
         # self.logit_scale = nn.Parameter(torch.ones([]) * np.log(1 / 0.07))
 
-    def forward(self, x, mel_ref, lens=None):
+    def get_speaker_embedding(self, mel_ref, lens=None):
+        """Average the ECAPA speaker embeddings of all reference mels.
+
+        Args:
+            mel_ref (list[Tensor]): reference mels, each of shape (b, t, num_mels).
+            lens (Tensor, optional): relative lengths passed to the speaker encoder.
+
+        Returns:
+            Tensor: speaker embedding of shape (b, 1, speaker_embedding_dim).
+        """
+        if lens is None and len(mel_ref) > 1 and all(mel_ref_.shape[0] == 1 for mel_ref_ in mel_ref):
+            # 同一说话人的多段参考音频：pad 成一个 batch，按相对长度 mask，ECAPA 只 forward 一次
+            lengths = torch.tensor([mel_ref_.shape[1] for mel_ref_ in mel_ref], dtype=torch.float32, device=mel_ref[0].device)
+            mels = pad_sequence([mel_ref_.squeeze(0) for mel_ref_ in mel_ref], batch_first=True)  # (n, t, num_mels)
+            speaker_embedding = self.speaker_encoder(mels, lengths / lengths.max())
+            return speaker_embedding.mean(dim=0, keepdim=True)
+
         speaker_embedding = []
         for mel_ref_ in mel_ref:
             speaker_embedding_ = self.speaker_encoder(mel_ref_, lens)
             speaker_embedding.append(speaker_embedding_)
         speaker_embedding = torch.stack(speaker_embedding).sum(dim=0)
         speaker_embedding = speaker_embedding / len(mel_ref)
+        return speaker_embedding
+
+    def forward(self, x, mel_ref, lens=None):
+        speaker_embedding = self.get_speaker_embedding(mel_ref, lens)
         
         n_batch = x.size(0)
         contrastive_loss = None
@@ -213,8 +236,39 @@ class BigVGAN(torch.nn.Module):
             contrastive_loss = self.cal_clip_loss(spe_emb_chunk1.squeeze(1), spe_emb_chunk2.squeeze(1), self.logit_scale.exp())
 
             speaker_embedding = speaker_embedding[:n_batch, :, :]
+
+        x = self.decode(x, self.get_speaker_conditioning(speaker_embedding))
+        return x, contrastive_loss
+
+    def get_speaker_conditioning(self, speaker_embedding):
+        """Project the speaker embedding to the bias added before the first and after each upsampling layer.
+
+        Args:
+            speaker_embedding (Tensor): speaker embedding of shape (b, 1, speaker_embedding_dim).
+
+        Returns:
+            list[Tensor]: [cond_layer output, conds[0] output, ...], each of shape (b, channels, 1).
+        """
         speaker_embedding = speaker_embedding.transpose(1, 2)
+        speaker_conditioning = [self.cond_layer(speaker_embedding)]
+        if self.cond_in_each_up_layer:
+            for i in range(self.num_upsamples):
+                speaker_conditioning.append(self.conds[i](speaker_embedding))
+        return speaker_conditioning
 
+    def decode(self, x, speaker_conditioning, lengths=None):
+        """Generate waveform from gpt latent with precomputed speaker conditioning.
+
+        Args:
+            x (Tensor): gpt latent of shape (b, t, gpt_dim).
+            speaker_conditioning (list[Tensor]): output of get_speaker_conditioning.
+            lengths (None | list[int]): valid latent frames of each item when x is zero padded to a common length.
+                Frames past each length are re-zeroed between layers, so the bias and speaker conditioning added to
+                the padding do not leak into the shorter items.
+
+        Returns:
+            Tensor: waveform of shape (b, 1, t * hop_length).
+        """
         # upsample feat
         if self.feat_upsample:
             x = torch.nn.functional.interpolate(
@@ -225,19 +279,27 @@ class BigVGAN(torch.nn.Module):
         else:
             x = x.transpose(1, 2)
 
+        frames = None
+        if lengths is not None:
+            frames = torch.as_tensor(lengths, device=x.device) * (4 if self.feat_upsample else 1)
+
         ### bigVGAN ###
         # pre conv
         x = self.conv_pre(x)
 
-        x = x + self.cond_layer(speaker_embedding)
+        x = x + speaker_conditioning[0]
+        x = self._mask_padding(x, frames)
 
         for i in range(self.num_upsamples):
             # upsampling
             for i_up in range(len(self.ups[i])):
                 x = self.ups[i][i_up](x)
+                if frames is not None:
+                    frames = frames * self.ups[i][i_up].stride[0]
 
             if self.cond_in_each_up_layer:
-                x = x + self.conds[i](speaker_embedding)
+                x = x + speaker_conditioning[i + 1]
+            x = self._mask_padding(x, frames)
 
             # AMP blocks
             xs = None
@@ -246,14 +308,44 @@ class BigVGAN(torch.nn.Module):
                     xs = self.resblocks[i * self.num_kernels + j](x)
                 else:
                     xs += self.resblocks[i * self.num_kernels + j](x)
-            x = xs / self.num_kernels
+            x = self._mask_padding(xs / self.num_kernels, frames)
 
         # post conv
         x = self.activation_post(x)
         x = self.conv_post(x)
         x = torch.tanh(x)
 
-        return x, contrastive_loss
+        return x
+
+    @staticmethod
+    def _mask_padding(x, frames):
+        if frames is None:
+            return x
+        # 与单独 decode 时卷积看到的零 padding 一致
+        return x.masked_fill(torch.arange(x.shape[-1], device=x.device)[None, None, :] >= frames[:, None, None], 0)
+
+    def receptive_field(self):
+        """Latent frames on each side of a frame that can change its waveform.
+
+        Adds up conv_pre, the upsampling layers, the widest AMP block of every stage (anti-aliased activations
+        included) and conv_post, each converted to latent frames at the rate it runs at.
+        """
+        # anti-aliased 激活：2x 上采样与 2x 下采样（12 阶滤波）单侧各约 3 个采样点
+        act = 6
+        scale = 4 if self.feat_upsample else 1
+        frames = (1 if self.feat_upsample else 0) + self.conv_pre.padding[0] / scale
+        for i in range(self.num_upsamples):
+            for up in self.ups[i]:
+                frames += math.ceil(up.kernel_size[0] / up.stride[0]) / 2 / scale
+                scale *= up.stride[0]
+            block = 0
+            for j in range(self.num_kernels):
+                resblock = self.resblocks[i * self.num_kernels + j]
+                convs = [m for m in resblock.modules() if isinstance(m, Conv1d)]
+                block = max(block, sum(conv.padding[0] for conv in convs) + act * len(resblock.activations))
+            frames += block / scale
+        frames += (act + self.conv_post.padding[0]) / scale
+        return math.ceil(frames)
 
     def remove_weight_norm(self):
         print('Removing weight norm...')
@@ -30,6 +30,7 @@ from transformers import BatchFeature
 from vllm.attention import Attention, AttentionMetadata
 from vllm.compilation.decorators import support_torch_compile
 from vllm.config import CacheConfig, VllmConfig
+from vllm.forward_context import get_forward_context
 from vllm.distributed.parallel_state import (
     get_pp_group, get_tensor_model_parallel_world_size)
 from vllm.model_executor.layers.activation import get_act_fn
@@ -388,9 +389,17 @@ class GPT2TTSModel(nn.Module, SupportsPP, SupportsMultiModal):
         audio_embeds = kwargs.pop("image_embeds", None)
         if audio_embeds is not None:
             if not isinstance(audio_embeds, list):
-                audio_embeds = audio_embeds.squeeze(1).reshape(-1, audio_embeds.shape[-1])
+                seq_embeds = list(audio_embeds.reshape(audio_embeds.shape[0], -1, audio_embeds.shape[-1]))
             else:
-                audio_embeds = torch.cat(audio_embeds, dim=1).squeeze(0)
+                seq_embeds = [embeds.reshape(-1, embeds.shape[-1]) for embeds in audio_embeds]
+            if sum(embeds.shape[0] for embeds in seq_embeds) != input_ids.shape[0]:
+                # 命中 prefix cache（或 chunked prefill）时 vllm 只计算每个 prompt 中 [context_len, seq_len) 的部分
+                attn_metadata = get_forward_context().attn_metadata
+                context_lens = attn_metadata.context_lens_tensor[:len(seq_embeds)].tolist()
+                seq_lens = attn_metadata.seq_lens[:len(seq_embeds)]
+                seq_embeds = [embeds[context_len:seq_len]
+                              for embeds, context_len, seq_len in zip(seq_embeds, context_lens, seq_lens)]
+            audio_embeds = torch.cat(seq_embeds, dim=0)
             audio_embeds = audio_embeds.to(dtype=self.audio_emb.weight.dtype)
 
         if audio_embeds is not None:  # and audio_embeds.shape[0] == input_ids.shape[0]   prefill
@@ -1,7 +1,12 @@
 import uuid
 import os
+import math
+import random
+import hashlib
+import weakref
 import functools
 import patch_vllm  # ⚠️ Monkey Patch, do not delete this line
+from patch_vllm import HIDDEN_STATES_BUFFER
 
 import torch
 import torch.nn as nn
@@ -11,10 +16,13 @@ from transformers.modeling_outputs import CausalLMOutputWithCrossAttentions
 from transformers.utils.model_parallel_utils import (assert_device_map,
                                                      get_device_map)
 from transformers import GPT2Config, GPT2Model
+from torch.nn.utils.rnn import pad_sequence
 
 from indextts.gpt.conformer_encoder import ConformerEncoder
 from indextts.gpt.perceiver import PerceiverResampler
+from indextts.gpt.runaway_stop import RunawayStopLogitsProcessor
 from indextts.utils.arch_util import AttentionBlock
+from indextts.utils.metrics import INFLIGHT_SENTENCES, observe_stage
 from indextts.utils.typical_sampling import TypicalLogitsWarper
 
 from vllm import AsyncLLMEngine, SamplingParams, TokensPrompt
@@ -47,7 +55,7 @@ class UnifiedVoice(nn.Module):
                  mel_length_compression=1024, number_text_tokens=256,
                  start_text_token=0, stop_text_token=1, number_mel_codes=8194, start_mel_token=8192, stop_mel_token=8193,
                  types=1, activation_function=None,
-                 model_dir=None,
+                 model_dir=None, use_vllm_latent=True, max_tokens_ratio=10.0, max_tokens_margin=50, enable_prefix_caching=True,
                  condition_num_latent=32, condition_module=None, **kwargs):
         """
         Args:
@@ -65,6 +73,15 @@ class UnifiedVoice(nn.Module):
             start_mel_token:
             stop_mel_token:
             checkpointing:
+            use_vllm_latent: Take the latent for the vocoder from the hidden states collected during vLLM decoding
+                instead of running the HF GPT2Model forward again.
+            max_tokens_ratio: Per-sentence mel token budget per text token. The budget of a sentence is
+                ceil(max_tokens_ratio * text_tokens) + max_tokens_margin, capped by the sampling max_tokens.
+                0 disables the per-sentence budget. See tools/calibrate_max_tokens.py.
+            max_tokens_margin: Constant added to the per-sentence budget.
+            enable_prefix_caching: Enable vLLM automatic prefix caching. The prompt token ids are derived from the
+                conditioning latent and the text (see build_tokens_prompt), so requests of the same speaker reuse
+                the KV cache of the conditioning block instead of prefilling it again.
         """
         super().__init__()
         self.number_text_tokens = number_text_tokens
@@ -81,6 +98,7 @@ class UnifiedVoice(nn.Module):
         self.max_conditioning_inputs = max_conditioning_inputs
         self.mel_length_compression = mel_length_compression
         self.cond_num = condition_num_latent
+        self.use_vllm_latent = use_vllm_latent
         self.cond_mask_pad = nn.ConstantPad1d((self.cond_num, 0), True)
 
         self.conditioning_encoder = ConformerEncoder(input_size=100,
@@ -135,16 +153,54 @@ class UnifiedVoice(nn.Module):
             tensor_parallel_size=1,
             dtype="auto",
             gpu_memory_utilization=gpu_memory_utilization,
+            enable_prefix_caching=enable_prefix_caching,
             # enforce_eager=True,
         )
+        self.enable_prefix_caching = enable_prefix_caching
+        # id(speech_conditioning_latent) -> (digest, prompt token ids of the conditioning block)
+        self._speaker_prefixes = {}
         self.llm = AsyncLLMEngine.from_engine_args(engine_args)
-        self.sampling_params = SamplingParams(
+        # 长静音 / 循环时提前输出 stop_mel_token，阈值可按请求覆盖
+        self.runaway_stop = RunawayStopLogitsProcessor(self.stop_mel_token)
+        # 默认采样参数，单个请求通过 build_sampling_params 覆盖其中的字段，不修改共享的 self.sampling_params
+        self.default_sampling_kwargs = dict(
             temperature=1.0,
             top_p=0.8,
             top_k=30,  # 5, 30
             repetition_penalty=10.0,  # 8.0
             max_tokens=768,  # 605
+            logits_processors=[self.runaway_stop],
         )
+        self.sampling_params = SamplingParams(**self.default_sampling_kwargs)
+        self.max_tokens_ratio = max_tokens_ratio
+        self.max_tokens_margin = max_tokens_margin
+
+    def build_sampling_params(self, generation_config=None):
+        """按请求构造独立的 SamplingParams
+
+        Args:
+            generation_config (None | dict): per-request overrides of seed / temperature / top_p / top_k /
+                repetition_penalty / max_tokens, plus the RunawayStopLogitsProcessor thresholds max_silent_tokens /
+                max_loop_tokens. See indextts.utils.generation_config.
+
+        Returns:
+            SamplingParams: self.sampling_params if there is nothing to override, otherwise a new object.
+        """
+        if not generation_config:
+            return self.sampling_params
+        generation_config = dict(generation_config)
+        runaway_stop_kwargs = {key: generation_config.pop(key) for key in ["max_silent_tokens", "max_loop_tokens"]
+                               if key in generation_config}
+        sampling_kwargs = {**self.default_sampling_kwargs, **generation_config}
+        if runaway_stop_kwargs:
+            sampling_kwargs["logits_processors"] = [RunawayStopLogitsProcessor(self.stop_mel_token, **runaway_stop_kwargs)]
+        return SamplingParams(**sampling_kwargs)
+
+    def get_max_tokens(self, num_text_tokens, max_tokens):
+        """按文本 token 数估计本句 mel token 的上限，采样出错时短句不会一直解码到 max_tokens"""
+        if self.max_tokens_ratio <= 0:
+            return max_tokens
+        return min(max_tokens, math.ceil(self.max_tokens_ratio * num_text_tokens) + self.max_tokens_margin)
 
     def build_aligned_inputs_and_targets(self, input, start_token, stop_token):
         inp = F.pad(input, (1, 0), value=start_token)
@@ -158,36 +214,150 @@ class UnifiedVoice(nn.Module):
         conds = self.perceiver_encoder(speech_conditioning_input, conds_mask)  # (b, 32, d)
         return conds
 
-    async def inference_speech(self, speech_conditioning_latent, text_inputs, cond_mel_lengths=None):
+    def get_conditioning_from_clips(self, cond_mels):
+        """同一说话人的多段参考音频 mel pad 成一个 batch，一次 forward 后取平均
 
-        text_inputs = F.pad(text_inputs, (0, 1), value=self.stop_text_token)
-        text_inputs, _ = self.build_aligned_inputs_and_targets(text_inputs, self.start_text_token, self.stop_text_token)
-        text_emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs)
+        padding 部分由 cond_mel_lengths 在 ConformerEncoder / PerceiverResampler 中 mask 掉。
 
-        # speech_conditioning_latent = self.get_conditioning(speech_conditioning_latent, cond_mel_lengths)
-        emb = torch.cat([speech_conditioning_latent, text_emb], dim=1)
-        trunc_index = emb.shape[1] + 1
+        Args:
+            cond_mels (list[Tensor]): reference mels, each of shape (1, 100, t).
+
+        Returns:
+            Tensor: conditioning latent of shape (1, 32, d).
+        """
+        cond_mel_lengths = torch.tensor([cond_mel.shape[-1] for cond_mel in cond_mels], device=cond_mels[0].device)
+        cond_mels = pad_sequence([cond_mel.squeeze(0).transpose(0, 1) for cond_mel in cond_mels], batch_first=True)  # (n, t, 100)
+        conds = self.get_conditioning(cond_mels.transpose(1, 2), cond_mel_lengths)
+        return conds.mean(dim=0, keepdim=True)
+
+    def _speaker_prefix(self, speech_conditioning_latent):
+        """conditioning latent 的内容 hash 与其对应的 prompt token ids
 
-        mel_start_emb = self.mel_embedding(torch.full((emb.shape[0], 1,), fill_value=self.start_mel_token, dtype=torch.long, device=text_inputs.device))
-        mel_start_emb = mel_start_emb + self.mel_pos_embedding(mel_start_emb)
-        inputs_embeds = torch.cat([emb, mel_start_emb], dim=1)
+        token ids 为 0..31 的一个排列（0 固定在首位，作为多模态 placeholder），由 latent 内容决定。
+        同一个 tensor 对象只 hash 一次，tensor 被释放时自动移除。
+        """
+        key = id(speech_conditioning_latent)
+        prefix = self._speaker_prefixes.get(key)
+        if prefix is None:
+            data = speech_conditioning_latent.detach().float().cpu().numpy().tobytes()
+            digest = hashlib.blake2b(data, digest_size=16).digest()
+            token_ids = list(range(1, speech_conditioning_latent.shape[1]))
+            random.Random(digest).shuffle(token_ids)
+            prefix = (digest, [0] + token_ids)
+            self._speaker_prefixes[key] = prefix
+            weakref.finalize(speech_conditioning_latent, self._speaker_prefixes.pop, key, None)
+        return prefix
+
+    def build_tokens_prompt(self, speech_conditioning_latent, text_inputs):
+        """conditioning latent + text + mel start 的 embedding 作为 "image" 多模态数据传给 vllm
+
+        开启 prefix caching 时，vllm 按 prompt token ids 计算 block hash，因此 token ids 需要唯一对应 embedding：
+        conditioning 部分的 ids 由 latent 内容决定，text + mel start 部分的 ids 由 latent 与 text 共同决定，
+        同一角色的请求即可复用 conditioning block 的 KV cache。
+        所有 ids 仍是 0..n-1 的排列，与原先的 range(n) 集合相同，repetition_penalty 对 prompt token 的作用不变。
+        """
+        with torch.no_grad():
+            text_inputs = F.pad(text_inputs, (0, 1), value=self.stop_text_token)
+            text_inputs, _ = self.build_aligned_inputs_and_targets(text_inputs, self.start_text_token, self.stop_text_token)
+            text_emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs)
 
-        fake_inputs = [idx for idx in range(inputs_embeds.shape[1])]
+            # speech_conditioning_latent = self.get_conditioning(speech_conditioning_latent, cond_mel_lengths)
+            emb = torch.cat([speech_conditioning_latent, text_emb], dim=1)
+            trunc_index = emb.shape[1] + 1
+
+            mel_start_emb = self.mel_embedding(torch.full((emb.shape[0], 1,), fill_value=self.start_mel_token, dtype=torch.long, device=text_inputs.device))
+            mel_start_emb = mel_start_emb + self.mel_pos_embedding(mel_start_emb)
+            inputs_embeds = torch.cat([emb, mel_start_emb], dim=1)
+
+        if self.enable_prefix_caching:
+            digest, fake_inputs = self._speaker_prefix(speech_conditioning_latent)
+            text_token_ids = list(range(len(fake_inputs), inputs_embeds.shape[1]))
+            random.Random(digest + text_inputs.cpu().numpy().tobytes()).shuffle(text_token_ids)
+            fake_inputs = fake_inputs + text_token_ids
+        else:
+            fake_inputs = [idx for idx in range(inputs_embeds.shape[1])]
         multi_modal_data = {"image": inputs_embeds}
-        tokens_prompt = TokensPrompt(prompt_token_ids=fake_inputs, multi_modal_data=multi_modal_data)
-        output_generator = self.llm.generate(tokens_prompt, sampling_params=self.sampling_params, request_id=uuid.uuid4())
-        # latent = []
-        async for output in output_generator:
-            # latent.append(output.hidden_states.clone())
+        return TokensPrompt(prompt_token_ids=fake_inputs, multi_modal_data=multi_modal_data)
+
+    async def inference_speech_stream(self, speech_conditioning_latent, text_inputs, request_context=None, sampling_params=None):
+        """边生成边返回，vllm 每输出一步就 yield 一次 (codes, hidden_states, finished)
+
+        codes 为目前已确定的 mel codes（与 inference_speech 一致，去掉最后 2 个 token，生成过程中即为尚未确定的尾部），
+        hidden_states 为逐 token 的 latent 列表（每项 (dim,)，只读），hidden_states[i] 对应 codes[i]；
+        use_vllm_latent=False 时为 None。
+
+        Args:
+            request_context (None | RequestContext): HTTP request this sentence belongs to. The vllm request_id is
+                registered on it while generating, so the whole HTTP request can be aborted on disconnect / deadline.
+            sampling_params (None | SamplingParams): per-request sampling params from build_sampling_params.
+                None uses the shared defaults.
+        """
+        if request_context is not None:
+            request_context.check()
+
+        sampling_params = sampling_params or self.sampling_params
+        max_tokens = self.get_max_tokens(text_inputs.shape[-1], sampling_params.max_tokens)
+        if max_tokens != sampling_params.max_tokens:
+            sampling_params = sampling_params.clone()
+            sampling_params.max_tokens = max_tokens
+
+        tokens_prompt = self.build_tokens_prompt(speech_conditioning_latent, text_inputs)
+        request_id = str(uuid.uuid4())
+        if self.use_vllm_latent:
+            HIDDEN_STATES_BUFFER[request_id] = []
+        if request_context is not None:
+            request_context.request_ids.add(request_id)
+        INFLIGHT_SENTENCES.inc()
+        try:
+            output_generator = self.llm.generate(tokens_prompt, sampling_params=sampling_params, request_id=request_id)
+            async for output in output_generator:
+                if output.finished:
+                    self._observe_request_metrics(output.metrics)
+                    if output.outputs[0].finish_reason == "length":
+                        print(f">> sentence stopped at max_tokens={max_tokens} ({text_inputs.shape[-1]} text tokens)")
+                codes = output.outputs[0].token_ids[:-2]
+                yield codes, HIDDEN_STATES_BUFFER.get(request_id), output.finished
+        finally:
+            INFLIGHT_SENTENCES.dec()
+            HIDDEN_STATES_BUFFER.pop(request_id, None)
+            if request_context is not None:
+                request_context.request_ids.discard(request_id)
+
+    @staticmethod
+    def _observe_request_metrics(metrics):
+        """vllm 记录的排队时间与调度后到结束的解码时间"""
+        if metrics is None:
+            return
+        if metrics.time_in_queue is not None:
+            observe_stage("queue_wait", metrics.time_in_queue)
+        if metrics.first_scheduled_time is not None and metrics.finished_time is not None:
+            observe_stage("decode", metrics.finished_time - metrics.first_scheduled_time)
+
+    async def inference_speech(self, speech_conditioning_latent, text_inputs, cond_mel_lengths=None, request_context=None,
+                               sampling_params=None):
+        """
+        Args:
+            request_context (None | RequestContext): see inference_speech_stream.
+            sampling_params (None | SamplingParams): see inference_speech_stream.
+
+        Returns:
+            (codes, latent): latent is (1, len(codes), dim), or None if use_vllm_latent=False.
+        """
+        codes, hidden_states = [], None
+        async for codes, hidden_states, _ in self.inference_speech_stream(speech_conditioning_latent, text_inputs,
+                                                                          request_context=request_context,
+                                                                          sampling_params=sampling_params):
             pass
-        codes = output.outputs[0].token_ids[:-2]
 
-        # latent = torch.cat(latent[:-2], dim=0).unsqueeze(0)
-        # # latent = self.final_norm(latent.float())
-        # latent = latent.float()
-        # print("codes", len(codes), codes)
-        # print("latent", latent.shape, latent)
-        return codes, None  # , latent
+        latent = None
+        if self.use_vllm_latent:
+            # 第 i 个 hidden_state 是预测第 i 个 token 时的输出（已过 final_norm），
+            # 与 forward(return_latent=True) 得到的 latent 逐位置对应
+            if hidden_states is None or len(hidden_states) < len(codes):
+                raise RuntimeError("vllm did not return hidden_states for the request, "
+                                   "check that patch_vllm is imported before the engine is created")
+            latent = torch.stack(hidden_states[:len(codes)], dim=0).unsqueeze(0).float()
+        return codes, latent
 
     def set_mel_padding(self, mel_input_tokens, mel_lengths):
         """
@@ -238,6 +408,8 @@ class UnifiedVoice(nn.Module):
         mel_emb = mel_emb + self.mel_pos_embedding(mel_codes)
 
         emb = torch.cat([conds, text_emb, mel_emb], dim=1)
+        if self.gpt is None:
+            raise RuntimeError("HF GPT2Model has been released (use_vllm_latent=True), take the latent from inference_speech instead")
         gpt_out = self.gpt(inputs_embeds=emb, return_dict=True)
         offset = conds.shape[1]
         enc = gpt_out.last_hidden_state[:, offset:]
@@ -0,0 +1,65 @@
+from typing import List
+
+import torch
+
+
+class RunawayStopLogitsProcessor:
+    """vllm 的 logits processor：生成陷入长静音或循环时强制输出 stop_mel_token
+
+    静音 token（52）连续出现、或最近的 mel codes 以固定周期重复，是 gpt 采样失败的常见表现，
+    这类句子往往一直解码到 max_tokens。这里在每一步检查已生成的 codes，命中时把 logits 改为只允许 stop_mel_token，
+    提前结束生成，省下后续的解码步数与 bigvgan 时间。
+
+    只依赖传入的 token_ids，不保存状态，同一个实例可以被所有请求共享。
+    """
+
+    def __init__(self, stop_token: int, silent_token=52, max_silent_tokens=30, max_loop_tokens=40, max_loop_period=8,
+                 min_loop_repeats=4):
+        """
+        Args:
+            stop_token (int): stop_mel_token forced when a runaway is detected.
+            silent_token (int): mel code of silence.
+            max_silent_tokens (int): stop after this many consecutive silent tokens. 0 disables the check.
+            max_loop_tokens (int): stop when the last max_loop_tokens codes (at least min_loop_repeats periods)
+                repeat with a period of up to max_loop_period codes. 0 disables the check.
+            max_loop_period (int): longest n-gram considered as a loop.
+            min_loop_repeats (int): minimum number of repeats of the n-gram.
+        """
+        self.stop_token = stop_token
+        self.silent_token = silent_token
+        self.max_silent_tokens = max_silent_tokens
+        self.max_loop_tokens = max_loop_tokens
+        self.max_loop_period = max_loop_period
+        self.min_loop_repeats = min_loop_repeats
+
+    def is_runaway(self, token_ids: List[int]) -> bool:
+        num_tokens = len(token_ids)
+        if num_tokens == 0:
+            return False
+        last = token_ids[-1]
+
+        if self.max_silent_tokens > 0 and last == self.silent_token and num_tokens >= self.max_silent_tokens:
+            run = 0
+            for token in reversed(token_ids):
+                if token != self.silent_token:
+                    break
+                run += 1
+                if run >= self.max_silent_tokens:
+                    return True
+
+        if self.max_loop_tokens > 0:
+            for period in range(1, self.max_loop_period + 1):
+                span = max(self.max_loop_tokens, period * self.min_loop_repeats)
+                # 先比较最后一个 token，绝大多数周期在这里就被排除
+                if span > num_tokens or token_ids[-1 - period] != last:
+                    continue
+                if all(token_ids[i] == token_ids[i - period] for i in range(num_tokens - span + period, num_tokens)):
+                    return True
+        return False
+
+    def __call__(self, token_ids: List[int], logits: torch.Tensor) -> torch.Tensor:
+        if not self.is_runaway(token_ids):
+            return logits
+        forced = torch.full_like(logits, float("-inf"))
+        forced[self.stop_token] = 0.0
+        return forced
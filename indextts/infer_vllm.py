@@ -1,8 +1,12 @@
+import asyncio
+import hashlib
+import json
 import os
 import re
 import time
 from subprocess import CalledProcessError
 import traceback
+from collections import deque
 from typing import List
 
 import numpy as np
@@ -21,9 +25,15 @@ warnings.filterwarnings("ignore", category=UserWarning)
 from indextts.BigVGAN.models import BigVGAN as Generator
 from indextts.gpt.model_vllm import UnifiedVoice
 from indextts.utils.checkpoint import load_checkpoint
-from indextts.utils.feature_extractors import MelSpectrogramFeatures
+from indextts.utils.conditioning_cache import ConditioningCache, hash_audio_files
+from indextts.utils.executors import InferenceExecutors
+from indextts.utils.audio_frontend import AudioFrontend
 
 from indextts.utils.front import TextNormalizer, TextTokenizer
+from indextts.utils.long_form import LongFormWriter
+from indextts.utils.metrics import AUDIO_SECONDS, RTF, stage_timer, track_inflight_request
+from indextts.utils.speaker_store import LazySpeaker, SpeakerStore
+from indextts.utils.vocoder_batcher import VocoderBatcher
 
 import matplotlib.pyplot as plt
 
@@ -66,6 +76,9 @@ def trim_and_pad_silence(wav_data, threshold=1000, min_silence=int(24000*0.4)):
 class IndexTTS:
     def __init__(
         self, cfg_path="checkpoints/config.yaml", model_dir="checkpoints", gpu_memory_utilization=0.25, is_fp16=True, device=None, use_cuda_kernel=None,
+        use_vllm_latent=True, vocoder_max_batch_size=8, vocoder_batch_wait_ms=5.0, speaker_cache_dir=None,
+        conditioning_cache_size=64, conditioning_cache_mb=512, max_tokens_ratio=10.0, max_tokens_margin=50,
+        enable_prefix_caching=True,
     ):
         """
         Args:
@@ -74,6 +87,18 @@ class IndexTTS:
             is_fp16 (bool): whether to use fp16.
             device (str): device to use (e.g., 'cuda:0', 'cpu'). If None, it will be set automatically based on the availability of CUDA or MPS.
             use_cuda_kernel (None | bool): whether to use BigVGan custom fused activation CUDA kernel, only for CUDA device.
+            use_vllm_latent (bool): whether to take the BigVGAN latent from the vLLM hidden states. If True, the
+                HF GPT2Model is not kept on the device and the second GPT forward pass per sentence is skipped.
+            vocoder_max_batch_size (int): maximum number of sentences (across requests) vocoded in one BigVGAN forward.
+            vocoder_batch_wait_ms (float): how long the vocoder batcher waits to fill a batch.
+            speaker_cache_dir (None | str): directory to persist registered speaker features in. If None, speakers
+                are re-encoded on every start.
+            conditioning_cache_size (int): maximum number of reference audio features kept in the in-memory LRU
+                used by infer / stream_infer. 0 disables the cache.
+            conditioning_cache_mb (float): maximum size in MB of the tensors kept in that LRU.
+            max_tokens_ratio (float): per-sentence mel token budget per text token, 0 disables it.
+            max_tokens_margin (int): constant added to the per-sentence mel token budget.
+            enable_prefix_caching (bool): let vllm reuse the KV cache of the speaker conditioning block across requests.
         """
         if device is not None:
             self.device = device
@@ -98,9 +123,14 @@ class IndexTTS:
         self.dtype = torch.float16 if self.is_fp16 else None
         self.stop_mel_token = self.cfg.gpt.stop_mel_token
 
-        self.gpt = UnifiedVoice(gpu_memory_utilization, **self.cfg.gpt, model_dir=model_dir)
+        self.gpt = UnifiedVoice(gpu_memory_utilization, **self.cfg.gpt, model_dir=model_dir, use_vllm_latent=use_vllm_latent,
+                                max_tokens_ratio=max_tokens_ratio, max_tokens_margin=max_tokens_margin,
+                                enable_prefix_caching=enable_prefix_caching)
         self.gpt_path = os.path.join(self.model_dir, self.cfg.gpt_checkpoint)
         load_checkpoint(self.gpt, self.gpt_path)
+        if use_vllm_latent:
+            # latent 直接取自 vllm 的 hidden_states，HF 的 GPT2Model 不再需要，避免重复占用显存
+            self.gpt.gpt = None
         self.gpt = self.gpt.to(self.device)
         # if self.is_fp16:
         #     self.gpt.eval().half()
@@ -129,14 +159,25 @@ class IndexTTS:
         self.bigvgan.remove_weight_norm()
         self.bigvgan.eval()
         print(">> bigvgan weights restored from:", self.bigvgan_path)
+        # 阻塞的音频 IO / conditioning / bigvgan 计算放到专用线程池中，事件循环只做调度和网络收发
+        self.executors = InferenceExecutors()
+        self.vocoder = VocoderBatcher(self.bigvgan, max_batch_size=vocoder_max_batch_size, batch_wait_ms=vocoder_batch_wait_ms,
+                                      executor=self.executors.vocoder)
+        self.audio_frontend = AudioFrontend(self.device)
         self.bpe_path = os.path.join(self.model_dir, "bpe.model")  # self.cfg.dataset["bpe_model"]
         self.normalizer = TextNormalizer()
         self.normalizer.load()
         print(">> TextNormalizer loaded")
-        self.tokenizer = TextTokenizer(self.bpe_path, self.normalizer)
+        # normalize / tokenize 的耗时计入 /metrics 的 stage 直方图
+        self.tokenizer = TextTokenizer(self.bpe_path, self.normalizer, stage_timer=stage_timer)
         print(">> bpe model loaded from:", self.bpe_path)
 
         self.speaker_dict = {}
+        self.speaker_store = None
+        if speaker_cache_dir:
+            self.speaker_store = SpeakerStore(speaker_cache_dir, [self.gpt_path, self.bigvgan_path])
+            print(">> speaker cache dir:", speaker_cache_dir)
+        self.conditioning_cache = ConditioningCache(max_entries=conditioning_cache_size, max_bytes=int(conditioning_cache_mb * 1024 * 1024))
     
     def remove_long_silence(self, codes: list, latent: torch.Tensor, max_consecutive=15, silent_token=52):
         assert latent.dim() == 3 and latent.size(0) == 1, "Latent should be (1, seq_len, dim)"
@@ -171,20 +212,132 @@ class IndexTTS:
         # print("filtered_latent", filtered_latent.shape)
         return filtered_latent
 
-    async def infer(self, audio_prompt: List[str], text, output_path=None, verbose=False, seed=None):
+    @torch.no_grad()
+    def get_latent(self, codes, speech_conditioning_latent, text_tokens):
+        """用 HF GPT2Model 重新 forward 一遍得到 latent，仅在 use_vllm_latent=False 时使用"""
+        codes = torch.tensor(codes, dtype=torch.long, device=self.device).unsqueeze(0)
+        code_lens = torch.tensor([codes.shape[-1]], device=codes.device, dtype=codes.dtype)
+        latent = self.gpt(speech_conditioning_latent, text_tokens,
+                        torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), codes,
+                        code_lens*self.gpt.mel_length_compression,
+                        cond_mel_lengths=torch.tensor([speech_conditioning_latent.shape[-1]], device=text_tokens.device),
+                        return_latent=True, clip_inputs=False)
+        return latent
+
+    @torch.no_grad()
+    def get_speaker_conditioning(self, auto_conditioning):
+        """参考音频 mel -> bigvgan 的说话人向量，以及其经 cond_layer/conds 投影后的 bias
+
+        Returns:
+            (speaker_embedding, speaker_conditioning)
+        """
+        speaker_embedding = self.bigvgan.get_speaker_embedding([ap_.transpose(1, 2) for ap_ in auto_conditioning])
+        speaker_conditioning = self.bigvgan.get_speaker_conditioning(speaker_embedding)
+        return speaker_embedding, speaker_conditioning
+
+    @torch.no_grad()
+    def compute_conditioning(self, audio_paths: List[str]):
+        """参考音频 -> mel、gpt conditioning latent（多段 batch 编码后取平均）、bigvgan 说话人向量
+
+        Returns:
+            dict: same layout as the entries of self.speaker_dict.
+        """
+        # 解码后在 device 上重采样并批量计算 mel
+        auto_conditioning = self.audio_frontend.compute_mels(audio_paths)
+
+        # 多段参考音频在一个 batch 中编码后取平均
+        speech_conditioning_latent = self.gpt.get_conditioning_from_clips(auto_conditioning)
+
+        speaker_embedding, speaker_conditioning = self.get_speaker_conditioning(auto_conditioning)
+        return {
+            "auto_conditioning": auto_conditioning,
+            "speech_conditioning_latent": speech_conditioning_latent,
+            "speaker_embedding": speaker_embedding,
+            "speaker_conditioning": speaker_conditioning,
+        }
+
+    async def get_conditioning_features(self, audio_paths: List[str]):
+        """compute_conditioning 的缓存版本，按参考音频内容 hash 查 self.conditioning_cache
+
+        hash 与特征计算都在线程池中执行，缓存本身只在事件循环线程中读写。
+        """
+        with stage_timer("conditioning"):
+            key = await self.executors.run_audio_io(hash_audio_files, audio_paths)
+            conditioning = self.conditioning_cache.get(key)
+            if conditioning is None:
+                conditioning = await self.executors.run_conditioning(self.compute_conditioning, audio_paths)
+                self.conditioning_cache.put(key, conditioning)
+        return conditioning
+
+    async def _infer_sentence(self, sent, speech_conditioning_latent, speaker_conditioning, request_context=None, sampling_params=None):
+        """单句推理：gpt 生成 codes -> 计算 latent -> bigvgan 生成波形
+
+        Returns:
+            (wav, gpt_gen_time, bigvgan_time)
+        """
+        text_tokens = self.tokenizer.convert_tokens_to_ids(sent)
+        text_tokens = torch.tensor(text_tokens, dtype=torch.int32, device=self.device).unsqueeze(0)
+
+        m_start_time = time.perf_counter()
+        codes, latent = await self.gpt.inference_speech(
+            speech_conditioning_latent,
+            text_tokens,
+            # cond_mel_lengths=torch.tensor([auto_conditioning.shape[-1]], device=text_tokens.device)
+            request_context=request_context,
+            sampling_params=sampling_params,
+        )
+        gpt_gen_time = time.perf_counter() - m_start_time
+
+        # # remove ultra-long silence if exits
+        # # temporarily fix the long silence bug.
+        # latent = self.remove_long_silence(codes, latent)
+
+        # 请求已取消 / 超时则不再做 bigvgan
+        if request_context is not None:
+            request_context.check()
+
+        if latent is None:
+            with stage_timer("latent"):
+                latent = await self.executors.run_vocoder(self.get_latent, codes, speech_conditioning_latent, text_tokens)
+
+        m_start_time = time.perf_counter()
+        with stage_timer("vocoder"):
+            wav = await self.vocoder.vocode(latent, speaker_conditioning)  # 已在 vocoder 线程中拷回 cpu
+        bigvgan_time = time.perf_counter() - m_start_time
+        AUDIO_SECONDS.inc(wav.shape[-1] / 24000)
+        wav = wav.squeeze(1)
+        wav = torch.clamp(32767 * wav, -32767.0, 32767.0)
+        return wav, gpt_gen_time, bigvgan_time
+
+    async def _infer_sentences(self, sentences, speech_conditioning_latent, speaker_conditioning, concurrent=True, request_context=None, sampling_params=None):
+        """推理所有分句，返回按原句子顺序排列的 [(wav, gpt_gen_time, bigvgan_time), ...]
+
+        concurrent=True 时所有分句同时提交给 vllm 引擎，由引擎合并成 batch 解码，
+        整体耗时约等于最长的一句，而不是所有句子耗时之和。
+        """
+        if concurrent:
+            return await asyncio.gather(*[
+                self._infer_sentence(sent, speech_conditioning_latent, speaker_conditioning, request_context=request_context, sampling_params=sampling_params)
+                for sent in sentences
+            ])
+        results = []
+        for sent in sentences:
+            results.append(await self._infer_sentence(sent, speech_conditioning_latent, speaker_conditioning, request_context=request_context, sampling_params=sampling_params))
+        return results
+
+    @track_inflight_request
+    async def infer(self, audio_prompt: List[str], text, output_path=None, verbose=False, seed=None, concurrent=True, request_context=None,
+                    generation_config=None):
         print(">> start inference...")
+        # 每个请求使用独立的 SamplingParams，并发请求之间不会互相覆盖 seed 等采样参数
+        if seed is not None:
+            generation_config = {**(generation_config or {}), "seed": int(seed)}
+        sampling_params = self.gpt.build_sampling_params(generation_config)
         start_time = time.perf_counter()
 
-        auto_conditioning = []
-        for ap_ in audio_prompt:
-            audio, sr = torchaudio.load(ap_)
-            audio = torch.mean(audio, dim=0, keepdim=True)
-            if audio.shape[0] > 1:
-                audio = audio[0].unsqueeze(0)
-            audio = torchaudio.transforms.Resample(sr, 24000)(audio)
-            cond_mel = MelSpectrogramFeatures()(audio).to(self.device)
-            # cond_mel_frame = cond_mel.shape[-1]
-            auto_conditioning.append(cond_mel)
+        conditioning = await self.get_conditioning_features(audio_prompt)
+        speech_conditioning_latent = conditioning["speech_conditioning_latent"]
+        speaker_conditioning = conditioning["speaker_conditioning"]
 
         text_tokens_list = self.tokenizer.tokenize(text)
         sentences = self.tokenizer.split_sentences(text_tokens_list)
@@ -195,55 +348,15 @@ class IndexTTS:
         gpt_gen_time = 0
         bigvgan_time = 0
 
-        speech_conditioning_latent = []
-        for cond_mel in auto_conditioning:
-            speech_conditioning_latent_ = self.gpt.get_conditioning(
-                cond_mel,  # .half()
-                torch.tensor([cond_mel.shape[-1]], device=self.device)
-            )
-            speech_conditioning_latent.append(speech_conditioning_latent_)
-        speech_conditioning_latent = torch.stack(speech_conditioning_latent).sum(dim=0)
-        speech_conditioning_latent = speech_conditioning_latent / len(auto_conditioning)
 
-        for sent in sentences:
-            text_tokens = self.tokenizer.convert_tokens_to_ids(sent)
-            text_tokens = torch.tensor(text_tokens, dtype=torch.int32, device=self.device).unsqueeze(0)
-
-            m_start_time = time.perf_counter()
-            with torch.no_grad():
-                # 设置采样参数的seed
-                if seed is not None:
-                    self.gpt.sampling_params.seed = int(seed)
-                else:
-                    self.gpt.sampling_params.seed = None
-                codes, latent = await self.gpt.inference_speech(
-                    speech_conditioning_latent,
-                    text_tokens,
-                    # cond_mel_lengths=torch.tensor([auto_conditioning.shape[-1]], device=text_tokens.device)
-                )
-                gpt_gen_time += time.perf_counter() - m_start_time
-
-                # # remove ultra-long silence if exits
-                # # temporarily fix the long silence bug.
-                # latent = self.remove_long_silence(codes, latent)
-
-                codes = torch.tensor(codes, dtype=torch.long, device=self.device).unsqueeze(0)
-                code_lens = torch.tensor([codes.shape[-1]], device=codes.device, dtype=codes.dtype)
-                latent = self.gpt(speech_conditioning_latent, text_tokens,
-                                torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), codes,
-                                code_lens*self.gpt.mel_length_compression,
-                                cond_mel_lengths=torch.tensor([speech_conditioning_latent.shape[-1]], device=text_tokens.device),
-                                return_latent=True, clip_inputs=False)
-
-                m_start_time = time.perf_counter()
-                wav, _ = self.bigvgan(latent, [ap_.transpose(1, 2) for ap_ in auto_conditioning])
-                bigvgan_time += time.perf_counter() - m_start_time
-                wav = wav.squeeze(1)
-
-                wav = torch.clamp(32767 * wav, -32767.0, 32767.0)
-                print(f"wav shape: {wav.shape}", "min:", wav.min(), "max:", wav.max())
-                # wavs.append(wav[:, :-512])
-                wavs.append(wav.cpu())  # to cpu before saving
+        results = await self._infer_sentences(sentences, speech_conditioning_latent, speaker_conditioning, concurrent=concurrent,
+                                              request_context=request_context, sampling_params=sampling_params)
+        for wav, gpt_gen_time_, bigvgan_time_ in results:
+            gpt_gen_time += gpt_gen_time_
+            bigvgan_time += bigvgan_time_
+            print(f"wav shape: {wav.shape}", "min:", wav.min(), "max:", wav.max())
+            # wavs.append(wav[:, :-512])
+            wavs.append(wav.cpu())  # to cpu before saving
         torch.cuda.empty_cache()
         end_time = time.perf_counter()
 
@@ -254,6 +367,7 @@ class IndexTTS:
         print(f">> Total inference time: {end_time - start_time:.2f} seconds")
         print(f">> Generated audio length: {wav_length:.2f} seconds")
         print(f">> RTF: {(end_time - start_time) / wav_length:.4f}")
+        RTF.observe((end_time - start_time) / wav_length)
 
         # save audio
         wav = wav.cpu()  # to cpu
@@ -264,7 +378,7 @@ class IndexTTS:
                 print(">> remove old wav file:", output_path)
             if os.path.dirname(output_path) != "":
                 os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            torchaudio.save(output_path, wav.type(torch.int16), sampling_rate)
+            await self.executors.run_audio_io(torchaudio.save, output_path, wav.type(torch.int16), sampling_rate)
             print(">> wav file saved to:", output_path)
             return output_path
         else:
@@ -274,7 +388,9 @@ class IndexTTS:
             wav_data = trim_and_pad_silence(wav_data)
             return (sampling_rate, wav_data)
         
-    async def infer_with_ref_audio_embed(self, speaker: str, text):
+    @track_inflight_request
+    async def infer_with_ref_audio_embed(self, speaker: str, text, concurrent=True, request_context=None, generation_config=None):
+        sampling_params = self.gpt.build_sampling_params(generation_config)
         start_time = time.perf_counter()
         text = text.replace("嗯", "EN4")
         text = text.replace("嘿", "HEI1")
@@ -282,7 +398,8 @@ class IndexTTS:
         text = text.replace("哈哈", "HA1HA1")
         sampling_rate = 24000
 
-        auto_conditioning = self.speaker_dict[speaker]["auto_conditioning"]
+        speaker_info = await self.get_speaker(speaker)
+        auto_conditioning = speaker_info["auto_conditioning"]
 
         text_tokens_list = self.tokenizer.tokenize(text)
         sentences = self.tokenizer.split_sentences(text_tokens_list)
@@ -290,45 +407,21 @@ class IndexTTS:
         gpt_gen_time = 0
         bigvgan_time = 0
 
-        speech_conditioning_latent = self.speaker_dict[speaker]["speech_conditioning_latent"]
+        speech_conditioning_latent = speaker_info["speech_conditioning_latent"]
+        speaker_conditioning = speaker_info["speaker_conditioning"]
 
-        for sent in sentences:
-            text_tokens = self.tokenizer.convert_tokens_to_ids(sent)
-            text_tokens = torch.tensor(text_tokens, dtype=torch.int32, device=self.device).unsqueeze(0)
-
-            m_start_time = time.perf_counter()
-            with torch.no_grad():
-                codes, latent = await self.gpt.inference_speech(
-                    speech_conditioning_latent,
-                    text_tokens,
-                    # cond_mel_lengths=torch.tensor([auto_conditioning.shape[-1]], device=text_tokens.device)
-                )
-                gpt_gen_time += time.perf_counter() - m_start_time
-
-                # # remove ultra-long silence if exits
-                # # temporarily fix the long silence bug.
-                # latent = self.remove_long_silence(codes, latent)
-
-                codes = torch.tensor(codes, dtype=torch.long, device=self.device).unsqueeze(0)
-                code_lens = torch.tensor([codes.shape[-1]], device=codes.device, dtype=codes.dtype)
-                latent = self.gpt(speech_conditioning_latent, text_tokens,
-                                torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), codes,
-                                code_lens*self.gpt.mel_length_compression,
-                                cond_mel_lengths=torch.tensor([speech_conditioning_latent.shape[-1]], device=text_tokens.device),
-                                return_latent=True, clip_inputs=False)
-
-                m_start_time = time.perf_counter()
-                wav, _ = self.bigvgan(latent, [ap_.transpose(1, 2) for ap_ in auto_conditioning])
-                bigvgan_time += time.perf_counter() - m_start_time
-                wav = wav.squeeze(1)
-
-                wav = torch.clamp(32767 * wav, -32767.0, 32767.0)
-                # wavs.append(wav[:, :-512])
-                wavs.append(wav)  # to cpu before saving
+        results = await self._infer_sentences(sentences, speech_conditioning_latent, speaker_conditioning, concurrent=concurrent,
+                                              request_context=request_context, sampling_params=sampling_params)
+        for wav, gpt_gen_time_, bigvgan_time_ in results:
+            gpt_gen_time += gpt_gen_time_
+            bigvgan_time += bigvgan_time_
+            # wavs.append(wav[:, :-512])
+            wavs.append(wav)  # to cpu before saving
         torch.cuda.empty_cache()
         end_time = time.perf_counter()
 
         wav = torch.cat(wavs, dim=1)
+        RTF.observe((end_time - start_time) / (wav.shape[-1] / sampling_rate))
         # wav_length = wav.shape[-1] / sampling_rate
         # # print(f">> Total inference time: {end_time - start_time:.2f} seconds")
         # print(f">> gpt_gen_time: {gpt_gen_time:.2f} seconds")
@@ -343,32 +436,147 @@ class IndexTTS:
         wav_data = wav_data.numpy().T
         wav_data = trim_and_pad_silence(wav_data)
         return (sampling_rate, wav_data)
-    
+
+    @track_inflight_request
+    async def stream_infer_with_ref_audio_embed(self, speaker: str, text, request_context=None, generation_config=None):
+        """与 infer_with_ref_audio_embed 相同，但按句子顺序逐句 yield (sampling_rate, wav_data)
+
+        所有分句同时提交给 vllm 引擎，某句完成且之前的句子都已输出时立即 yield，
+        调用方可以边生成边编码、发送。提前退出时取消尚未完成的句子。
+        """
+        sampling_params = self.gpt.build_sampling_params(generation_config)
+        start_time = time.perf_counter()
+        text = text.replace("嗯", "EN4")
+        text = text.replace("嘿", "HEI1")
+        text = text.replace("嗨", "HAI4")
+        text = text.replace("哈哈", "HA1HA1")
+        sampling_rate = 24000
+
+        text_tokens_list = self.tokenizer.tokenize(text)
+        sentences = self.tokenizer.split_sentences(text_tokens_list)
+        speaker_info = await self.get_speaker(speaker)
+        speech_conditioning_latent = speaker_info["speech_conditioning_latent"]
+        speaker_conditioning = speaker_info["speaker_conditioning"]
+
+        tasks = [
+            asyncio.ensure_future(self._infer_sentence(sent, speech_conditioning_latent, speaker_conditioning,
+                                                       request_context=request_context, sampling_params=sampling_params))
+            for sent in sentences
+        ]
+        audio_length = 0
+        try:
+            for task in tasks:
+                wav, _, _ = await task
+                audio_length += wav.shape[-1]
+                wav_data = wav.cpu().type(torch.int16).numpy().T
+                yield sampling_rate, trim_and_pad_silence(wav_data)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if audio_length:
+            RTF.observe((time.perf_counter() - start_time) / (audio_length / sampling_rate))
+
+    @track_inflight_request
+    async def infer_long_form(self, text, output_path, speaker=None, audio_prompt: List[str] = None, window=16,
+                              generation_config=None, request_context=None, verbose=True):
+        """长文本（有声书章节）合成：分句并行推理，按句子顺序边完成边写入 output_path（.wav / .flac）
+
+        同时在推理或等待写出的句子不超过 window 句，内存占用与全文长度无关；每写完一句记录 checkpoint，
+        中断后以相同参数重新调用会从第一句未写出的句子继续，见 LongFormWriter。
+
+        Args:
+            text (str): full text, paragraphs separated by newlines.
+            output_path (str): .wav or .flac file to write.
+            speaker (None | str): registered speaker name, see registry_speaker.
+            audio_prompt (None | list[str]): reference audio paths, used when speaker is None.
+            window (int): reorder window, the maximum number of sentences decoded ahead of the next one to write.
+            generation_config (None | dict): sampling overrides, see UnifiedVoice.build_sampling_params. Pass a seed
+                to get the same audio for the sentences that are re-synthesized after a resume.
+            request_context (None | RequestContext): cancels the remaining sentences.
+
+        Returns:
+            str: output_path.
+        """
+        sampling_params = self.gpt.build_sampling_params(generation_config)
+        sampling_rate = 24000
+        start_time = time.perf_counter()
+        if speaker is not None:
+            speaker_info = await self.get_speaker(speaker)
+            speech_conditioning_latent = speaker_info["speech_conditioning_latent"]
+            speaker_conditioning = speaker_info["speaker_conditioning"]
+            voice_key = f"speaker:{speaker}"
+        else:
+            conditioning = await self.get_conditioning_features(audio_prompt)
+            speech_conditioning_latent = conditioning["speech_conditioning_latent"]
+            speaker_conditioning = conditioning["speaker_conditioning"]
+            voice_key = await self.executors.run_audio_io(hash_audio_files, audio_prompt)
+
+        # 按段落分别 normalize / 分句，避免对整章文本一次性做 normalize
+        sentences = []
+        for paragraph in text.splitlines():
+            if paragraph.strip():
+                sentences.extend(self.tokenizer.split_sentences(self.tokenizer.tokenize(paragraph)))
+        digest = hashlib.sha256(json.dumps([text, voice_key, generation_config or {}], ensure_ascii=False,
+                                           sort_keys=True).encode("utf-8")).hexdigest()
+
+        writer = LongFormWriter(output_path, digest, len(sentences), sample_rate=sampling_rate)
+        next_sentence = await self.executors.run_audio_io(writer.open)
+        pending = deque()  # 按句子顺序排列的推理 task
+        sentence_iter = iter(range(next_sentence, len(sentences)))
+        written_frames = 0
+
+        def start_next_sentence():
+            index = next(sentence_iter, None)
+            if index is not None:
+                pending.append(asyncio.ensure_future(self._infer_sentence(
+                    sentences[index], speech_conditioning_latent, speaker_conditioning,
+                    request_context=request_context, sampling_params=sampling_params)))
+
+        try:
+            for _ in range(max(1, window)):
+                start_next_sentence()
+            while pending:
+                wav, _, _ = await pending[0]
+                pending.popleft()
+                start_next_sentence()
+                wav_data = trim_and_pad_silence(wav.type(torch.int16).numpy().T)
+                await self.executors.run_audio_io(writer.write, wav_data)
+                written_frames += len(wav_data)
+                if verbose:
+                    print(f">> long-form {output_path}: {writer.next_sentence}/{len(sentences)} sentences, "
+                          f"{writer.num_frames / sampling_rate:.1f}s audio")
+            await self.executors.run_audio_io(writer.finish)
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            await self.executors.run_audio_io(writer.close)
+
+        if written_frames:
+            RTF.observe((time.perf_counter() - start_time) / (written_frames / sampling_rate))
+        print(f">> long-form synthesis saved to: {output_path}")
+        return output_path
+
+    async def get_speaker(self, speaker: str):
+        """speaker_dict 中的角色特征；磁盘缓存中尚未读取的在 conditioning 线程池中读取并搬到 device，不阻塞事件循环"""
+        speaker_info = self.speaker_dict[speaker]
+        if isinstance(speaker_info, LazySpeaker) and not speaker_info.loaded:
+            await self.executors.run_conditioning(speaker_info.load)
+        return speaker_info
+
     @torch.no_grad()
     def registry_speaker(self, speaker: str, audio_paths: List[str]):
-        auto_conditioning = []
-        for ap_ in audio_paths:
-            audio, sr = torchaudio.load(ap_)
-            audio = torch.mean(audio, dim=0, keepdim=True)
-            if audio.shape[0] > 1:
-                audio = audio[0].unsqueeze(0)
-            audio = torchaudio.transforms.Resample(sr, 24000)(audio)
-            cond_mel = MelSpectrogramFeatures()(audio).to(self.device)
-            # cond_mel_frame = cond_mel.shape[-1]
-            auto_conditioning.append(cond_mel)
-
-        speech_conditioning_latent = []
-        for cond_mel in auto_conditioning:
-            speech_conditioning_latent_ = self.gpt.get_conditioning(
-                cond_mel,  # .half()
-                torch.tensor([cond_mel.shape[-1]], device=self.device)
-            )
-            speech_conditioning_latent.append(speech_conditioning_latent_)
-        speech_conditioning_latent = torch.stack(speech_conditioning_latent).sum(dim=0)
-        speech_conditioning_latent = speech_conditioning_latent / len(auto_conditioning)
-
-        self.speaker_dict[speaker] = {
-            "auto_conditioning": auto_conditioning,
-            "speech_conditioning_latent": speech_conditioning_latent
-        }
+        speaker_key = None
+        if self.speaker_store is not None:
+            speaker_key = self.speaker_store.get_key(audio_paths)
+            speaker_info = self.speaker_store.load(speaker_key, device=self.device)
+            if speaker_info is not None:
+                self.speaker_dict[speaker] = speaker_info
+                print(f"Speaker: {speaker} loaded from cache")
+                return
+
+        self.speaker_dict[speaker] = self.compute_conditioning(audio_paths)
+        if speaker_key is not None:
+            self.speaker_store.save(speaker_key, self.speaker_dict[speaker])
         print(f"Speaker: {speaker} registered")
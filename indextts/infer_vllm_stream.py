@@ -1,9 +1,10 @@
+import asyncio
 import os
 import re
 import time
 from subprocess import CalledProcessError
 import traceback
-from typing import List
+from typing import AsyncIterator, List
 
 import numpy as np
 import sentencepiece as spm
@@ -21,16 +22,26 @@ warnings.filterwarnings("ignore", category=UserWarning)
 from indextts.BigVGAN.models import BigVGAN as Generator
 from indextts.gpt.model_vllm import UnifiedVoice
 from indextts.utils.checkpoint import load_checkpoint
-from indextts.utils.feature_extractors import MelSpectrogramFeatures
+from indextts.utils.conditioning_cache import ConditioningCache, hash_audio_files
+from indextts.utils.executors import InferenceExecutors
+from indextts.utils.audio_frontend import AudioFrontend
 
-from indextts.utils.front import TextNormalizer, TextTokenizer
+from indextts.utils.front import IncrementalSentenceSplitter, TextNormalizer, TextTokenizer
+from indextts.utils.metrics import AUDIO_SECONDS, RTF, stage_timer, track_inflight_request
+from indextts.utils.speaker_store import LazySpeaker, SpeakerStore
+from indextts.utils.vocoder_batcher import VocoderBatcher
 
 import matplotlib.pyplot as plt
 
+# stream_infer* 的分句策略：sentence 与 infer 一致按整句合并；fast_first 首段在子句边界截短以降低首包延迟，后续分段逐步变长
+SPLIT_MODES = ["sentence", "fast_first"]
+
 
 
 
 def trim_and_pad_silence(wav_data, threshold=1000, min_silence=int(24000*0.4)):
+    if len(wav_data) == 0:
+        return np.zeros((min_silence, 1), dtype=np.int16)
 
     # 2. 处理后端静音
     abs_trimmed = np.abs(wav_data).flatten()
@@ -50,6 +61,10 @@ def trim_and_pad_silence(wav_data, threshold=1000, min_silence=int(24000*0.4)):
 class IndexTTS:
     def __init__(
         self, cfg_path="checkpoints/config.yaml", model_dir="checkpoints", gpu_memory_utilization=0.25, is_fp16=True, device=None, use_cuda_kernel=None,
+        use_vllm_latent=True, vocoder_max_batch_size=8, vocoder_batch_wait_ms=5.0, speaker_cache_dir=None,
+        conditioning_cache_size=64, conditioning_cache_mb=512, max_tokens_ratio=10.0, max_tokens_margin=50,
+        enable_prefix_caching=True, stream_lookahead_sentences=2, stream_left_context=None, stream_lookahead_frames=4,
+        stream_crossfade_frames=2,
     ):
         """
         Args:
@@ -58,6 +73,27 @@ class IndexTTS:
             is_fp16 (bool): whether to use fp16.
             device (str): device to use (e.g., 'cuda:0', 'cpu'). If None, it will be set automatically based on the availability of CUDA or MPS.
             use_cuda_kernel (None | bool): whether to use BigVGan custom fused activation CUDA kernel, only for CUDA device.
+            use_vllm_latent (bool): whether to take the BigVGAN latent from the vLLM hidden states. If True, the
+                HF GPT2Model is not kept on the device and the second GPT forward pass per sentence is skipped.
+            vocoder_max_batch_size (int): maximum number of sentences (across requests) vocoded in one BigVGAN forward.
+            vocoder_batch_wait_ms (float): how long the vocoder batcher waits to fill a batch.
+            speaker_cache_dir (None | str): directory to persist registered speaker features in. If None, speakers
+                are re-encoded on every start.
+            conditioning_cache_size (int): maximum number of reference audio features kept in the in-memory LRU
+                used by infer / stream_infer. 0 disables the cache.
+            conditioning_cache_mb (float): maximum size in MB of the tensors kept in that LRU.
+            max_tokens_ratio (float): per-sentence mel token budget per text token, 0 disables it.
+            max_tokens_margin (int): constant added to the per-sentence mel token budget.
+            enable_prefix_caching (bool): let vllm reuse the KV cache of the speaker conditioning block across requests.
+            stream_lookahead_sentences (int): number of sentences stream_infer decodes ahead of the sentence being
+                played back. 0 processes the sentences one after another.
+            stream_left_context (None | int): latent frames prepended to each chunk vocoded by token level streaming.
+                None uses BigVGAN.receptive_field(), which makes the left side of every chunk match a whole-sentence
+                vocode at the cost of extra vocoder compute.
+            stream_lookahead_frames (int): newest latent frames held back from each chunk until more right context
+                is decoded. Each frame adds one mel token of decode time to the first chunk latency.
+            stream_crossfade_frames (int): frames crossfaded between adjacent chunks to hide the seam left when
+                stream_lookahead_frames is smaller than BigVGAN.receptive_field().
         """
         if device is not None:
             self.device = device
@@ -82,9 +118,14 @@ class IndexTTS:
         self.dtype = torch.float16 if self.is_fp16 else None
         self.stop_mel_token = self.cfg.gpt.stop_mel_token
 
-        self.gpt = UnifiedVoice(gpu_memory_utilization, **self.cfg.gpt, model_dir=model_dir)
+        self.gpt = UnifiedVoice(gpu_memory_utilization, **self.cfg.gpt, model_dir=model_dir, use_vllm_latent=use_vllm_latent,
+                                max_tokens_ratio=max_tokens_ratio, max_tokens_margin=max_tokens_margin,
+                                enable_prefix_caching=enable_prefix_caching)
         self.gpt_path = os.path.join(self.model_dir, self.cfg.gpt_checkpoint)
         load_checkpoint(self.gpt, self.gpt_path)
+        if use_vllm_latent:
+            # latent 直接取自 vllm 的 hidden_states，HF 的 GPT2Model 不再需要，避免重复占用显存
+            self.gpt.gpt = None
         self.gpt = self.gpt.to(self.device)
         # if self.is_fp16:
         #     self.gpt.eval().half()
@@ -113,14 +154,30 @@ class IndexTTS:
         self.bigvgan.remove_weight_norm()
         self.bigvgan.eval()
         print(">> bigvgan weights restored from:", self.bigvgan_path)
+        # 阻塞的音频 IO / conditioning / bigvgan 计算放到专用线程池中，事件循环只做调度和网络收发
+        self.executors = InferenceExecutors()
+        self.vocoder = VocoderBatcher(self.bigvgan, max_batch_size=vocoder_max_batch_size, batch_wait_ms=vocoder_batch_wait_ms,
+                                      executor=self.executors.vocoder)
+        self.audio_frontend = AudioFrontend(self.device)
         self.bpe_path = os.path.join(self.model_dir, "bpe.model")  # self.cfg.dataset["bpe_model"]
         self.normalizer = TextNormalizer()
         self.normalizer.load()
         print(">> TextNormalizer loaded")
-        self.tokenizer = TextTokenizer(self.bpe_path, self.normalizer)
+        # normalize / tokenize 的耗时计入 /metrics 的 stage 直方图
+        self.tokenizer = TextTokenizer(self.bpe_path, self.normalizer, stage_timer=stage_timer)
         print(">> bpe model loaded from:", self.bpe_path)
 
         self.speaker_dict = {}
+        self.speaker_store = None
+        if speaker_cache_dir:
+            self.speaker_store = SpeakerStore(speaker_cache_dir, [self.gpt_path, self.bigvgan_path])
+            print(">> speaker cache dir:", speaker_cache_dir)
+        self.conditioning_cache = ConditioningCache(max_entries=conditioning_cache_size, max_bytes=int(conditioning_cache_mb * 1024 * 1024))
+        self.stream_lookahead_sentences = stream_lookahead_sentences
+        # 左侧上下文只增加 bigvgan 计算量、不增加延迟，默认取完整感受野
+        self.stream_left_context = self.bigvgan.receptive_field() if stream_left_context is None else stream_left_context
+        self.stream_lookahead_frames = stream_lookahead_frames
+        self.stream_crossfade_frames = stream_crossfade_frames
     
     def remove_long_silence(self, codes: list, latent: torch.Tensor, max_consecutive=15, silent_token=52):
         assert latent.dim() == 3 and latent.size(0) == 1, "Latent should be (1, seq_len, dim)"
@@ -155,20 +212,129 @@ class IndexTTS:
         # print("filtered_latent", filtered_latent.shape)
         return filtered_latent
 
-    async def infer(self, audio_prompt: List[str], text, output_path=None, verbose=False):
+    @torch.no_grad()
+    def get_latent(self, codes, speech_conditioning_latent, text_tokens):
+        """用 HF GPT2Model 重新 forward 一遍得到 latent，仅在 use_vllm_latent=False 时使用"""
+        codes = torch.tensor(codes, dtype=torch.long, device=self.device).unsqueeze(0)
+        code_lens = torch.tensor([codes.shape[-1]], device=codes.device, dtype=codes.dtype)
+        latent = self.gpt(speech_conditioning_latent, text_tokens,
+                        torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), codes,
+                        code_lens*self.gpt.mel_length_compression,
+                        cond_mel_lengths=torch.tensor([speech_conditioning_latent.shape[-1]], device=text_tokens.device),
+                        return_latent=True, clip_inputs=False)
+        return latent
+
+    @torch.no_grad()
+    def get_speaker_conditioning(self, auto_conditioning):
+        """参考音频 mel -> bigvgan 的说话人向量，以及其经 cond_layer/conds 投影后的 bias
+
+        Returns:
+            (speaker_embedding, speaker_conditioning)
+        """
+        speaker_embedding = self.bigvgan.get_speaker_embedding([ap_.transpose(1, 2) for ap_ in auto_conditioning])
+        speaker_conditioning = self.bigvgan.get_speaker_conditioning(speaker_embedding)
+        return speaker_embedding, speaker_conditioning
+
+    @torch.no_grad()
+    def compute_conditioning(self, audio_paths: List[str]):
+        """参考音频 -> mel、gpt conditioning latent（多段 batch 编码后取平均）、bigvgan 说话人向量
+
+        Returns:
+            dict: same layout as the entries of self.speaker_dict.
+        """
+        # 解码后在 device 上重采样并批量计算 mel
+        auto_conditioning = self.audio_frontend.compute_mels(audio_paths)
+
+        # 多段参考音频在一个 batch 中编码后取平均
+        speech_conditioning_latent = self.gpt.get_conditioning_from_clips(auto_conditioning)
+
+        speaker_embedding, speaker_conditioning = self.get_speaker_conditioning(auto_conditioning)
+        return {
+            "auto_conditioning": auto_conditioning,
+            "speech_conditioning_latent": speech_conditioning_latent,
+            "speaker_embedding": speaker_embedding,
+            "speaker_conditioning": speaker_conditioning,
+        }
+
+    async def get_conditioning_features(self, audio_paths: List[str]):
+        """compute_conditioning 的缓存版本，按参考音频内容 hash 查 self.conditioning_cache
+
+        hash 与特征计算都在线程池中执行，缓存本身只在事件循环线程中读写。
+        """
+        with stage_timer("conditioning"):
+            key = await self.executors.run_audio_io(hash_audio_files, audio_paths)
+            conditioning = self.conditioning_cache.get(key)
+            if conditioning is None:
+                conditioning = await self.executors.run_conditioning(self.compute_conditioning, audio_paths)
+                self.conditioning_cache.put(key, conditioning)
+        return conditioning
+
+    async def _infer_sentence(self, sent, speech_conditioning_latent, speaker_conditioning, request_context=None, sampling_params=None):
+        """单句推理：gpt 生成 codes -> 计算 latent -> bigvgan 生成波形
+
+        Returns:
+            (wav, gpt_gen_time, bigvgan_time)
+        """
+        text_tokens = self.tokenizer.convert_tokens_to_ids(sent)
+        text_tokens = torch.tensor(text_tokens, dtype=torch.int32, device=self.device).unsqueeze(0)
+
+        m_start_time = time.perf_counter()
+        codes, latent = await self.gpt.inference_speech(
+            speech_conditioning_latent,
+            text_tokens,
+            # cond_mel_lengths=torch.tensor([auto_conditioning.shape[-1]], device=text_tokens.device)
+            request_context=request_context,
+            sampling_params=sampling_params,
+        )
+        gpt_gen_time = time.perf_counter() - m_start_time
+
+        # # remove ultra-long silence if exits
+        # # temporarily fix the long silence bug.
+        # latent = self.remove_long_silence(codes, latent)
+
+        # 请求已取消 / 超时则不再做 bigvgan
+        if request_context is not None:
+            request_context.check()
+
+        if latent is None:
+            with stage_timer("latent"):
+                latent = await self.executors.run_vocoder(self.get_latent, codes, speech_conditioning_latent, text_tokens)
+
+        m_start_time = time.perf_counter()
+        with stage_timer("vocoder"):
+            wav = await self.vocoder.vocode(latent, speaker_conditioning)  # 已在 vocoder 线程中拷回 cpu
+        bigvgan_time = time.perf_counter() - m_start_time
+        AUDIO_SECONDS.inc(wav.shape[-1] / 24000)
+        wav = wav.squeeze(1)
+        wav = torch.clamp(32767 * wav, -32767.0, 32767.0)
+        return wav, gpt_gen_time, bigvgan_time
+
+    async def _infer_sentences(self, sentences, speech_conditioning_latent, speaker_conditioning, concurrent=True, request_context=None, sampling_params=None):
+        """推理所有分句，返回按原句子顺序排列的 [(wav, gpt_gen_time, bigvgan_time), ...]
+
+        concurrent=True 时所有分句同时提交给 vllm 引擎，由引擎合并成 batch 解码，
+        整体耗时约等于最长的一句，而不是所有句子耗时之和。
+        """
+        if concurrent:
+            return await asyncio.gather(*[
+                self._infer_sentence(sent, speech_conditioning_latent, speaker_conditioning, request_context=request_context, sampling_params=sampling_params)
+                for sent in sentences
+            ])
+        results = []
+        for sent in sentences:
+            results.append(await self._infer_sentence(sent, speech_conditioning_latent, speaker_conditioning, request_context=request_context, sampling_params=sampling_params))
+        return results
+
+    @track_inflight_request
+    async def infer(self, audio_prompt: List[str], text, output_path=None, verbose=False, concurrent=True, request_context=None,
+                    generation_config=None):
         print(">> start inference...")
+        sampling_params = self.gpt.build_sampling_params(generation_config)
         start_time = time.perf_counter()
 
-        auto_conditioning = []
-        for ap_ in audio_prompt:
-            audio, sr = torchaudio.load(ap_)
-            audio = torch.mean(audio, dim=0, keepdim=True)
-            if audio.shape[0] > 1:
-                audio = audio[0].unsqueeze(0)
-            audio = torchaudio.transforms.Resample(sr, 24000)(audio)
-            cond_mel = MelSpectrogramFeatures()(audio).to(self.device)
-            # cond_mel_frame = cond_mel.shape[-1]
-            auto_conditioning.append(cond_mel)
+        conditioning = await self.get_conditioning_features(audio_prompt)
+        speech_conditioning_latent = conditioning["speech_conditioning_latent"]
+        speaker_conditioning = conditioning["speaker_conditioning"]
 
         text_tokens_list = self.tokenizer.tokenize(text)
         sentences = self.tokenizer.split_sentences(text_tokens_list)
@@ -179,51 +345,14 @@ class IndexTTS:
         gpt_gen_time = 0
         bigvgan_time = 0
 
-        speech_conditioning_latent = []
-        for cond_mel in auto_conditioning:
-            speech_conditioning_latent_ = self.gpt.get_conditioning(
-                cond_mel,  # .half()
-                torch.tensor([cond_mel.shape[-1]], device=self.device)
-            )
-            speech_conditioning_latent.append(speech_conditioning_latent_)
-        speech_conditioning_latent = torch.stack(speech_conditioning_latent).sum(dim=0)
-        speech_conditioning_latent = speech_conditioning_latent / len(auto_conditioning)
-
-        for sent in sentences:
-            text_tokens = self.tokenizer.convert_tokens_to_ids(sent)
-            text_tokens = torch.tensor(text_tokens, dtype=torch.int32, device=self.device).unsqueeze(0)
-
-            m_start_time = time.perf_counter()
-            with torch.no_grad():
-                # with torch.amp.autocast(text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
-                codes, latent = await self.gpt.inference_speech(
-                    speech_conditioning_latent,
-                    text_tokens,
-                    # cond_mel_lengths=torch.tensor([auto_conditioning.shape[-1]], device=text_tokens.device)
-                )
-                gpt_gen_time += time.perf_counter() - m_start_time
-
-                # # remove ultra-long silence if exits
-                # # temporarily fix the long silence bug.
-                # latent = self.remove_long_silence(codes, latent)
-
-                codes = torch.tensor(codes, dtype=torch.long, device=self.device).unsqueeze(0)
-                code_lens = torch.tensor([codes.shape[-1]], device=codes.device, dtype=codes.dtype)
-                latent = self.gpt(speech_conditioning_latent, text_tokens,
-                                torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), codes,
-                                code_lens*self.gpt.mel_length_compression,
-                                cond_mel_lengths=torch.tensor([speech_conditioning_latent.shape[-1]], device=text_tokens.device),
-                                return_latent=True, clip_inputs=False)
-
-                m_start_time = time.perf_counter()
-                wav, _ = self.bigvgan(latent, [ap_.transpose(1, 2) for ap_ in auto_conditioning])
-                bigvgan_time += time.perf_counter() - m_start_time
-                wav = wav.squeeze(1)
-
-                wav = torch.clamp(32767 * wav, -32767.0, 32767.0)
-                print(f"wav shape: {wav.shape}", "min:", wav.min(), "max:", wav.max())
-                # wavs.append(wav[:, :-512])
-                wavs.append(wav.cpu())  # to cpu before saving
+        results = await self._infer_sentences(sentences, speech_conditioning_latent, speaker_conditioning, concurrent=concurrent,
+                                              request_context=request_context, sampling_params=sampling_params)
+        for wav, gpt_gen_time_, bigvgan_time_ in results:
+            gpt_gen_time += gpt_gen_time_
+            bigvgan_time += bigvgan_time_
+            print(f"wav shape: {wav.shape}", "min:", wav.min(), "max:", wav.max())
+            # wavs.append(wav[:, :-512])
+            wavs.append(wav.cpu())  # to cpu before saving
         torch.cuda.empty_cache()
         end_time = time.perf_counter()
 
@@ -234,6 +363,7 @@ class IndexTTS:
         print(f">> Total inference time: {end_time - start_time:.2f} seconds")
         print(f">> Generated audio length: {wav_length:.2f} seconds")
         print(f">> RTF: {(end_time - start_time) / wav_length:.4f}")
+        RTF.observe((end_time - start_time) / wav_length)
 
         # save audio
         wav = wav.cpu()  # to cpu
@@ -244,7 +374,7 @@ class IndexTTS:
                 print(">> remove old wav file:", output_path)
             if os.path.dirname(output_path) != "":
                 os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            torchaudio.save(output_path, wav.type(torch.int16), sampling_rate)
+            await self.executors.run_audio_io(torchaudio.save, output_path, wav.type(torch.int16), sampling_rate)
             print(">> wav file saved to:", output_path)
             return output_path
         else:
@@ -254,7 +384,9 @@ class IndexTTS:
             wav_data = trim_and_pad_silence(wav_data)
             return (sampling_rate, wav_data)
 
-    async def infer_with_ref_audio_embed(self, speaker: str, text):
+    @track_inflight_request
+    async def infer_with_ref_audio_embed(self, speaker: str, text, concurrent=True, request_context=None, generation_config=None):
+        sampling_params = self.gpt.build_sampling_params(generation_config)
         start_time = time.perf_counter()
         text = text.replace("嗯", "EN4")
         text = text.replace("嘿", "HEI1")
@@ -262,7 +394,8 @@ class IndexTTS:
         text = text.replace("哈哈", "HA1HA1")
         sampling_rate = 24000
 
-        auto_conditioning = self.speaker_dict[speaker]["auto_conditioning"]
+        speaker_info = await self.get_speaker(speaker)
+        auto_conditioning = speaker_info["auto_conditioning"]
 
         text_tokens_list = self.tokenizer.tokenize(text)
         sentences = self.tokenizer.split_sentences(text_tokens_list)
@@ -270,45 +403,21 @@ class IndexTTS:
         gpt_gen_time = 0
         bigvgan_time = 0
 
-        speech_conditioning_latent = self.speaker_dict[speaker]["speech_conditioning_latent"]
+        speech_conditioning_latent = speaker_info["speech_conditioning_latent"]
+        speaker_conditioning = speaker_info["speaker_conditioning"]
 
-        for sent in sentences:
-            text_tokens = self.tokenizer.convert_tokens_to_ids(sent)
-            text_tokens = torch.tensor(text_tokens, dtype=torch.int32, device=self.device).unsqueeze(0)
-
-            m_start_time = time.perf_counter()
-            with torch.no_grad():
-                codes, latent = await self.gpt.inference_speech(
-                    speech_conditioning_latent,
-                    text_tokens,
-                    # cond_mel_lengths=torch.tensor([auto_conditioning.shape[-1]], device=text_tokens.device)
-                )
-                gpt_gen_time += time.perf_counter() - m_start_time
-
-                # # remove ultra-long silence if exits
-                # # temporarily fix the long silence bug.
-                # latent = self.remove_long_silence(codes, latent)
-
-                codes = torch.tensor(codes, dtype=torch.long, device=self.device).unsqueeze(0)
-                code_lens = torch.tensor([codes.shape[-1]], device=codes.device, dtype=codes.dtype)
-                latent = self.gpt(speech_conditioning_latent, text_tokens,
-                                torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), codes,
-                                code_lens*self.gpt.mel_length_compression,
-                                cond_mel_lengths=torch.tensor([speech_conditioning_latent.shape[-1]], device=text_tokens.device),
-                                return_latent=True, clip_inputs=False)
-
-                m_start_time = time.perf_counter()
-                wav, _ = self.bigvgan(latent, [ap_.transpose(1, 2) for ap_ in auto_conditioning])
-                bigvgan_time += time.perf_counter() - m_start_time
-                wav = wav.squeeze(1)
-
-                wav = torch.clamp(32767 * wav, -32767.0, 32767.0)
-                # wavs.append(wav[:, :-512])
-                wavs.append(wav)  # to cpu before saving
+        results = await self._infer_sentences(sentences, speech_conditioning_latent, speaker_conditioning, concurrent=concurrent,
+                                              request_context=request_context, sampling_params=sampling_params)
+        for wav, gpt_gen_time_, bigvgan_time_ in results:
+            gpt_gen_time += gpt_gen_time_
+            bigvgan_time += bigvgan_time_
+            # wavs.append(wav[:, :-512])
+            wavs.append(wav)  # to cpu before saving
         torch.cuda.empty_cache()
         end_time = time.perf_counter()
 
         wav = torch.cat(wavs, dim=1)
+        RTF.observe((end_time - start_time) / (wav.shape[-1] / sampling_rate))
         # wav_length = wav.shape[-1] / sampling_rate
         # # print(f">> Total inference time: {end_time - start_time:.2f} seconds")
         # print(f">> gpt_gen_time: {gpt_gen_time:.2f} seconds")
@@ -324,43 +433,229 @@ class IndexTTS:
         wav_data = trim_and_pad_silence(wav_data)
         return (sampling_rate, wav_data)
 
+    async def get_speaker(self, speaker: str):
+        """speaker_dict 中的角色特征；磁盘缓存中尚未读取的在 conditioning 线程池中读取并搬到 device，不阻塞事件循环"""
+        speaker_info = self.speaker_dict[speaker]
+        if isinstance(speaker_info, LazySpeaker) and not speaker_info.loaded:
+            await self.executors.run_conditioning(speaker_info.load)
+        return speaker_info
+
     @torch.no_grad()
     def registry_speaker(self, speaker: str, audio_paths: List[str]):
-        auto_conditioning = []
-        for ap_ in audio_paths:
-            audio, sr = torchaudio.load(ap_)
-            audio = torch.mean(audio, dim=0, keepdim=True)
-            if audio.shape[0] > 1:
-                audio = audio[0].unsqueeze(0)
-            audio = torchaudio.transforms.Resample(sr, 24000)(audio)
-            cond_mel = MelSpectrogramFeatures()(audio).to(self.device)
-            # cond_mel_frame = cond_mel.shape[-1]
-            auto_conditioning.append(cond_mel)
-
-        speech_conditioning_latent = []
-        for cond_mel in auto_conditioning:
-            speech_conditioning_latent_ = self.gpt.get_conditioning(
-                cond_mel,  # .half()
-                torch.tensor([cond_mel.shape[-1]], device=self.device)
-            )
-            speech_conditioning_latent.append(speech_conditioning_latent_)
-        speech_conditioning_latent = torch.stack(speech_conditioning_latent).sum(dim=0)
-        speech_conditioning_latent = speech_conditioning_latent / len(auto_conditioning)
-
-        self.speaker_dict[speaker] = {
-            "auto_conditioning": auto_conditioning,
-            "speech_conditioning_latent": speech_conditioning_latent
-        }
+        speaker_key = None
+        if self.speaker_store is not None:
+            speaker_key = self.speaker_store.get_key(audio_paths)
+            speaker_info = self.speaker_store.load(speaker_key, device=self.device)
+            if speaker_info is not None:
+                self.speaker_dict[speaker] = speaker_info
+                print(f"Speaker: {speaker} loaded from cache")
+                return
+
+        self.speaker_dict[speaker] = self.compute_conditioning(audio_paths)
+        if speaker_key is not None:
+            self.speaker_store.save(speaker_key, self.speaker_dict[speaker])
         print(f"Speaker: {speaker} registered")
 
 
-    async def stream_infer_with_character(self, speaker: str, text, verbose=False):
+    async def _stream_sentence_chunks(self, sent, speech_conditioning_latent, speaker_conditioning, chunk_tokens,
+                                      left_context=None, lookahead=None, crossfade_frames=None, request_context=None,
+                                      sampling_params=None):
+        """单句 token 级流式：vllm 每生成 chunk_tokens 个 mel token，就把新的 latent 送去 bigvgan
+
+        每次 vocode 的 latent 向左多带 left_context 帧，不小于 BigVGAN.receptive_field() 时输出部分的左侧上下文
+        与整句一次性 vocode 一致。最右 lookahead 帧缺少右侧上下文，留到下一段再输出；lookahead 小于感受野时，
+        每段末尾的波形仍与整句 vocode 略有差别，相邻两段在 crossfade_frames 帧的重叠区间内做线性交叉淡化掩盖接缝。
+        三者为 None 时使用构造函数中的 stream_left_context / stream_lookahead_frames / stream_crossfade_frames。
+
+        Yields:
+            (wav, is_last): wav is a (1, t) float tensor on cpu, already scaled to the int16 range.
+        """
+        left_context = self.stream_left_context if left_context is None else left_context
+        lookahead = self.stream_lookahead_frames if lookahead is None else lookahead
+        crossfade_frames = max(0, self.stream_crossfade_frames if crossfade_frames is None else crossfade_frames)
+        chunk_tokens = max(chunk_tokens, crossfade_frames + 1)
+        text_tokens = self.tokenizer.convert_tokens_to_ids(sent)
+        text_tokens = torch.tensor(text_tokens, dtype=torch.int32, device=self.device).unsqueeze(0)
+
+        emitted_frames = 0  # 已输出（不含交叉淡化尾部）的帧数
+        vocoded_frames = 0  # 上一次 vocode 时可用的帧数
+        tail = None  # 上一段末尾 crossfade_frames 帧的波形，与下一段开头交叉淡化
+        last_yielded = False
+        async for codes, hidden_states, finished in self.gpt.inference_speech_stream(
+                speech_conditioning_latent, text_tokens, request_context=request_context, sampling_params=sampling_params):
+            num_frames = len(codes)
+            if not finished and num_frames - vocoded_frames < chunk_tokens + lookahead:
+                continue
+            if num_frames <= emitted_frames:
+                continue
+            if request_context is not None:
+                request_context.check()
+
+            end = num_frames if finished else num_frames - lookahead
+            start = max(0, emitted_frames - left_context)
+            latent = torch.stack(hidden_states[start:num_frames], dim=0).unsqueeze(0).float()
+            with stage_timer("vocoder"):
+                wav = await self.vocoder.vocode(latent, speaker_conditioning)
+            wav = torch.clamp(32767 * wav.squeeze(1), -32767.0, 32767.0)
+            hop_length = wav.shape[-1] // (num_frames - start)
+            vocoded_frames = num_frames
+
+            segment = wav[:, (emitted_frames - start) * hop_length:(end - start) * hop_length]
+            if tail is not None:
+                fade = torch.linspace(0.0, 1.0, tail.shape[-1])
+                segment[:, :tail.shape[-1]] = tail * (1.0 - fade) + segment[:, :tail.shape[-1]] * fade
+            if finished:
+                tail = None
+                last_yielded = True
+                yield segment, True
+                continue
+            if crossfade_frames == 0:
+                emitted_frames = end
+                yield segment, False
+                continue
+            tail_length = crossfade_frames * hop_length
+            tail = segment[:, -tail_length:].clone()
+            emitted_frames = end - crossfade_frames
+            yield segment[:, :-tail_length], False
+
+        if tail is not None:
+            yield tail, True
+        elif not last_yielded:
+            # crossfade_frames 为 0 且最后一段已全部输出时，仍以 is_last 结束本句，句末补静音
+            yield torch.zeros(1, 0), True
+
+    async def _stream_sentence_wavs(self, sent, speech_conditioning_latent, speaker_conditioning, chunk_tokens=0, request_context=None, sampling_params=None):
+        """按 chunk_tokens 选择逐句或 token 级流式，yield int16 numpy 音频块，句末补静音"""
+        if chunk_tokens <= 0 or not self.gpt.use_vllm_latent:
+            wav, _, _ = await self._infer_sentence(sent, speech_conditioning_latent, speaker_conditioning, request_context=request_context, sampling_params=sampling_params)
+            # 转换为numpy格式并处理
+            wav_chunk = wav.type(torch.int16).numpy().T
+            yield trim_and_pad_silence(wav_chunk)
+            return
+
+        async for wav, is_last in self._stream_sentence_chunks(sent, speech_conditioning_latent, speaker_conditioning,
+                                                               chunk_tokens, request_context=request_context, sampling_params=sampling_params):
+            AUDIO_SECONDS.inc(wav.shape[-1] / 24000)
+            wav_chunk = wav.type(torch.int16).numpy().T
+            if is_last:
+                wav_chunk = trim_and_pad_silence(wav_chunk)
+            yield wav_chunk
+
+    def split_stream_sentences(self, text, split_mode="sentence"):
+        """按 split_mode（见 SPLIT_MODES）对文本分句"""
+        text_tokens_list = self.tokenizer.tokenize(text)
+        if split_mode == "fast_first":
+            return self.tokenizer.split_sentences_fast_first(text_tokens_list)
+        if split_mode == "sentence":
+            return self.tokenizer.split_sentences(text_tokens_list)
+        raise ValueError(f"invalid split_mode: {split_mode!r}, expected one of {SPLIT_MODES}")
+
+    async def split_incremental_sentences(self, text_deltas: AsyncIterator[str]):
+        """文本增量（如上游 LLM 逐 token 输出）-> 逐句 yield tokenize 后的句子，句子一完整就输出"""
+        splitter = IncrementalSentenceSplitter(self.tokenizer)
+        async for delta in text_deltas:
+            for sent in splitter.push(delta):
+                yield sent
+        for sent in splitter.flush():
+            yield sent
+
+    async def _stream_sentences(self, sentences, speech_conditioning_latent, speaker_conditioning, chunk_tokens=0,
+                                request_context=None, sampling_params=None, max_buffered_chunks=16):
+        """多句流水线：当前句之后的 stream_lookahead_sentences 句同时在 vllm 中解码
+
+        每句由独立的 task 完成 gpt 解码 -> latent -> bigvgan -> trim_and_pad_silence，结果放入该句的有界队列；
+        这里按句子顺序从队列中取出并 yield，调用方编码、发送当前句时，后续句子的解码与 vocode 不会停下。
+        当前句输出完毕才启动下一句，提前解码的句子数不超过 stream_lookahead_sentences。
+
+        Args:
+            sentences (list | AsyncIterator): tokenized sentences. An async iterator (see split_incremental_sentences)
+                is consumed as the sentences arrive, each one starts decoding as soon as a lookahead slot is free.
+            max_buffered_chunks (int): maximum number of audio chunks buffered per sentence. A sentence whose
+                queue is full waits for the consumer before vocoding further chunks.
+
+        Yields:
+            (sentence_index, wav_chunk): int16 numpy audio chunks in sentence order.
+        """
+        done = object()  # 每句 / 全部句子结束的标记
+
+        async def run_sentence(sent, chunk_queue):
+            try:
+                async for wav_chunk in self._stream_sentence_wavs(sent, speech_conditioning_latent, speaker_conditioning,
+                                                                  chunk_tokens=chunk_tokens, request_context=request_context,
+                                                                  sampling_params=sampling_params):
+                    await chunk_queue.put(wav_chunk)
+            except Exception as ex:
+                await chunk_queue.put(ex)
+                return
+            await chunk_queue.put(done)
+
+        async def iterate_sentences():
+            if hasattr(sentences, "__aiter__"):
+                async for sent in sentences:
+                    yield sent
+            else:
+                for sent in sentences:
+                    yield sent
+
+        slots = asyncio.Semaphore(max(0, self.stream_lookahead_sentences) + 1)
+        started = asyncio.Queue()  # (sentence_index, chunk_queue)，按句子顺序；异常 / done 表示输入结束
+        tasks = []
+
+        async def start_sentences():
+            # 句子到达且有空闲的 lookahead 名额时立即启动
+            try:
+                sentence_index = 0
+                async for sent in iterate_sentences():
+                    await slots.acquire()
+                    text_tokens = self.tokenizer.convert_tokens_to_ids(sent)
+                    original_text = self.tokenizer.decode(text_tokens)  # 将ID转回文本
+                    print(f"original text:", original_text)
+                    chunk_queue = asyncio.Queue(maxsize=max_buffered_chunks)
+                    tasks.append(asyncio.ensure_future(run_sentence(sent, chunk_queue)))
+                    await started.put((sentence_index, chunk_queue))
+                    sentence_index += 1
+            except Exception as ex:
+                await started.put(ex)
+                return
+            await started.put(done)
+
+        starter = asyncio.ensure_future(start_sentences())
+        try:
+            while True:
+                item = await started.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                sentence_index, chunk_queue = item
+                while True:
+                    item = await chunk_queue.get()
+                    if item is done:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    yield sentence_index, item
+                slots.release()
+        finally:
+            # 客户端断开 / 出错时取消仍在进行的句子，vllm 中对应的请求随之 abort
+            starter.cancel()
+            for task in tasks:
+                task.cancel()
+
+    @track_inflight_request
+    async def stream_infer_with_character(self, speaker: str, text, verbose=False, request_context=None, chunk_tokens=0,
+                                          generation_config=None, split_mode="sentence", return_sentence_index=False):
         """流式语音合成方法，使用预注册的角色特征
 
         Args:
             speaker: 预注册的角色名称
-            text: 要合成的文本
+            text: 要合成的文本；也可以是逐段到达的文本增量（async iterator），此时边接收边分句，句子一完整就开始合成
             verbose: 是否打印详细日志
+            request_context: 所属 HTTP 请求的 RequestContext，取消后停止生成后续句子
+            chunk_tokens: >0 时按 token 粒度流式输出，每生成约 chunk_tokens 个 mel token 就输出一段音频；0 为逐句输出
+            generation_config: 本次请求的采样参数覆盖（seed / temperature / top_p / top_k / repetition_penalty / max_tokens）
+            split_mode: 分句策略，见 SPLIT_MODES；fast_first 首段更短，首包更快
+            return_sentence_index: 为 True 时 yield (采样率, 句子序号, 音频数据)
 
         Yields:
             (采样率, 音频数据) 元组，可以多次yield
@@ -369,52 +664,31 @@ class IndexTTS:
             print(">> start streaming inference with character...")
         start_time = time.perf_counter()
         sampling_rate = 24000
+        sampling_params = self.gpt.build_sampling_params(generation_config)
 
         # 1. 从speaker_dict获取预处理的特征
-        auto_conditioning = self.speaker_dict[speaker]["auto_conditioning"]
-        speech_conditioning_latent = self.speaker_dict[speaker]["speech_conditioning_latent"]
+        speaker_info = await self.get_speaker(speaker)
+        auto_conditioning = speaker_info["auto_conditioning"]
+        speech_conditioning_latent = speaker_info["speech_conditioning_latent"]
+        speaker_conditioning = speaker_info["speaker_conditioning"]
 
         # 2. 文本处理
-        text_tokens_list = self.tokenizer.tokenize(text)
-        sentences = self.tokenizer.split_sentences(text_tokens_list)
-
-        # 3. 逐句生成并流式输出
-        for sent in sentences:
-            text_tokens = self.tokenizer.convert_tokens_to_ids(sent)
-            original_text = self.tokenizer.decode(text_tokens)  # 将ID转回文本
-            print(f"original text:", original_text)
-            text_tokens = torch.tensor(text_tokens, dtype=torch.int32, device=self.device).unsqueeze(0)
-
-            with torch.no_grad():
-                # 生成语音编码
-                codes, latent = await self.gpt.inference_speech(
-                    speech_conditioning_latent,
-                    text_tokens
-                )
-
-                # 转换为波形
-                codes = torch.tensor(codes, dtype=torch.long, device=self.device).unsqueeze(0)
-                code_lens = torch.tensor([codes.shape[-1]], device=codes.device, dtype=codes.dtype)
-                latent = self.gpt(
-                    speech_conditioning_latent, text_tokens,
-                    torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), codes,
-                    code_lens * self.gpt.mel_length_compression,
-                    cond_mel_lengths=torch.tensor([speech_conditioning_latent.shape[-1]], device=text_tokens.device),
-                    return_latent=True, clip_inputs=False
-                )
-
-                # 生成波形
-                wav, _ = self.bigvgan(latent, [ap_.transpose(1, 2) for ap_ in auto_conditioning])
-                wav = wav.squeeze(1)
-                wav = torch.clamp(32767 * wav, -32767.0, 32767.0)
-
-                # 转换为numpy格式并处理
-                wav_chunk = wav.cpu().type(torch.int16).numpy().T
-                wav_chunk = trim_and_pad_silence(wav_chunk)
-
-                if verbose:
-                    print(f">> Yielded audio chunk with shape: {wav_chunk.shape}")
-
+        if isinstance(text, str):
+            sentences = self.split_stream_sentences(text, split_mode)
+        else:
+            # 增量文本：split_mode 不适用，按 split_sentences 的规则逐句切分
+            sentences = self.split_incremental_sentences(text)
+
+        # 3. 流水线生成：后续句子提前解码，按句子顺序流式输出
+        async for sentence_index, wav_chunk in self._stream_sentences(sentences, speech_conditioning_latent, speaker_conditioning,
+                                                                      chunk_tokens=chunk_tokens, request_context=request_context,
+                                                                      sampling_params=sampling_params):
+            if verbose:
+                print(f">> Yielded audio chunk with shape: {wav_chunk.shape}")
+
+            if return_sentence_index:
+                yield (sampling_rate, sentence_index, wav_chunk)
+            else:
                 yield (sampling_rate, wav_chunk)
 
         torch.cuda.empty_cache()
@@ -422,13 +696,20 @@ class IndexTTS:
             end_time = time.perf_counter()
             print(f">> Streaming inference with character completed in {end_time - start_time:.2f} seconds")
 
-    async def stream_infer(self, audio_prompt: List[str], text, verbose=False):
+    @track_inflight_request
+    async def stream_infer(self, audio_prompt: List[str], text, verbose=False, request_context=None, chunk_tokens=0,
+                           generation_config=None, split_mode="sentence", return_sentence_index=False):
         """流式语音合成方法，使用生成器逐句返回音频
 
         Args:
             audio_prompt: 音频提示文件路径列表
             text: 要合成的文本
             verbose: 是否打印详细日志
+            request_context: 所属 HTTP 请求的 RequestContext，取消后停止生成后续句子
+            chunk_tokens: >0 时按 token 粒度流式输出，每生成约 chunk_tokens 个 mel token 就输出一段音频；0 为逐句输出
+            generation_config: 本次请求的采样参数覆盖（seed / temperature / top_p / top_k / repetition_penalty / max_tokens）
+            split_mode: 分句策略，见 SPLIT_MODES；fast_first 首段更短，首包更快
+            return_sentence_index: 为 True 时 yield (采样率, 句子序号, 音频数据)
 
         Yields:
             (采样率, 音频数据) 元组，可以多次yield
@@ -437,70 +718,26 @@ class IndexTTS:
             print(">> start streaming inference...")
         start_time = time.perf_counter()
         sampling_rate = 24000
+        sampling_params = self.gpt.build_sampling_params(generation_config)
 
-        # 1. 音频提示预处理
-        auto_conditioning = []
-        for ap_ in audio_prompt:
-            audio, sr = torchaudio.load(ap_)
-            audio = torch.mean(audio, dim=0, keepdim=True)
-            if audio.shape[0] > 1:
-                audio = audio[0].unsqueeze(0)
-            audio = torchaudio.transforms.Resample(sr, sampling_rate)(audio)
-            cond_mel = MelSpectrogramFeatures()(audio).to(self.device)
-            auto_conditioning.append(cond_mel)
-
-        # 2. 获取语音条件潜在表示
-        speech_conditioning_latent = []
-        for cond_mel in auto_conditioning:
-            speech_conditioning_latent_ = self.gpt.get_conditioning(
-                cond_mel,
-                torch.tensor([cond_mel.shape[-1]], device=self.device)
-            )
-            speech_conditioning_latent.append(speech_conditioning_latent_)
-        speech_conditioning_latent = torch.stack(speech_conditioning_latent).sum(dim=0)
-        speech_conditioning_latent = speech_conditioning_latent / len(auto_conditioning)
-
-        # 3. 文本处理
-        text_tokens_list = self.tokenizer.tokenize(text)
-        sentences = self.tokenizer.split_sentences(text_tokens_list)
+        # 1. 参考音频特征（按音频内容缓存）
+        conditioning = await self.get_conditioning_features(audio_prompt)
+        speech_conditioning_latent = conditioning["speech_conditioning_latent"]
+        speaker_conditioning = conditioning["speaker_conditioning"]
 
-        # 4. 逐句生成并流式输出
-        for sent in sentences:
-            text_tokens = self.tokenizer.convert_tokens_to_ids(sent)
-            original_text = self.tokenizer.decode(text_tokens)  # 将ID转回文本
-            print(f"original text:", original_text)
-            text_tokens = torch.tensor(text_tokens, dtype=torch.int32, device=self.device).unsqueeze(0)
-
-            with torch.no_grad():
-                # 生成语音编码
-                codes, latent = await self.gpt.inference_speech(
-                    speech_conditioning_latent,
-                    text_tokens
-                )
-
-                # 转换为波形
-                codes = torch.tensor(codes, dtype=torch.long, device=self.device).unsqueeze(0)
-                code_lens = torch.tensor([codes.shape[-1]], device=codes.device, dtype=codes.dtype)
-                latent = self.gpt(
-                    speech_conditioning_latent, text_tokens,
-                    torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), codes,
-                    code_lens * self.gpt.mel_length_compression,
-                    cond_mel_lengths=torch.tensor([speech_conditioning_latent.shape[-1]], device=text_tokens.device),
-                    return_latent=True, clip_inputs=False
-                )
-
-                # 生成波形
-                wav, _ = self.bigvgan(latent, [ap_.transpose(1, 2) for ap_ in auto_conditioning])
-                wav = wav.squeeze(1)
-                wav = torch.clamp(32767 * wav, -32767.0, 32767.0)
-
-                # 转换为numpy格式并处理
-                wav_chunk = wav.cpu().type(torch.int16).numpy().T
-                wav_chunk = trim_and_pad_silence(wav_chunk)
+        # 2. 文本处理
+        sentences = self.split_stream_sentences(text, split_mode)
 
-                if verbose:
-                    print(f">> Yielded audio chunk with shape: {wav_chunk.shape}")
+        # 3. 流水线生成：后续句子提前解码，按句子顺序流式输出
+        async for sentence_index, wav_chunk in self._stream_sentences(sentences, speech_conditioning_latent, speaker_conditioning,
+                                                                      chunk_tokens=chunk_tokens, request_context=request_context,
+                                                                      sampling_params=sampling_params):
+            if verbose:
+                print(f">> Yielded audio chunk with shape: {wav_chunk.shape}")
 
+            if return_sentence_index:
+                yield (sampling_rate, sentence_index, wav_chunk)
+            else:
                 yield (sampling_rate, wav_chunk)
 
         torch.cuda.empty_cache()
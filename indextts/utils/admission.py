@@ -0,0 +1,212 @@
+import asyncio
+import math
+import re
+import time
+import weakref
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Tuple
+
+from indextts.utils.metrics import ADMISSION_OUTSTANDING_SECONDS, ADMISSION_QUEUED, ADMISSION_REJECTED, observe_stage
+
+# 估算文本 token 数：每个 CJK 字符约 1 个 token，英文 / 数字按词计；不做 normalize，代价远小于真正的 tokenize
+_CJK_PATTERN = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]")
+_WORD_PATTERN = re.compile(r"[A-Za-z0-9']+")
+
+
+class AdmissionRejected(Exception):
+    """排队已满或排队超时，应返回 429，retry_after 为建议的重试间隔（秒）"""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """按预计生成的音频时长做准入控制与过载保护
+
+    每个请求的代价估算为：文本 token 数 -> 预计 mel token 数 -> 音频秒数。在途请求的代价之和不超过
+    capacity_seconds 时直接放行，否则按先来先服务排队；排队数超过 max_queue 或排队超过 queue_timeout
+    时拒绝（429 + Retry-After），避免过载时所有请求一起变慢、全部超时。
+    单个请求的代价超过 capacity_seconds 时，在没有其它在途请求时放行。
+    """
+
+    def __init__(self, capacity_seconds=0.0, max_queue=64, queue_timeout=30.0, mel_tokens_per_text_token=5.0,
+                 seconds_per_mel_token=1024 / 24000, drain_window=30.0):
+        """
+        Args:
+            capacity_seconds (float): seconds of audio allowed in flight. 0 disables admission control, requests
+                are still counted for /health.
+            max_queue (int): requests allowed to wait for capacity, more are rejected right away.
+            queue_timeout (float): seconds a request may wait in the queue before it is rejected.
+            mel_tokens_per_text_token (float): expected mel tokens generated per text token.
+            seconds_per_mel_token (float): audio seconds per mel token (BigVGAN hop length * 4 / sample rate).
+            drain_window (float): seconds of completed requests used to estimate the drain rate for Retry-After.
+        """
+        self.capacity_seconds = capacity_seconds
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.mel_tokens_per_text_token = mel_tokens_per_text_token
+        self.seconds_per_mel_token = seconds_per_mel_token
+        self.drain_window = drain_window
+
+        self.outstanding_seconds = 0.0
+        self.inflight = 0
+        self.waiters: Deque[Tuple[float, asyncio.Future]] = deque()
+        self.completed: Deque[Tuple[float, float]] = deque()  # (完成时间, 代价)
+        self.admitted = 0
+        self.rejected = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity_seconds > 0
+
+    @staticmethod
+    def count_text_tokens(text: str) -> int:
+        return len(_CJK_PATTERN.findall(text)) + len(_WORD_PATTERN.findall(text))
+
+    def tokens_cost(self, text_tokens: int) -> float:
+        """文本 token 数 -> 预计生成的音频秒数"""
+        return max(1, text_tokens) * self.mel_tokens_per_text_token * self.seconds_per_mel_token
+
+    def estimate_cost(self, text: str) -> float:
+        """text -> 预计生成的音频秒数"""
+        return self.tokens_cost(self.count_text_tokens(text))
+
+    def _fits(self, cost: float) -> bool:
+        return not self.enabled or self.inflight == 0 or self.outstanding_seconds + cost <= self.capacity_seconds
+
+    def _drain_rate(self) -> float:
+        """最近 drain_window 秒内每秒完成的音频秒数"""
+        now = time.monotonic()
+        while self.completed and now - self.completed[0][0] > self.drain_window:
+            self.completed.popleft()
+        if not self.completed:
+            return 0.0
+        return sum(cost for _, cost in self.completed) / self.drain_window
+
+    def retry_after(self) -> int:
+        """清空当前在途与排队的代价预计需要的秒数"""
+        backlog = self.outstanding_seconds + sum(cost for cost, _ in self.waiters)
+        rate = self._drain_rate()
+        if rate <= 0:
+            return 1
+        return max(1, math.ceil((backlog - self.capacity_seconds) / rate))
+
+    def _reject(self, reason: str):
+        self.rejected += 1
+        ADMISSION_REJECTED.inc()
+        raise AdmissionRejected(reason, self.retry_after())
+
+    def _grant(self, cost: float):
+        self.inflight += 1
+        self.admitted += 1
+        self.outstanding_seconds += cost
+        ADMISSION_OUTSTANDING_SECONDS.set(self.outstanding_seconds)
+
+    def _wake(self):
+        # 严格按顺序放行，队首放不下时后面的小请求也等待，避免大请求饿死
+        while self.waiters and self._fits(self.waiters[0][0]):
+            cost, future = self.waiters.popleft()
+            if future.done():
+                continue
+            self._grant(cost)
+            future.set_result(None)
+        ADMISSION_QUEUED.set(len(self.waiters))
+
+    async def acquire(self, cost: float):
+        """等待直到放行，被拒绝时抛出 AdmissionRejected；放行后必须调用 release(cost)"""
+        if not self.waiters and self._fits(cost):
+            self._grant(cost)
+            return
+        if len(self.waiters) >= self.max_queue:
+            self._reject("queue full")
+
+        start_time = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((cost, future))
+        ADMISSION_QUEUED.set(len(self.waiters))
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.queue_timeout if self.queue_timeout > 0 else None)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as ex:
+            if future.done() and not future.cancelled():
+                # 超时 / 取消与放行同时发生：已计入在途，需要归还
+                self.release(cost)
+            else:
+                future.cancel()
+                self._remove_waiter(future)
+            if isinstance(ex, asyncio.TimeoutError):
+                self._reject("queue timeout")
+            raise
+        finally:
+            observe_stage("admission_wait", time.perf_counter() - start_time)
+
+    def _remove_waiter(self, future: asyncio.Future):
+        self.waiters = deque(waiter for waiter in self.waiters if waiter[1] is not future)
+        # 队首离开后，后面的请求可能已经可以放行
+        self._wake()
+
+    def charge(self, cost: float):
+        """已放行的请求追加代价（如 WebSocket 陆续到达的文本），不排队；结束时 release 传入累计的代价"""
+        self.outstanding_seconds += cost
+        ADMISSION_OUTSTANDING_SECONDS.set(self.outstanding_seconds)
+
+    def release(self, cost: float):
+        self.inflight -= 1
+        self.outstanding_seconds = max(0.0, self.outstanding_seconds - cost)
+        self.completed.append((time.monotonic(), cost))
+        ADMISSION_OUTSTANDING_SECONDS.set(self.outstanding_seconds)
+        self._wake()
+
+    @asynccontextmanager
+    async def admit(self, cost: float):
+        await self.acquire(cost)
+        try:
+            yield
+        finally:
+            self.release(cost)
+
+    async def admit_stream(self, cost: float, stream: AsyncIterator):
+        """流式响应的准入：在返回响应之前等待放行（被拒绝时仍可返回 429），流结束时归还
+
+        客户端在响应开始前断开时 starlette 不会迭代生成器、其 finally 不会执行，
+        因此同时在生成器被回收时归还，保证名额不会泄漏。
+        """
+        await self.acquire(cost)
+        loop = asyncio.get_running_loop()
+        released = False
+
+        def release_once():
+            nonlocal released
+            if not released:
+                released = True
+                self.release(cost)
+
+        async def generate():
+            try:
+                async for chunk in stream:
+                    yield chunk
+            finally:
+                release_once()
+
+        generator = generate()
+        weakref.finalize(generator, lambda: loop.is_closed() or loop.call_soon_threadsafe(release_once))
+        return generator
+
+    def stats(self) -> dict:
+        queued_seconds = sum(cost for cost, _ in self.waiters)
+        return {
+            "enabled": self.enabled,
+            "capacity_seconds": self.capacity_seconds,
+            "outstanding_seconds": self.outstanding_seconds,
+            "utilization": self.outstanding_seconds / self.capacity_seconds if self.enabled else 0.0,
+            "inflight": self.inflight,
+            "queued": len(self.waiters),
+            "queued_seconds": queued_seconds,
+            "max_queue": self.max_queue,
+            "saturated": self.enabled and len(self.waiters) >= self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "retry_after": self.retry_after() if self.waiters else 0,
+        }
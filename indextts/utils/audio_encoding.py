@@ -0,0 +1,154 @@
+import asyncio
+import io
+import shutil
+import struct
+import subprocess
+from typing import AsyncIterator, List
+
+import numpy as np
+import soundfile as sf
+
+from indextts.utils.metrics import stage_timer
+
+# 流式输出的采样格式 -> Content-Type 中的 format：pcm16 为 int16 小端（默认，带宽是 float32 的一半），
+# float32 为 [-1, 1] 范围的 float32 小端（Web Audio API 可直接使用）
+SAMPLE_FORMATS = {"pcm16": "S16LE", "float32": "F32LE"}
+
+# 可选的分帧头，每个音频块前加 12 字节：seq、本块采样点数、句子序号，均为 uint32 小端
+# 客户端可以据此检查丢块，并知道句子边界
+FRAME_HEADER = struct.Struct("<III")
+
+
+def encode_pcm_chunk(pcm_data: np.ndarray, sample_format="pcm16") -> memoryview:
+    """int16 音频块 -> 直接引用 numpy buffer 的 memoryview，pcm16 时不发生拷贝
+
+    Args:
+        pcm_data (np.ndarray): int16 samples, as yielded by IndexTTS.stream_infer.
+        sample_format (str): one of SAMPLE_FORMATS.
+    """
+    with stage_timer("encode"):
+        if sample_format == "float32":
+            pcm_data = np.multiply(pcm_data, 1.0 / 32767.0, dtype="<f4")
+        else:
+            pcm_data = pcm_data.astype("<i2", copy=False)
+        return memoryview(np.ascontiguousarray(pcm_data)).cast("B")
+
+
+def raw_media_type(sample_rate: int, sample_format="pcm16") -> str:
+    return f"audio/x-raw; format={SAMPLE_FORMATS[sample_format]}; rate={sample_rate}; channels=1"
+
+
+# /audio/speech 的 response_format -> media type，pcm 与 OpenAI 一致为 24kHz 16bit 小端单声道、不带文件头
+RESPONSE_FORMATS = {
+    "mp3": "audio/mpeg",
+    "opus": "audio/ogg",
+    "aac": "audio/aac",
+    "flac": "audio/flac",
+    "wav": "audio/wav",
+    "pcm": "audio/pcm",
+}
+
+# ffmpeg 的输出参数，opus 使用 ogg 封装，aac 使用可直接拼接的 adts
+FFMPEG_OUTPUT_ARGS = {
+    "mp3": ["-c:a", "libmp3lame", "-b:a", "64k", "-f", "mp3"],
+    "opus": ["-c:a", "libopus", "-b:a", "32k", "-f", "ogg"],
+    "aac": ["-c:a", "aac", "-b:a", "64k", "-f", "adts"],
+    "flac": ["-c:a", "flac", "-f", "flac"],
+    "wav": ["-c:a", "pcm_s16le", "-f", "wav"],
+    "pcm": ["-c:a", "pcm_s16le", "-f", "s16le"],
+}
+
+MIN_SPEED, MAX_SPEED = 0.25, 4.0
+
+
+def atempo_filter(speed: float) -> str:
+    """speed -> ffmpeg atempo 滤镜链，单个 atempo 只支持 [0.5, 2.0]，超出范围时串联多个"""
+    factors = []
+    while speed > 2.0:
+        factors.append(2.0)
+        speed /= 2.0
+    while speed < 0.5:
+        factors.append(0.5)
+        speed /= 0.5
+    factors.append(speed)
+    return ",".join(f"atempo={factor:.6g}" for factor in factors)
+
+
+def ffmpeg_args(sample_rate: int, response_format: str, speed=1.0) -> List[str]:
+    """int16 单声道 pcm 从 stdin 输入、编码结果写到 stdout 的 ffmpeg 命令行"""
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        raise RuntimeError(f"ffmpeg is required for response_format={response_format} / speed={speed}")
+    args = [ffmpeg, "-hide_banner", "-loglevel", "error",
+            "-f", "s16le", "-ar", str(sample_rate), "-ac", "1", "-i", "pipe:0"]
+    if speed != 1.0:
+        args += ["-filter:a", atempo_filter(speed)]
+    return args + FFMPEG_OUTPUT_ARGS[response_format] + ["-flush_packets", "1", "pipe:1"]
+
+
+def validate_response_format(response_format: str, speed: float):
+    if response_format not in RESPONSE_FORMATS:
+        raise ValueError(f"invalid response_format: {response_format}, expected one of {list(RESPONSE_FORMATS)}")
+    if not MIN_SPEED <= speed <= MAX_SPEED:
+        raise ValueError(f"invalid speed: {speed}, expected a value in [{MIN_SPEED}, {MAX_SPEED}]")
+
+
+def encode_audio(pcm_data: np.ndarray, sample_rate: int, response_format="wav", speed=1.0) -> bytes:
+    """int16 音频 -> response_format 编码后的完整文件，阻塞调用，应放在 audio_io 线程池中执行
+
+    wav / flac / pcm 且不变速时直接用 soundfile / numpy，其余经 ffmpeg 编码。
+    """
+    with stage_timer("encode"):
+        if speed == 1.0 and response_format == "pcm":
+            return pcm_data.astype("<i2", copy=False).tobytes()
+        if speed == 1.0 and response_format in ["wav", "flac"]:
+            with io.BytesIO() as buffer:
+                sf.write(buffer, pcm_data, sample_rate, format=response_format.upper(), subtype="PCM_16")
+                return buffer.getvalue()
+        result = subprocess.run(ffmpeg_args(sample_rate, response_format, speed),
+                                input=memoryview(np.ascontiguousarray(pcm_data, dtype="<i2")).cast("B"),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+        if result.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed: {result.stderr.decode(errors='ignore').strip()}")
+        return result.stdout
+
+
+async def stream_encoded_audio(pcm_chunks: AsyncIterator[np.ndarray], sample_rate: int, response_format="pcm",
+                               speed=1.0, read_size=16 * 1024):
+    """把逐句产生的 int16 音频块送入一个持续运行的 ffmpeg 进程，边编码边 yield 编码结果
+
+    整个请求共用一个编码器，mp3 / opus / aac / flac 输出是一个完整连续的流，变速也不会在句子边界处断开。
+    编码在 ffmpeg 子进程中进行，不占用事件循环。pcm 且不变速时直接输出原始数据。
+    """
+    if speed == 1.0 and response_format == "pcm":
+        async for pcm_data in pcm_chunks:
+            yield encode_pcm_chunk(pcm_data, "pcm16")
+        return
+
+    process = await asyncio.create_subprocess_exec(*ffmpeg_args(sample_rate, response_format, speed),
+                                                   stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.DEVNULL)
+
+    async def feed():
+        try:
+            async for pcm_data in pcm_chunks:
+                process.stdin.write(encode_pcm_chunk(pcm_data, "pcm16"))
+                await process.stdin.drain()
+        finally:
+            process.stdin.close()
+
+    feeder = asyncio.ensure_future(feed())
+    try:
+        while True:
+            data = await process.stdout.read(read_size)
+            if not data:
+                break
+            yield data
+        await feeder  # 推理出错 / 被取消时在这里抛出
+        if await process.wait() != 0:
+            raise RuntimeError(f"ffmpeg exited with code {process.returncode}")
+    finally:
+        feeder.cancel()
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
@@ -0,0 +1,256 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, Optional, Set
+from urllib.parse import unquote, urlparse
+
+import aiohttp
+
+
+class AudioFetcher:
+    """参考音频 URL 的异步下载器与磁盘缓存
+
+    - 共享一个 aiohttp.ClientSession（连接池），不阻塞事件循环
+    - 文件按内容 sha256 命名，不同 URL 的同名文件不会互相覆盖，内容相同的 URL 共用一个文件
+      （conditioning 缓存也按音频内容 hash，命中后无需重新编码）
+    - URL -> 文件的索引保存在 index.json 中，重启后仍然有效；总大小超过 max_bytes 时按 LRU 淘汰
+    - 缓存超过 revalidate_after 秒后，用 ETag / Last-Modified 发送条件请求，304 时直接复用；
+      源站不可达时继续使用旧文件
+    - 同一 URL 的并发请求只下载一次
+    - acquire() 返回的文件在 release() 之前不会被删除：被淘汰 / 替换时只从索引中移除，
+      最后一个使用者 release 后再删除
+    """
+
+    def __init__(self, cache_dir: str, max_bytes=1024 * 1024 * 1024, max_file_bytes=64 * 1024 * 1024,
+                 revalidate_after=60.0, timeout=30.0, max_connections=32, executor=None):
+        """
+        Args:
+            cache_dir (str): directory holding the downloaded files and index.json.
+            max_bytes (int): total size of the cached files, least recently used URLs are evicted beyond it.
+            max_file_bytes (int): downloads larger than this are rejected.
+            revalidate_after (float): seconds a cached URL is used without asking the server. 0 revalidates on
+                every request.
+            timeout (float): total timeout in seconds of one download.
+            max_connections (int): connection pool size of the aiohttp session.
+            executor (None | Executor): pool for the blocking file writes, None uses the loop's default executor.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.revalidate_after = revalidate_after
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.executor = executor
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.index_path = os.path.join(self.cache_dir, "index.json")
+
+        # url -> {"digest", "file", "size", "etag", "last_modified", "validated_at"}，按最近使用顺序排列
+        self.entries: "OrderedDict[str, dict]" = OrderedDict()
+        self.total_bytes = 0
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.readers: Dict[str, int] = {}  # file -> 持有该文件的 acquire 次数
+        self.orphans: Set[str] = set()  # 已不在索引中、等待最后一个使用者 release 后删除的文件
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.evictions = 0
+        self._load_index()
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as ex:
+            print(f">> ignore broken audio cache index {self.index_path}: {ex}")
+            return
+        for url, entry in entries:
+            if not os.path.exists(os.path.join(self.cache_dir, entry["file"])):
+                continue
+            self.entries[url] = entry
+        self.total_bytes = sum(entry["size"] for entry in self._files().values())
+
+    def _files(self) -> Dict[str, dict]:
+        """file -> entry，多个 URL 指向同一文件时只计一次大小"""
+        return {entry["file"]: entry for entry in self.entries.values()}
+
+    def _save_index(self, entries):
+        tmp_path = f"{self.index_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)
+
+    async def _run_blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def stats(self) -> dict:
+        requests = self.hits + self.revalidated + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits + self.revalidated) / requests if requests else 0.0,
+        }
+
+    async def fetch(self, url: str) -> str:
+        """返回 url 对应的本地文件路径，必要时下载"""
+        future = self.inflight.get(url)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = asyncio.ensure_future(self._fetch(url))
+        self.inflight[url] = future
+        future.add_done_callback(lambda _: self.inflight.pop(url, None))
+        # shield：某个调用方被取消时不影响其他等待同一下载的请求
+        return await asyncio.shield(future)
+
+    async def acquire(self, url: str) -> str:
+        """与 fetch 相同，但返回的文件在 release(path) 之前不会被淘汰删除"""
+        for _ in range(3):
+            path = await self.fetch(url)
+            # fetch 返回到这里之间其它请求可能已把文件淘汰删除，此时重新获取
+            if os.path.exists(path):
+                file = os.path.basename(path)
+                self.readers[file] = self.readers.get(file, 0) + 1
+                return path
+        raise FileNotFoundError(f"cached audio evicted while fetching, url={url}")
+
+    def release(self, path: str):
+        file = os.path.basename(path)
+        if file not in self.readers:
+            return
+        count = self.readers[file] - 1
+        if count > 0:
+            self.readers[file] = count
+            return
+        self.readers.pop(file, None)
+        if file in self.orphans:
+            self.orphans.discard(file)
+            self._delete_file(file)
+
+    async def _fetch(self, url: str) -> str:
+        entry = self.entries.get(url)
+        headers = {}
+        if entry is not None:
+            self.entries.move_to_end(url)
+            if time.time() - entry["validated_at"] < self.revalidate_after:
+                self.hits += 1
+                return os.path.join(self.cache_dir, entry["file"])
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        try:
+            async with self._get_session().get(url, headers=headers) as response:
+                if entry is not None and response.status == 304:
+                    self.revalidated += 1
+                    entry["validated_at"] = time.time()
+                    return os.path.join(self.cache_dir, entry["file"])
+                response.raise_for_status()
+                if response.content_length is not None and response.content_length > self.max_file_bytes:
+                    raise ValueError(f"audio too large: {response.content_length} bytes, url={url}")
+                chunks, size = [], 0
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    size += len(chunk)
+                    if size > self.max_file_bytes:
+                        raise ValueError(f"audio larger than {self.max_file_bytes} bytes, url={url}")
+                    chunks.append(chunk)
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            if entry is None:
+                raise
+            # 源站暂时不可达时沿用缓存
+            print(f">> revalidate failed, use cached audio url={url}: {ex!r}")
+            self.hits += 1
+            return os.path.join(self.cache_dir, entry["file"])
+
+        data = b"".join(chunks)
+        digest = hashlib.sha256(data).hexdigest()
+        if entry is not None and entry["digest"] == digest and url in self.entries:
+            # 源站不支持条件请求、内容未变：只更新校验信息，不重写文件
+            self.revalidated += 1
+            entry.update(etag=etag, last_modified=last_modified, validated_at=time.time())
+            await self._run_blocking(self._save_index, list(self.entries.items()))
+            return os.path.join(self.cache_dir, entry["file"])
+
+        self.misses += 1
+        ext = os.path.splitext(unquote(urlparse(url).path))[1][:8] or ".wav"
+        file = f"{digest}{ext}"
+        path = os.path.join(self.cache_dir, file)
+        print(f">> downloaded audio url={url} path={path} ({size} bytes)")
+
+        self._remove(url)
+        if file in self.orphans:
+            # 等待删除的文件内容相同，直接重新纳入索引
+            self.orphans.discard(file)
+            self.total_bytes += size
+        elif file not in self._files():
+            await self._run_blocking(self._write_file, path, data)
+            self.total_bytes += size
+        self.entries[url] = {
+            "digest": digest,
+            "file": file,
+            "size": size,
+            "etag": etag,
+            "last_modified": last_modified,
+            "validated_at": time.time(),
+        }
+        self._evict(keep=url)
+        await self._run_blocking(self._save_index, list(self.entries.items()))
+        return path
+
+    @staticmethod
+    def _write_file(path, data):
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _remove(self, url):
+        """移除 url 的索引，对应文件不再被任何 URL 引用时删除；仍被 acquire 持有时推迟到 release"""
+        entry = self.entries.pop(url, None)
+        if entry is None or entry["file"] in self._files():
+            return
+        self.total_bytes -= entry["size"]
+        if self.readers.get(entry["file"]):
+            self.orphans.add(entry["file"])
+        else:
+            self._delete_file(entry["file"])
+
+    def _delete_file(self, file):
+        try:
+            os.remove(os.path.join(self.cache_dir, file))
+        except OSError:
+            pass
+
+    def _evict(self, keep: str):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            url = next(iter(self.entries))
+            if url == keep:
+                break
+            self._remove(url)
+            self.evictions += 1
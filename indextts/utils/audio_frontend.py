@@ -0,0 +1,87 @@
+import io
+import threading
+from typing import Dict, List, Tuple, Union
+
+import soundfile as sf
+import torch
+import torchaudio
+from torch.nn.utils.rnn import pad_sequence
+
+from indextts.utils.feature_extractors import MelSpectrogramFeatures
+
+
+class AudioFrontend:
+    """参考音频预处理：解码 -> 单声道 -> 重采样到 24k -> mel
+
+    重采样器按源采样率缓存（Resample 在构造时计算 sinc kernel），mel 的 filterbank 与窗函数常驻在 device 上，
+    解码之后的计算都在 device 上完成，多段音频的 mel 在一个 batch 中计算。
+    """
+
+    def __init__(self, device, sample_rate=24000):
+        """
+        Args:
+            device (str | torch.device): device the resampling and mel extraction run on.
+            sample_rate (int): target sample rate of the mel extractor.
+        """
+        self.device = device
+        self.sample_rate = sample_rate
+        self.mel_extractor = MelSpectrogramFeatures(sample_rate=sample_rate).to(device).eval()
+        self.hop_length = self.mel_extractor.mel_spec.hop_length
+        self._resamplers: Dict[int, torchaudio.transforms.Resample] = {}
+        self._lock = threading.Lock()
+
+    def load(self, source: Union[str, bytes]) -> Tuple[torch.Tensor, int]:
+        """解码为 (1, t) 的 float32 单声道波形（cpu），返回 (audio, sr)
+
+        优先用 soundfile 直接解码为 float32 numpy 并零拷贝转为 tensor；soundfile 不支持的格式回退到 torchaudio。
+        """
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
+        try:
+            data, sr = sf.read(source, dtype="float32", always_2d=True)  # (t, channels)
+            audio = torch.from_numpy(data).T
+        except RuntimeError:  # soundfile.LibsndfileError
+            if isinstance(source, io.BytesIO):
+                source.seek(0)
+            audio, sr = torchaudio.load(source)
+        if audio.shape[0] > 1:
+            audio = torch.mean(audio, dim=0, keepdim=True)
+        return audio, sr
+
+    def get_resampler(self, sr: int) -> torchaudio.transforms.Resample:
+        resampler = self._resamplers.get(sr)
+        if resampler is None:
+            with self._lock:
+                resampler = self._resamplers.get(sr)
+                if resampler is None:
+                    resampler = torchaudio.transforms.Resample(sr, self.sample_rate).to(self.device)
+                    self._resamplers[sr] = resampler
+        return resampler
+
+    def resample(self, audio: torch.Tensor, sr: int) -> torch.Tensor:
+        audio = audio.to(self.device, non_blocking=True)
+        if sr == self.sample_rate:
+            return audio
+        return self.get_resampler(sr)(audio)
+
+    @torch.no_grad()
+    def mel(self, audios: List[torch.Tensor]) -> List[torch.Tensor]:
+        """多段 (1, t) 的 24k 波形在一个 batch 中计算 mel
+
+        短音频末尾补零，与单独计算相比只有最后 n_fft / hop_length / 2 帧内的窗口会看到补零部分。
+
+        Returns:
+            list[Tensor]: mels of shape (1, 100, frames), one per input.
+        """
+        if len(audios) == 1:
+            return [self.mel_extractor(audios[0])]
+        num_frames = [audio.shape[-1] // self.hop_length + 1 for audio in audios]
+        batch = pad_sequence([audio.squeeze(0) for audio in audios], batch_first=True)  # (n, t)
+        mels = self.mel_extractor(batch)  # (n, 100, frames)
+        return [mels[i:i + 1, :, :frames] for i, frames in enumerate(num_frames)]
+
+    @torch.no_grad()
+    def compute_mels(self, sources: List[Union[str, bytes]]) -> List[torch.Tensor]:
+        """参考音频路径（或文件内容）-> 各自的 mel (1, 100, frames)，位于 self.device"""
+        audios = [self.resample(*self.load(source)) for source in sources]
+        return self.mel(audios)
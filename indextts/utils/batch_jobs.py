@@ -0,0 +1,320 @@
+import asyncio
+import json
+import os
+import time
+import traceback
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from indextts.utils.audio_encoding import encode_audio
+
+# 离线批量任务的输出格式（不经 ffmpeg）
+BATCH_OUTPUT_FORMATS = ["wav", "flac"]
+
+
+class BatchJob:
+    """一个批量合成任务的状态，持久化在 jobs_dir/<job_id>/ 下
+
+    - job.json: 任务参数与状态
+    - manifest.jsonl: 全部条目，每行 {"id", "text", "character" | "audio_paths", "output"?, 采样参数...}
+    - progress.jsonl: 每完成 / 失败一条追加一行，重启后据此跳过已完成的条目
+    """
+
+    def __init__(self, job_id: str, job_dir: str, output_dir: str, response_format="wav", created_at=None,
+                 status="queued"):
+        self.id = job_id
+        self.job_dir = job_dir
+        self.output_dir = output_dir
+        self.response_format = response_format
+        self.created_at = created_at or time.time()
+        self.status = status  # queued / running / finished / cancelled
+        self.items: List[dict] = []
+        self.done: Dict[str, dict] = {}
+        self.failed: Dict[str, str] = {}
+        self.audio_seconds = 0.0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.completed_this_run = 0
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def job_path(self):
+        return os.path.join(self.job_dir, "job.json")
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.job_dir, "manifest.jsonl")
+
+    @property
+    def progress_path(self):
+        return os.path.join(self.job_dir, "progress.jsonl")
+
+    def output_path(self, item: dict) -> str:
+        name = os.path.basename(item.get("output") or f"{item['id']}.{self.response_format}")
+        return os.path.join(self.output_dir, name)
+
+    def pending_items(self) -> List[dict]:
+        return [item for item in self.items if item["id"] not in self.done]
+
+    def save(self):
+        tmp_path = f"{self.job_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "id": self.id,
+                "output_dir": self.output_dir,
+                "response_format": self.response_format,
+                "created_at": self.created_at,
+                "status": self.status,
+            }, f, ensure_ascii=False)
+        os.replace(tmp_path, self.job_path)
+
+    def save_manifest(self):
+        with open(self.manifest_path, "w", encoding="utf-8") as f:
+            for item in self.items:
+                f.write(json.dumps(item, ensure_ascii=False) + "\n")
+
+    @classmethod
+    def load(cls, job_dir: str) -> "BatchJob":
+        with open(os.path.join(job_dir, "job.json"), "r", encoding="utf-8") as f:
+            info = json.load(f)
+        job = cls(info["id"], job_dir, info["output_dir"], response_format=info["response_format"],
+                  created_at=info["created_at"], status=info["status"])
+        with open(job.manifest_path, "r", encoding="utf-8") as f:
+            job.items = [json.loads(line) for line in f if line.strip()]
+        if os.path.exists(job.progress_path):
+            with open(job.progress_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # 崩溃时写了一半的行
+                    job.record(record)
+        # 输出文件已被删除的条目重新合成
+        for item_id, record in list(job.done.items()):
+            if not os.path.exists(os.path.join(job.output_dir, record["file"])):
+                job.done.pop(item_id)
+                job.audio_seconds -= record["audio_seconds"]
+        return job
+
+    def record(self, record: dict):
+        if record["status"] == "done":
+            self.done[record["id"]] = record
+            self.failed.pop(record["id"], None)
+            self.audio_seconds += record["audio_seconds"]
+        else:
+            self.failed[record["id"]] = record["error"]
+
+    def append_progress(self, record: dict):
+        with open(self.progress_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+
+    def stats(self) -> dict:
+        total = len(self.items)
+        elapsed = ((self.finished_at or time.time()) - self.started_at) if self.started_at else 0.0
+        rate = self.completed_this_run / elapsed if elapsed > 0 else 0.0
+        remaining = total - len(self.done)
+        return {
+            "id": self.id,
+            "status": self.status,
+            "output_dir": self.output_dir,
+            "response_format": self.response_format,
+            "created_at": self.created_at,
+            "total": total,
+            "done": len(self.done),
+            "failed": len(self.failed),
+            "pending": remaining - len(self.failed),
+            "progress": len(self.done) / total if total else 1.0,
+            "audio_seconds": self.audio_seconds,
+            "elapsed": elapsed,
+            "items_per_second": rate,
+            "eta_seconds": remaining / rate if rate > 0 and self.status == "running" else None,
+            "errors": dict(list(self.failed.items())[:20]),
+        }
+
+
+class BatchJobManager:
+    """离线批量合成：吞吐优先的调度
+
+    所有任务共用 max_concurrent_items 个名额，每个条目的所有分句同时提交给 vllm 引擎，
+    引擎与 VocoderBatcher 始终有足够多的句子可以凑满 batch；条目完成后立即编码写入输出目录，
+    并在 progress.jsonl 中追加一行。服务重启后 resume() 继续未完成的任务，已完成的条目不再合成。
+    """
+
+    def __init__(self, jobs_dir: str, synthesize: Callable[[dict], Awaitable[Tuple[int, np.ndarray]]],
+                 executor=None, max_concurrent_items=32, root=None):
+        """
+        Args:
+            jobs_dir (str): directory holding one sub directory per job.
+            synthesize (callable): async function item -> (sampling_rate, int16 wav), e.g. wrapping
+                IndexTTS.infer_with_ref_audio_embed / IndexTTS.infer.
+            executor (None | Executor): pool for encoding and file writes, None uses the loop's default executor.
+            max_concurrent_items (int): items being synthesized at the same time, shared by all jobs.
+            root (None | str): directory client supplied manifest and output paths are resolved under, paths
+                escaping it are rejected. None accepts any path.
+        """
+        self.jobs_dir = jobs_dir
+        self.synthesize = synthesize
+        self.executor = executor
+        self.max_concurrent_items = max_concurrent_items
+        self.root = os.path.realpath(root) if root else None
+        self.jobs: Dict[str, BatchJob] = {}
+        self._slots = None
+        os.makedirs(self.jobs_dir, exist_ok=True)
+
+    async def _run_blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def resolve(self, path: str) -> str:
+        """客户端传入的路径：相对路径相对 root，解析符号链接后不在 root 之下时抛出 ValueError"""
+        if self.root is None:
+            return os.path.abspath(path)
+        resolved = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath([self.root, resolved]) != self.root:
+            raise ValueError(f"path {path!r} is outside of the batch root")
+        return resolved
+
+    def get(self, job_id: str) -> Optional[BatchJob]:
+        return self.jobs.get(job_id)
+
+    def list_jobs(self) -> List[dict]:
+        return [job.stats() for job in sorted(self.jobs.values(), key=lambda job: job.created_at)]
+
+    async def submit(self, items: List[dict], output_dir: str, response_format="wav") -> BatchJob:
+        """创建任务并开始执行
+
+        Args:
+            items (list[dict]): manifest entries, each with "text" and either "character" or "audio_paths".
+                "id" defaults to the line number, "output" to "<id>.<response_format>".
+            output_dir (str): directory the audio files are written to, resolved with resolve(). Each item's
+                "audio_paths" are resolved the same way and saved resolved in the job manifest.
+            response_format (str): one of BATCH_OUTPUT_FORMATS.
+        """
+        if response_format not in BATCH_OUTPUT_FORMATS:
+            raise ValueError(f"invalid response_format: {response_format}, expected one of {BATCH_OUTPUT_FORMATS}")
+        if len(items) == 0:
+            raise ValueError("empty manifest")
+        job_id = uuid.uuid4().hex[:16]
+        job = BatchJob(job_id, os.path.join(self.jobs_dir, job_id), self.resolve(output_dir), response_format)
+        seen, outputs = set(), {}
+        for index, item in enumerate(items):
+            if not isinstance(item, dict) or not item.get("text"):
+                raise ValueError(f"manifest line {index}: text is required")
+            item = {**item, "id": str(item.get("id", f"{index:06d}"))}
+            if item["id"] in seen:
+                raise ValueError(f"manifest line {index}: duplicated id {item['id']}")
+            seen.add(item["id"])
+            if item.get("audio_paths") is not None:
+                # 参考音频同样是服务器上的路径，解析后写入 manifest，resume 时不再依赖 root
+                if not isinstance(item["audio_paths"], list):
+                    raise ValueError(f"manifest line {index}: audio_paths must be a list")
+                item["audio_paths"] = [self.resolve(path) for path in item["audio_paths"]]
+            # 输出文件名重复时后完成的条目会覆盖先完成的，且 progress 中两条都记为完成
+            output = os.path.basename(job.output_path(item))
+            if output in ["", ".", ".."]:
+                raise ValueError(f"manifest line {index}: invalid output {item.get('output')!r}")
+            if output in outputs:
+                raise ValueError(f"manifest line {index}: output {output} is also written by item {outputs[output]}")
+            outputs[output] = item["id"]
+            job.items.append(item)
+
+        def create():
+            os.makedirs(job.job_dir, exist_ok=True)
+            os.makedirs(job.output_dir, exist_ok=True)
+            job.save_manifest()
+            job.save()
+        await self._run_blocking(create)
+        self.jobs[job_id] = job
+        self._start(job)
+        return job
+
+    async def resume(self):
+        """服务启动时加载 jobs_dir 中的任务，继续执行未完成（queued / running）的任务"""
+        for job_id in sorted(os.listdir(self.jobs_dir)):
+            job_dir = os.path.join(self.jobs_dir, job_id)
+            if job_id in self.jobs or not os.path.exists(os.path.join(job_dir, "job.json")):
+                continue
+            try:
+                job = await self._run_blocking(BatchJob.load, job_dir)
+            except (OSError, ValueError, KeyError) as ex:
+                print(f">> ignore broken batch job {job_dir}: {ex!r}")
+                continue
+            self.jobs[job_id] = job
+            if job.status in ["queued", "running"]:
+                print(f">> resume batch job {job_id}: {len(job.done)}/{len(job.items)} done")
+                self._start(job)
+
+    def restart(self, job_id: str) -> BatchJob:
+        """重新执行已取消 / 已结束任务中未完成与失败的条目"""
+        job = self.jobs[job_id]
+        if job.task is None or job.task.done():
+            job.failed.clear()
+            self._start(job)
+        return job
+
+    async def cancel(self, job_id: str) -> BatchJob:
+        job = self.jobs[job_id]
+        if job.task is not None and not job.task.done():
+            job.task.cancel()
+            try:
+                await job.task
+            except asyncio.CancelledError:
+                pass
+        job.status = "cancelled"
+        job.finished_at = time.time()
+        await self._run_blocking(job.save)
+        return job
+
+    def _start(self, job: BatchJob):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrent_items)
+        job.task = asyncio.ensure_future(self._run(job))
+
+    async def _run(self, job: BatchJob):
+        job.status = "running"
+        job.started_at = time.time()
+        job.finished_at = None
+        job.completed_this_run = 0
+        await self._run_blocking(job.save)
+        tasks = set()
+        try:
+            for item in job.pending_items():
+                await self._slots.acquire()
+                task = asyncio.ensure_future(self._run_item(job, item))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda _: self._slots.release())
+            await asyncio.gather(*tasks)
+        finally:
+            for task in list(tasks):
+                task.cancel()
+        job.status = "finished"
+        job.finished_at = time.time()
+        await self._run_blocking(job.save)
+        print(f">> batch job {job.id} finished: {len(job.done)} done, {len(job.failed)} failed, "
+              f"{job.audio_seconds:.1f}s audio in {job.finished_at - job.started_at:.1f}s")
+
+    async def _run_item(self, job: BatchJob, item: dict):
+        try:
+            sr, wav = await self.synthesize(item)
+            path = job.output_path(item)
+
+            def write():
+                data = encode_audio(wav, sr, job.response_format)
+                tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            await self._run_blocking(write)
+            record = {"id": item["id"], "status": "done", "file": os.path.basename(path),
+                      "audio_seconds": len(wav) / sr}
+            job.completed_this_run += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            traceback.print_exc()
+            record = {"id": item["id"], "status": "failed", "error": f"{type(ex).__name__}: {ex}"}
+        job.record(record)
+        await self._run_blocking(job.append_progress, record)
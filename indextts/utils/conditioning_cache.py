@@ -0,0 +1,82 @@
+import hashlib
+from collections import OrderedDict
+from typing import List
+
+import torch
+
+
+def hash_audio_files(audio_paths: List[str], prefix: str = "") -> str:
+    """按参考音频的文件内容（而非路径）计算 sha256，同一段音频换了路径/文件名也能命中"""
+    h = hashlib.sha256(prefix.encode())
+    for audio_path in audio_paths:
+        with open(audio_path, "rb") as f:
+            data = f.read()
+        h.update(len(data).to_bytes(8, "little"))
+        h.update(data)
+    return h.hexdigest()
+
+
+def _entry_nbytes(value) -> int:
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, (list, tuple)):
+        return sum(_entry_nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(_entry_nbytes(v) for v in value.values())
+    return 0
+
+
+class ConditioningCache:
+    """参考音频特征（mel、gpt conditioning latent、bigvgan 说话人向量）的内存 LRU 缓存
+
+    key 为参考音频内容的 hash，同时按条目数和显存/内存占用字节数限制容量，超出时淘汰最久未使用的条目。
+    """
+
+    def __init__(self, max_entries=64, max_bytes=512 * 1024 * 1024):
+        """
+        Args:
+            max_entries (int): maximum number of cached entries. 0 disables the cache.
+            max_bytes (int): maximum total size in bytes of the cached tensors.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (entry, nbytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str):
+        item = self._entries.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def put(self, key: str, entry: dict):
+        nbytes = _entry_nbytes(entry)
+        if self.max_entries <= 0 or nbytes > self.max_bytes:
+            return
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[1]
+        self._entries[key] = (entry, nbytes)
+        self.nbytes += nbytes
+        while len(self._entries) > self.max_entries or self.nbytes > self.max_bytes:
+            _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= evicted_nbytes
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total > 0 else 0.0,
+        }
@@ -0,0 +1,43 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class InferenceExecutors:
+    """把阻塞的 CPU / GPU 计算从 asyncio 事件循环中移到专用线程池
+
+    - audio_io: 参考音频 hash / 下载、wav 编码写出等 IO 与轻量 CPU 任务
+    - conditioning: 参考音频 -> mel / conditioning latent / 说话人向量
+    - vocoder: bigvgan 解码（以及 use_vllm_latent=False 时的 latent forward）
+
+    事件循环只负责调度与网络收发，某个请求在做 bigvgan 时其它请求仍可以把 token 送进 vllm、发送流式数据。
+    注意 torch.no_grad 的状态是线程级的，提交到这里的函数需要自己带上 no_grad。
+    """
+
+    def __init__(self, audio_io_workers=4, conditioning_workers=1, vocoder_workers=1):
+        """
+        Args:
+            audio_io_workers (int): threads for audio decoding / encoding and file IO.
+            conditioning_workers (int): threads for reference audio conditioning.
+            vocoder_workers (int): threads for BigVGAN. Kept at 1 so vocoder batches run one at a time on the GPU.
+        """
+        self.audio_io = ThreadPoolExecutor(max_workers=audio_io_workers, thread_name_prefix="audio_io")
+        self.conditioning = ThreadPoolExecutor(max_workers=conditioning_workers, thread_name_prefix="conditioning")
+        self.vocoder = ThreadPoolExecutor(max_workers=vocoder_workers, thread_name_prefix="vocoder")
+
+    @staticmethod
+    async def run(executor, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+    async def run_audio_io(self, func, *args, **kwargs):
+        return await self.run(self.audio_io, func, *args, **kwargs)
+
+    async def run_conditioning(self, func, *args, **kwargs):
+        return await self.run(self.conditioning, func, *args, **kwargs)
+
+    async def run_vocoder(self, func, *args, **kwargs):
+        return await self.run(self.vocoder, func, *args, **kwargs)
+
+    def shutdown(self):
+        for executor in [self.audio_io, self.conditioning, self.vocoder]:
+            executor.shutdown(wait=False, cancel_futures=True)
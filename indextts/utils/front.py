@@ -2,6 +2,7 @@
 import os
 import traceback
 import re
+from contextlib import nullcontext
 from typing import List, Union, overload
 import warnings
 from indextts.utils.common import tokenize_by_CJK_char, de_tokenized_by_CJK_char
@@ -230,9 +231,17 @@ class TextNormalizer:
 
 
 class TextTokenizer:
-    def __init__(self, vocab_file: str, normalizer: TextNormalizer = None):
+    def __init__(self, vocab_file: str, normalizer: TextNormalizer = None, stage_timer=None):
+        """
+        Args:
+            vocab_file (str): sentencepiece model.
+            normalizer (None | TextNormalizer): applied before tokenizing.
+            stage_timer (None | callable): stage name -> context manager timing that stage, e.g.
+                indextts.utils.metrics.stage_timer. None records nothing.
+        """
         self.vocab_file = vocab_file
         self.normalizer = normalizer
+        self.stage_timer = stage_timer or (lambda stage: nullcontext())
 
         if self.vocab_file is None:
             raise ValueError("vocab_file is None")
@@ -321,11 +330,13 @@ class TextTokenizer:
             return self.sp_model.Encode(text, out_type=kwargs.pop("out_type", int), **kwargs)
         # 预处理
         if self.normalizer:
-            text = self.normalizer.normalize(text)
-        if len(self.pre_tokenizers) > 0:
-            for pre_tokenizer in self.pre_tokenizers:
-                text = pre_tokenizer(text)
-        return self.sp_model.Encode(text, out_type=kwargs.pop("out_type", int), **kwargs)
+            with self.stage_timer("normalize"):
+                text = self.normalizer.normalize(text)
+        with self.stage_timer("tokenize"):
+            if len(self.pre_tokenizers) > 0:
+                for pre_tokenizer in self.pre_tokenizers:
+                    text = pre_tokenizer(text)
+            return self.sp_model.Encode(text, out_type=kwargs.pop("out_type", int), **kwargs)
 
     def batch_encode(self, texts: List[str], **kwargs):
         # 预处理
@@ -428,6 +439,144 @@ class TextTokenizer:
             tokenized, self.punctuation_marks_tokens, max_tokens_per_sentence=max_tokens_per_sentence
         )
 
+    # 子句边界（中文的 ，；：、 在 normalize 后都是 ,）
+    clause_marks_tokens = [",", "▁,"]
+
+    def split_clauses(self, tokenized: List[str], max_tokens_per_sentence=120) -> List[List[str]]:
+        """按句末标点与逗号切成子句，不合并相邻子句；超长子句按 split_sentences 的规则继续切分"""
+        split_tokens = self.punctuation_marks_tokens + self.clause_marks_tokens
+        clauses: List[List[str]] = []
+        current_clause = []
+        split_after_quote = False
+        for i, token in enumerate(tokenized):
+            current_clause.append(token)
+            if split_after_quote:
+                # 标点后紧随的 '（引号、撇号）归入前一子句，在其后切分
+                split_after_quote = False
+            elif token not in split_tokens or len(current_clause) <= 2:
+                continue
+            elif i < len(tokenized) - 1 and tokenized[i + 1] in ["'", "▁'"]:
+                split_after_quote = True
+                continue
+            clauses.append(current_clause)
+            current_clause = []
+        if current_clause:
+            clauses.append(current_clause)
+
+        result = []
+        for clause in clauses:
+            if len(clause) <= max_tokens_per_sentence:
+                result.append(clause)
+            else:
+                result.extend(self.split_sentences(clause, max_tokens_per_sentence=max_tokens_per_sentence))
+        return result
+
+    def split_sentences_fast_first(self, tokenized: List[str], first_max_tokens=24, growth=2.0,
+                                   max_tokens_per_sentence=120) -> List[List[str]]:
+        """流式场景的分句：首段尽量短，后续分段逐步变长
+
+        首段在不超过 first_max_tokens 的前提下合并尽量多的子句（第一个子句本身更长时取整个子句），
+        之后每段的长度上限乘以 growth，直到 max_tokens_per_sentence。首段很快生成完，后续较长的分段
+        在前面的音频播放期间解码完成，既降低首包延迟，又不至于因分段过碎损失吞吐。
+
+        Args:
+            first_max_tokens (int): token budget of the first segment.
+            growth (float): factor the budget grows by for each following segment.
+            max_tokens_per_sentence (int): upper bound of every segment, as in split_sentences.
+        """
+        clauses = self.split_clauses(tokenized, max_tokens_per_sentence=max_tokens_per_sentence)
+        if len(clauses) == 0:
+            return []
+        segments = [clauses[0]]
+        limit = first_max_tokens
+        for clause in clauses[1:]:
+            if len(segments[-1]) + len(clause) <= limit:
+                segments[-1] = segments[-1] + clause
+            else:
+                segments.append(clause)
+                limit = min(max_tokens_per_sentence, max(limit + 1, int(limit * growth)))
+        return segments
+
+
+
+class IncrementalSentenceSplitter:
+    """增量分句：文本逐段到达（如上游 LLM 逐 token 输出）时，句子一完整就切出来，无需等待全文
+
+    原始文本在句末标点（。！？!?… 以及后接空白的 .）处确认边界：标点之后还需要再收到一个字符，
+    以便把紧随的引号、括号以及连续的标点并入当前句（对应 split_sentences_by_token 中后续为 ' 时不切分的规则）。
+    边界之前的文本经 tokenize 后按 TextTokenizer.split_sentences 的规则切分、合并。
+    长时间没有句末标点时，缓冲超过 max_pending_chars 个字符后在最后一个逗号类标点处切分，
+    超过 2 倍时整体切分（split_sentences 再按长度规则处理）。
+    """
+
+    SENTENCE_END_CHARS = "。！？!?…"
+    CLAUSE_END_CHARS = "，,；;：:、"
+    # 句末标点之后仍属于本句的字符：引号、括号等（normalize 后均为 '）
+    CLOSING_CHARS = "'\"”’）)」』》】]"
+
+    def __init__(self, tokenizer: TextTokenizer, max_tokens_per_sentence=120, max_pending_chars=120):
+        """
+        Args:
+            tokenizer (TextTokenizer): tokenizer whose normalizer and split rules are used.
+            max_tokens_per_sentence (int): same as in TextTokenizer.split_sentences.
+            max_pending_chars (int): buffered characters without a sentence end before cutting at a clause mark.
+        """
+        self.tokenizer = tokenizer
+        self.max_tokens_per_sentence = max_tokens_per_sentence
+        self.max_pending_chars = max_pending_chars
+        self.buffer = ""
+
+    def _find_sentence_end(self) -> int:
+        """返回已确认的最后一个句子边界（切分位置），没有时返回 0"""
+        text = self.buffer
+        cut = 0
+        i = 0
+        while i < len(text):
+            char = text[i]
+            is_end = char in self.SENTENCE_END_CHARS or (char == "." and i + 1 < len(text) and text[i + 1].isspace())
+            if not is_end:
+                i += 1
+                continue
+            j = i + 1
+            while j < len(text) and (text[j] in self.SENTENCE_END_CHARS or text[j] in self.CLOSING_CHARS or text[j] == "."):
+                j += 1
+            if j >= len(text):
+                # 边界之后还没有收到新的字符，可能还有引号 / 标点，等待下一段
+                break
+            cut = j
+            i = j
+        return cut
+
+    def _find_clause_end(self) -> int:
+        for i in range(len(self.buffer) - 1, -1, -1):
+            if self.buffer[i] in self.CLAUSE_END_CHARS:
+                return i + 1
+        return 0
+
+    def _split(self, text: str) -> List[List[str]]:
+        if not text.strip():
+            return []
+        tokenized = self.tokenizer.tokenize(text)
+        return self.tokenizer.split_sentences(tokenized, max_tokens_per_sentence=self.max_tokens_per_sentence)
+
+    def push(self, delta: str) -> List[List[str]]:
+        """追加一段文本，返回新切出的完整句子（tokenize 后的 token 列表），可能为空"""
+        self.buffer += delta
+        cut = self._find_sentence_end()
+        if cut == 0 and len(self.buffer) > self.max_pending_chars:
+            cut = self._find_clause_end()
+            if cut == 0 and len(self.buffer) > 2 * self.max_pending_chars:
+                cut = len(self.buffer)
+        if cut == 0:
+            return []
+        text, self.buffer = self.buffer[:cut], self.buffer[cut:]
+        return self._split(text)
+
+    def flush(self) -> List[List[str]]:
+        """文本结束：切出缓冲中剩余的文本"""
+        text, self.buffer = self.buffer, ""
+        return self._split(text)
+
 
 if __name__ == "__main__":
     # 测试程序
@@ -0,0 +1,28 @@
+# HTTP 请求中可以按请求覆盖的采样参数及其类型，对应 vllm SamplingParams 的同名字段，
+# max_silent_tokens / max_loop_tokens 为 RunawayStopLogitsProcessor 的阈值（0 关闭对应检查）
+GENERATION_CONFIG_TYPES = {
+    "seed": int,
+    "temperature": float,
+    "top_p": float,
+    "top_k": int,
+    "repetition_penalty": float,
+    "max_tokens": int,
+    "max_silent_tokens": int,
+    "max_loop_tokens": int,
+}
+
+
+def parse_generation_config(data: dict) -> dict:
+    """从请求体中取出采样参数字段，未传或为 null 的字段使用 UnifiedVoice 的默认值
+
+    Returns:
+        dict: generation_config accepted by UnifiedVoice.build_sampling_params.
+    """
+    generation_config = {}
+    for key, cast in GENERATION_CONFIG_TYPES.items():
+        if data.get(key) is not None:
+            try:
+                generation_config[key] = cast(data[key])
+            except (TypeError, ValueError):
+                raise ValueError(f"invalid {key}: {data[key]!r}")
+    return generation_config
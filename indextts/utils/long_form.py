@@ -0,0 +1,126 @@
+import json
+import os
+import struct
+import uuid
+
+import numpy as np
+import soundfile as sf
+
+# 长文本模式支持的输出格式
+LONG_FORM_FORMATS = ["wav", "flac"]
+
+# 16bit 单声道 PCM 的 44 字节 WAV 文件头
+WAV_HEADER = struct.Struct("<4sI4s4sIHHIIHH4sI")
+
+
+def wav_header(num_frames: int, sample_rate: int) -> bytes:
+    data_size = num_frames * 2
+    return WAV_HEADER.pack(b"RIFF", 36 + data_size, b"WAVE", b"fmt ", 16, 1, 1, sample_rate, sample_rate * 2, 2, 16,
+                           b"data", data_size)
+
+
+class LongFormWriter:
+    """长文本合成的顺序写出与断点续写
+
+    音频按句子顺序追加写入 <output>.part.wav（自行维护文件头），每写完一句更新文件头并 fsync，
+    再原子地写 <output>.progress.json（下一句的序号与已写入的采样点数）。重启后若 progress 中的
+    digest（文本、说话人、采样参数）与本次一致，则把 part 文件截断到已记录的采样点数，从下一句继续。
+    全部写完后 wav 直接改名为 output，flac 则分块转码，内存占用与音频总时长无关。
+    """
+
+    def __init__(self, output_path: str, digest: str, num_sentences: int, sample_rate=24000, block_frames=1 << 16):
+        """
+        Args:
+            output_path (str): final .wav / .flac file.
+            digest (str): identifies the text, speaker and sampling settings, a checkpoint with a different digest
+                is discarded.
+            num_sentences (int): number of sentences the text was split into.
+            sample_rate (int): sample rate of the audio.
+            block_frames (int): frames per block when transcoding to flac.
+        """
+        self.output_path = output_path
+        self.response_format = os.path.splitext(output_path)[1].lstrip(".").lower()
+        if self.response_format not in LONG_FORM_FORMATS:
+            raise ValueError(f"unsupported output format: {output_path}, expected one of {LONG_FORM_FORMATS}")
+        self.digest = digest
+        self.num_sentences = num_sentences
+        self.sample_rate = sample_rate
+        self.block_frames = block_frames
+        self.part_path = f"{output_path}.part.wav"
+        self.progress_path = f"{output_path}.progress.json"
+        self.next_sentence = 0
+        self.num_frames = 0
+        self.file = None
+
+    def open(self) -> int:
+        """打开（或续写）part 文件，返回下一句的序号"""
+        checkpoint = None
+        if os.path.exists(self.progress_path) and os.path.exists(self.part_path):
+            try:
+                with open(self.progress_path, "r", encoding="utf-8") as f:
+                    checkpoint = json.load(f)
+            except (OSError, ValueError):
+                checkpoint = None
+        if checkpoint is not None and checkpoint.get("digest") == self.digest \
+                and checkpoint.get("num_sentences") == self.num_sentences:
+            self.next_sentence = checkpoint["next_sentence"]
+            self.num_frames = checkpoint["num_frames"]
+            self.file = open(self.part_path, "r+b")
+            # 丢弃最后一次 checkpoint 之后写入的部分
+            self.file.truncate(WAV_HEADER.size + self.num_frames * 2)
+            self.file.seek(0, os.SEEK_END)
+            print(f">> resume long-form synthesis {self.output_path} from sentence "
+                  f"{self.next_sentence}/{self.num_sentences} ({self.num_frames / self.sample_rate:.1f}s written)")
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(self.output_path)), exist_ok=True)
+            self.next_sentence = 0
+            self.num_frames = 0
+            self.file = open(self.part_path, "w+b")
+            self.file.write(wav_header(0, self.sample_rate))
+            self._save_progress()
+        return self.next_sentence
+
+    def write(self, wav_data: np.ndarray):
+        """追加下一句的 int16 音频并记录 checkpoint"""
+        self.file.write(memoryview(np.ascontiguousarray(wav_data, dtype="<i2")).cast("B"))
+        self.num_frames += len(wav_data)
+        self.next_sentence += 1
+        self.file.seek(0)
+        self.file.write(wav_header(self.num_frames, self.sample_rate))
+        self.file.seek(0, os.SEEK_END)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self._save_progress()
+
+    def _save_progress(self):
+        tmp_path = f"{self.progress_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "digest": self.digest,
+                "num_sentences": self.num_sentences,
+                "next_sentence": self.next_sentence,
+                "num_frames": self.num_frames,
+            }, f)
+        os.replace(tmp_path, self.progress_path)
+
+    def finish(self) -> str:
+        """全部句子写完后生成最终文件，删除 part 与 progress 文件"""
+        self.close()
+        if self.response_format == "wav":
+            os.replace(self.part_path, self.output_path)
+        else:
+            tmp_path = f"{self.output_path}.{uuid.uuid4().hex}.tmp"
+            with sf.SoundFile(self.part_path, "r") as src, \
+                    sf.SoundFile(tmp_path, "w", samplerate=self.sample_rate, channels=1, format="FLAC",
+                                 subtype="PCM_16") as dst:
+                for block in src.blocks(blocksize=self.block_frames, dtype="int16"):
+                    dst.write(block)
+            os.replace(tmp_path, self.output_path)
+            os.remove(self.part_path)
+        os.remove(self.progress_path)
+        return self.output_path
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,73 @@
+import functools
+import inspect
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# 各阶段耗时，stage 取值见 STAGES
+STAGES = ["admission_wait", "normalize", "tokenize", "conditioning", "queue_wait", "decode", "latent", "vocoder", "encode",
+          "first_chunk"]
+
+STAGE_SECONDS = Histogram(
+    "indextts_stage_seconds", "Latency of each inference stage in seconds", ["stage"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+RTF = Histogram(
+    "indextts_rtf", "Real time factor of non-streaming requests",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 2.0),
+)
+VOCODER_BATCH_SIZE = Histogram(
+    "indextts_vocoder_batch_size", "Number of latents per BigVGAN forward",
+    buckets=(1, 2, 4, 8, 16, 32),
+)
+INFLIGHT_REQUESTS = Gauge("indextts_inflight_requests", "Requests currently being synthesized")
+INFLIGHT_SENTENCES = Gauge("indextts_inflight_sentences", "Sentences currently submitted to the vllm engine")
+AUDIO_SECONDS = Counter("indextts_audio_seconds", "Seconds of audio produced")
+ADMISSION_OUTSTANDING_SECONDS = Gauge("indextts_admission_outstanding_seconds", "Estimated seconds of audio admitted and not finished")
+ADMISSION_QUEUED = Gauge("indextts_admission_queued", "Requests waiting for admission")
+ADMISSION_REJECTED = Counter("indextts_admission_rejected", "Requests rejected with 429 by the admission controller")
+
+# 预先绑定 label，热路径上只剩一次 dict 查找和 observe
+_stage_histograms = {stage: STAGE_SECONDS.labels(stage) for stage in STAGES}
+
+
+def observe_stage(stage: str, seconds: float):
+    _stage_histograms[stage].observe(seconds)
+
+
+@contextmanager
+def stage_timer(stage: str):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        _stage_histograms[stage].observe(time.perf_counter() - start_time)
+
+
+def track_inflight_request(func):
+    """在 INFLIGHT_REQUESTS 中统计正在执行的请求，支持 async 函数与 async 生成器"""
+    if inspect.isasyncgenfunction(func):
+        @functools.wraps(func)
+        async def gen_wrapper(*args, **kwargs):
+            INFLIGHT_REQUESTS.inc()
+            try:
+                async for item in func(*args, **kwargs):
+                    yield item
+            finally:
+                INFLIGHT_REQUESTS.dec()
+        return gen_wrapper
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        INFLIGHT_REQUESTS.inc()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            INFLIGHT_REQUESTS.dec()
+    return wrapper
+
+
+def render_metrics():
+    """返回 (body, content_type)，供 /metrics 接口使用"""
+    return generate_latest(), CONTENT_TYPE_LATEST
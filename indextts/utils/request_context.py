@@ -0,0 +1,89 @@
+import asyncio
+import time
+from typing import Optional, Set
+
+
+class RequestCancelled(Exception):
+    """HTTP 请求已被取消（客户端断开或超过 deadline），其余句子不再生成"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class RequestContext:
+    """一次 HTTP 请求范围内的取消状态
+
+    记录该请求提交给 vllm 的所有 request_id（UnifiedVoice.inference_speech 中登记 / 注销），
+    客户端断开或超过 deadline 时统一调用引擎的 abort，同时让逐句循环在下一句开始前退出。
+    """
+
+    def __init__(self, timeout: Optional[float] = None):
+        """
+        Args:
+            timeout (None | float): seconds from now after which the request is aborted. None or <= 0 means no deadline.
+        """
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.request_ids: Set[str] = set()
+        self.cancel_reason: Optional[str] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_reason is not None
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def check(self):
+        """在提交下一句之前调用，已取消或超时则抛出 RequestCancelled"""
+        if self.cancel_reason is None and self.expired():
+            self.cancel_reason = "deadline exceeded"
+        if self.cancel_reason is not None:
+            raise RequestCancelled(self.cancel_reason)
+
+    async def abort(self, llm, reason: str):
+        """标记取消并 abort 所有仍在 vllm 中运行的请求"""
+        if self.cancel_reason is None:
+            self.cancel_reason = reason
+        for request_id in list(self.request_ids):
+            await llm.abort(request_id)
+        self.request_ids.clear()
+
+
+async def run_until_disconnected(request, coro, context: RequestContext, llm, poll_interval=0.2):
+    """执行 coro（一次完整的非流式推理），期间轮询客户端是否断开、是否超过 deadline
+
+    断开或超时时取消推理任务并 abort 该请求在 vllm 中的所有 request_id，抛出 RequestCancelled。
+
+    Args:
+        request: starlette Request, used for is_disconnected().
+        coro: the inference coroutine.
+        context (RequestContext): context passed to the same inference call.
+        llm: the AsyncLLMEngine the inference submits to.
+        poll_interval (float): seconds between disconnect checks.
+    """
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result()
+            if context.expired():
+                reason = "deadline exceeded"
+                break
+            if await request.is_disconnected():
+                reason = "client disconnected"
+                break
+    except asyncio.CancelledError:
+        reason = "handler cancelled"
+        task.cancel()
+        await context.abort(llm, reason)
+        raise
+
+    task.cancel()
+    await context.abort(llm, reason)
+    try:
+        await task
+    except (asyncio.CancelledError, Exception):
+        pass
+    raise RequestCancelled(reason)
@@ -0,0 +1,112 @@
+import hashlib
+import os
+import threading
+from collections.abc import Mapping
+from typing import List
+
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+from indextts.utils.conditioning_cache import hash_audio_files
+
+# 缓存特征的格式 / 计算方式（compute_conditioning、保存的字段）变化时加一，旧缓存自然失效
+FEATURE_VERSION = 1
+
+
+class LazySpeaker(Mapping):
+    """speaker_dict 中的一项：首次使用时才用 safe_open 从 safetensors 读出全部特征并搬到 device
+
+    load() 是阻塞的，异步代码应通过 IndexTTS.get_speaker 在线程池中调用；直接按 key 访问时在当前线程读取。
+    """
+
+    def __init__(self, path: str, device="cpu"):
+        self.path = path
+        self.device = device
+        self._entry = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._entry is not None
+
+    def load(self) -> dict:
+        with self._lock:
+            if self._entry is None:
+                with safe_open(self.path, framework="pt", device=str(self.device)) as f:
+                    tensors = {name: f.get_tensor(name) for name in f.keys()}
+                self._entry = {
+                    "auto_conditioning": SpeakerStore._unflatten(tensors, "auto_conditioning"),
+                    "speech_conditioning_latent": tensors["speech_conditioning_latent"],
+                    "speaker_embedding": tensors["speaker_embedding"],
+                    "speaker_conditioning": SpeakerStore._unflatten(tensors, "speaker_conditioning"),
+                }
+            return self._entry
+
+    def __getitem__(self, name):
+        return self.load()[name]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+
+class SpeakerStore:
+    """registry_speaker 计算结果的磁盘缓存
+
+    每个角色保存为一个 safetensors 文件，文件名为参考音频内容与模型 checkpoint 的 hash，
+    参考音频、模型权重或 FEATURE_VERSION 任一变化都会得到新的 key，旧文件自然失效。
+    启动时只需读取参考音频做 hash，命中后返回 LazySpeaker，角色第一次被使用时才从 safetensors 读出各项特征，
+    注册大量角色时启动不再被读取与拷贝到显存拖慢，未使用的角色也不占显存。
+    """
+
+    def __init__(self, store_dir: str, model_files: List[str]):
+        """
+        Args:
+            store_dir (str): directory holding the cached speaker files.
+            model_files (list[str]): checkpoints the cached tensors depend on (gpt / bigvgan).
+                They are fingerprinted by name, size and mtime instead of hashing gigabytes of weights.
+        """
+        self.store_dir = store_dir
+        os.makedirs(self.store_dir, exist_ok=True)
+        h = hashlib.sha256()
+        for model_file in model_files:
+            stat = os.stat(model_file)
+            h.update(f"{os.path.basename(model_file)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        self.model_fingerprint = h.hexdigest()
+
+    def get_key(self, audio_paths: List[str]) -> str:
+        return hash_audio_files(audio_paths, prefix=f"v{FEATURE_VERSION}:{self.model_fingerprint}")
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.store_dir, f"{key}.safetensors")
+
+    def load(self, key: str, device="cpu"):
+        """Return a lazily loaded speaker_dict entry saved under key, or None if it is not cached."""
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        return LazySpeaker(path, device=device)
+
+    def save(self, key: str, entry: dict):
+        tensors = {
+            "speech_conditioning_latent": entry["speech_conditioning_latent"],
+            "speaker_embedding": entry["speaker_embedding"],
+        }
+        for name in ["auto_conditioning", "speaker_conditioning"]:
+            for i, tensor in enumerate(entry[name]):
+                tensors[f"{name}.{i}"] = tensor
+        tensors = {k: v.detach().contiguous().cpu() for k, v in tensors.items()}
+        # 先写临时文件再替换，避免进程中途退出留下损坏的缓存
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        save_file(tensors, tmp_path)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _unflatten(tensors: dict, name: str) -> list:
+        items = []
+        while f"{name}.{len(items)}" in tensors:
+            items.append(tensors[f"{name}.{len(items)}"])
+        return items
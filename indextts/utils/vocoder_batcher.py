@@ -0,0 +1,116 @@
+import asyncio
+from typing import List
+
+import torch
+import torch.nn.functional as F
+
+from indextts.utils.metrics import VOCODER_BATCH_SIZE
+
+
+class VocoderBatcher:
+    """跨请求的 BigVGAN 动态 batch 服务
+
+    所有并发请求的 latent 先放进同一个队列，后台任务在 batch_wait_ms 窗口内尽量凑满 max_batch_size，
+    按长度排序分桶（同一桶内 padding 不超过 max_padding_ratio），每桶 padding 到同一长度后做一次
+    BigVGAN.decode，再按各自的 latent 长度截掉 padding 部分的波形，通过 future 返回给各自的调用方。
+    decode 时 padding 部分在每层之间重新置零，但 anti-aliased 激活在序列末尾的 replicate padding
+    无法逐层复现，较短的条目最后 BigVGAN.receptive_field() 帧以内的波形与单独 decode 有细微差别，
+    其余部分在浮点误差内一致。
+    BigVGAN forward 与结果拷回 CPU 都在 executor 线程中执行，不阻塞事件循环。
+    """
+
+    def __init__(self, bigvgan, max_batch_size=8, batch_wait_ms=5.0, executor=None, max_padding_ratio=0.5):
+        """
+        Args:
+            bigvgan: BigVGAN generator (eval mode, weight norm removed).
+            max_batch_size (int): maximum number of latents vocoded in one forward. 1 disables batching.
+            batch_wait_ms (float): how long to wait for more latents after the first one arrives.
+            executor (None | concurrent.futures.Executor): where BigVGAN runs. None means the event loop's
+                default executor.
+            max_padding_ratio (float): largest fraction of a forward's length that may be padding for its shortest
+                latent, longer spreads are split into separate forwards.
+        """
+        self.bigvgan = bigvgan
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait_ms / 1000
+        self.max_padding_ratio = max_padding_ratio
+        self.executor = executor
+        self._queue = None
+        self._task = None
+
+    async def vocode(self, latent, speaker_conditioning):
+        """
+        Args:
+            latent (Tensor): gpt latent of shape (1, t, gpt_dim).
+            speaker_conditioning (list[Tensor]): output of BigVGAN.get_speaker_conditioning for one speaker.
+
+        Returns:
+            Tensor: waveform of shape (1, 1, t * hop_length), on cpu.
+        """
+        if self.max_batch_size <= 1:
+            wavs = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self._vocode_batch, [latent], [speaker_conditioning])
+            return wavs[0]
+
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((latent, speaker_conditioning, future))
+        return await future
+
+    async def _run(self):
+        while True:
+            items = [await self._queue.get()]
+            # 队列中已经够一个 batch 时不再等待
+            if self._queue.qsize() < self.max_batch_size - 1:
+                await asyncio.sleep(self.batch_wait)
+            while len(items) < self.max_batch_size and not self._queue.empty():
+                items.append(self._queue.get_nowait())
+            # 调用方已取消（如客户端断开）的不再计算
+            items = [item for item in items if not item[2].done()]
+            if len(items) == 0:
+                continue
+
+            try:
+                wavs = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self._vocode_batch, [item[0] for item in items], [item[1] for item in items])
+            except Exception as ex:
+                for _, _, future in items:
+                    if not future.done():
+                        future.set_exception(ex)
+                continue
+            for (_, _, future), wav in zip(items, wavs):
+                if not future.done():
+                    future.set_result(wav)
+
+    def _buckets(self, lengths: List[int]) -> List[List[int]]:
+        """按长度排序后切分，返回每次 forward 的条目下标"""
+        buckets = []
+        for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+            if buckets and lengths[i] - lengths[buckets[-1][0]] <= self.max_padding_ratio * lengths[i]:
+                buckets[-1].append(i)
+            else:
+                buckets.append([i])
+        return buckets
+
+    @torch.no_grad()
+    def _vocode_batch(self, latents: List[torch.Tensor], speaker_conditionings: List[List[torch.Tensor]]) -> List[torch.Tensor]:
+        lengths = [latent.shape[1] for latent in latents]
+        wavs = [None] * len(latents)
+        for bucket in self._buckets(lengths):
+            VOCODER_BATCH_SIZE.observe(len(bucket))
+            bucket_lengths = [lengths[i] for i in bucket]
+            max_len = max(bucket_lengths)
+            x = torch.cat([F.pad(latents[i], (0, 0, 0, max_len - lengths[i])) for i in bucket], dim=0)
+            speaker_conditioning = [torch.cat(conds, dim=0) for conds in zip(*[speaker_conditionings[i] for i in bucket])]
+            padded = len(bucket) > 1 and min(bucket_lengths) < max_len
+            wav = self.bigvgan.decode(x, speaker_conditioning, lengths=bucket_lengths if padded else None)  # (b, 1, max_len * hop_length)
+            # 按各自 latent 长度截掉 padding 部分生成的波形；在 worker 线程中拷回 cpu，等待 GPU 的同步不落在事件循环上
+            hop_length = wav.shape[-1] // max_len
+            wav = wav.float().cpu()
+            for j, i in enumerate(bucket):
+                wavs[i] = wav[j:j + 1, :, :lengths[i] * hop_length]
+        return wavs
@@ -0,0 +1,191 @@
+"""AudioFetcher 的测试，用本地 aiohttp 服务器模拟音频源站
+
+    python -m pytest -q tests/test_audio_fetcher.py
+"""
+import asyncio
+import hashlib
+import os
+
+import pytest
+
+web = pytest.importorskip("aiohttp.web")
+
+from indextts.utils.audio_fetcher import AudioFetcher
+
+
+class AudioServer:
+    """/<name> 返回 files[name]，带 ETag 与 Last-Modified，支持 If-None-Match / If-Modified-Since"""
+
+    LAST_MODIFIED = "Wed, 01 Jan 2025 00:00:00 GMT"
+
+    def __init__(self, files, delay=0.0, validators=True, chunked=False):
+        self.files = files
+        self.delay = delay
+        self.validators = validators
+        self.chunked = chunked
+        self.requests = []  # (name, headers)
+        self.runner = None
+        self.base_url = None
+
+    async def handle(self, request):
+        name = request.match_info["name"]
+        self.requests.append((name, dict(request.headers)))
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        data = self.files[name]
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        headers = {}
+        if self.validators:
+            headers = {"ETag": etag, "Last-Modified": self.LAST_MODIFIED}
+            if request.headers.get("If-None-Match") == etag or \
+                    request.headers.get("If-Modified-Since") == self.LAST_MODIFIED:
+                return web.Response(status=304, headers=headers)
+        if self.chunked:
+            # 不带 Content-Length，只能在读取过程中检查大小
+            response = web.StreamResponse(headers=headers)
+            response.enable_chunked_encoding()
+            await response.prepare(request)
+            for i in range(0, len(data), 64):
+                await response.write(data[i:i + 64])
+            await response.write_eof()
+            return response
+        return web.Response(body=data, headers=headers)
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_get("/{name}", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.runner.cleanup()
+
+    def url(self, name):
+        return f"{self.base_url}/{name}"
+
+    def count(self, name):
+        return sum(1 for requested, _ in self.requests if requested == name)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_concurrent_requests_download_once(tmp_path):
+    async def main():
+        async with AudioServer({"a.wav": b"a" * 1000}, delay=0.2) as server:
+            fetcher = AudioFetcher(str(tmp_path))
+            try:
+                paths = await asyncio.gather(*[fetcher.fetch(server.url("a.wav")) for _ in range(8)])
+            finally:
+                await fetcher.close()
+            assert server.count("a.wav") == 1
+            assert len(set(paths)) == 1
+            with open(paths[0], "rb") as f:
+                assert f.read() == b"a" * 1000
+
+    run(main())
+
+
+def test_lru_eviction_by_bytes(tmp_path):
+    files = {"a.wav": b"a" * 1000, "b.wav": b"b" * 1000, "c.wav": b"c" * 1000}
+
+    async def main():
+        async with AudioServer(files) as server:
+            fetcher = AudioFetcher(str(tmp_path), max_bytes=2500)
+            try:
+                path_a = await fetcher.fetch(server.url("a.wav"))
+                path_b = await fetcher.fetch(server.url("b.wav"))
+                await fetcher.fetch(server.url("a.wav"))  # 命中，a 变为最近使用
+                path_c = await fetcher.fetch(server.url("c.wav"))
+            finally:
+                await fetcher.close()
+            assert fetcher.stats()["evictions"] == 1
+            assert server.url("b.wav") not in fetcher.entries
+            assert not os.path.exists(path_b)
+            assert os.path.exists(path_a) and os.path.exists(path_c)
+            assert fetcher.total_bytes == 2000
+
+    run(main())
+
+
+def test_acquired_file_survives_eviction_until_release(tmp_path):
+    files = {"a.wav": b"a" * 1000, "b.wav": b"b" * 1000}
+
+    async def main():
+        async with AudioServer(files) as server:
+            fetcher = AudioFetcher(str(tmp_path), max_bytes=1500)
+            try:
+                path_a = await fetcher.acquire(server.url("a.wav"))
+                await fetcher.fetch(server.url("b.wav"))
+            finally:
+                await fetcher.close()
+            assert server.url("a.wav") not in fetcher.entries
+            assert os.path.exists(path_a)
+            fetcher.release(path_a)
+            assert not os.path.exists(path_a)
+
+    run(main())
+
+
+@pytest.mark.parametrize("validator", ["If-None-Match", "If-Modified-Since"])
+def test_revalidation_with_304(tmp_path, validator):
+    async def main():
+        async with AudioServer({"a.wav": b"a" * 1000}) as server:
+            fetcher = AudioFetcher(str(tmp_path), revalidate_after=0)
+            try:
+                path = await fetcher.fetch(server.url("a.wav"))
+                entry = fetcher.entries[server.url("a.wav")]
+                # 只保留一种校验信息，分别验证 ETag 与 Last-Modified
+                if validator == "If-None-Match":
+                    entry["last_modified"] = None
+                else:
+                    entry["etag"] = None
+                mtime = os.stat(path).st_mtime_ns
+                assert await fetcher.fetch(server.url("a.wav")) == path
+            finally:
+                await fetcher.close()
+            assert server.count("a.wav") == 2
+            assert validator in server.requests[-1][1]
+            assert fetcher.stats()["revalidated"] == 1
+            assert os.stat(path).st_mtime_ns == mtime
+
+    run(main())
+
+
+def test_unchanged_content_without_validators_is_not_rewritten(tmp_path):
+    async def main():
+        async with AudioServer({"a.wav": b"a" * 1000}, validators=False) as server:
+            fetcher = AudioFetcher(str(tmp_path), revalidate_after=0)
+            try:
+                path = await fetcher.acquire(server.url("a.wav"))
+                mtime = os.stat(path).st_mtime_ns
+                assert await fetcher.fetch(server.url("a.wav")) == path
+            finally:
+                await fetcher.close()
+            assert os.stat(path).st_mtime_ns == mtime
+            assert fetcher.stats()["revalidated"] == 1
+            assert fetcher.orphans == set()
+
+    run(main())
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+def test_rejects_oversized_response(tmp_path, chunked):
+    async def main():
+        async with AudioServer({"big.wav": b"x" * 4096}, chunked=chunked) as server:
+            fetcher = AudioFetcher(str(tmp_path), max_file_bytes=1024)
+            try:
+                with pytest.raises(ValueError):
+                    await fetcher.fetch(server.url("big.wav"))
+            finally:
+                await fetcher.close()
+            assert fetcher.entries == {}
+            assert [name for name in os.listdir(tmp_path) if name != "index.json"] == []
+
+    run(main())
@@ -0,0 +1,74 @@
+"""IndexTTS._stream_sentence_chunks 的分段与交叉淡化逻辑，用假的 gpt / vocoder 代替模型
+
+    python -m pytest -q tests/test_stream_chunks.py
+"""
+import asyncio
+
+import pytest
+
+torch = pytest.importorskip("torch")
+infer_vllm_stream = pytest.importorskip("indextts.infer_vllm_stream")
+
+HOP_LENGTH = 4
+
+
+class FakeTokenizer:
+    def convert_tokens_to_ids(self, tokens):
+        return list(range(len(tokens)))
+
+
+class FakeGPT:
+    """每步多生成一帧，hidden state 的值为帧序号"""
+
+    def __init__(self, num_frames):
+        self.num_frames = num_frames
+
+    async def inference_speech_stream(self, speech_conditioning_latent, text_tokens, request_context=None,
+                                      sampling_params=None):
+        hidden_states = []
+        for i in range(self.num_frames):
+            hidden_states.append(torch.full((2,), float(i)))
+            yield list(range(i + 1)), hidden_states, i == self.num_frames - 1
+
+
+class FakeVocoder:
+    """逐帧展开为 HOP_LENGTH 个采样点，不依赖上下文，分段 vocode 的结果应与整句一致"""
+
+    async def vocode(self, latent, speaker_conditioning):
+        return (latent[:, :, 0].repeat_interleave(HOP_LENGTH, dim=1) / 1000).unsqueeze(1)
+
+
+def make_tts(num_frames, crossfade_frames):
+    tts = infer_vllm_stream.IndexTTS.__new__(infer_vllm_stream.IndexTTS)
+    tts.device = "cpu"
+    tts.tokenizer = FakeTokenizer()
+    tts.gpt = FakeGPT(num_frames)
+    tts.vocoder = FakeVocoder()
+    tts.stream_left_context = 3
+    tts.stream_lookahead_frames = 2
+    tts.stream_crossfade_frames = crossfade_frames
+    return tts
+
+
+def collect(tts, chunk_tokens):
+    async def main():
+        return [(wav, is_last) async for wav, is_last in tts._stream_sentence_chunks(["a", "b"], None, None, chunk_tokens)]
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize("crossfade_frames", [0, 1, 2])
+@pytest.mark.parametrize("num_frames", [5, 23, 40])
+def test_chunks_reassemble_whole_sentence(crossfade_frames, num_frames):
+    chunks = collect(make_tts(num_frames, crossfade_frames), chunk_tokens=6)
+    assert [is_last for _, is_last in chunks] == [False] * (len(chunks) - 1) + [True]
+    # 除最后一段外每段都有音频
+    assert all(wav.shape[-1] > 0 for wav, _ in chunks[:-1])
+    audio = torch.cat([wav for wav, _ in chunks], dim=-1)
+    expected = torch.arange(num_frames, dtype=torch.float32).repeat_interleave(HOP_LENGTH) / 1000 * 32767
+    torch.testing.assert_close(audio[0], expected)
+
+
+def test_zero_crossfade_yields_full_segments():
+    chunks = collect(make_tts(40, 0), chunk_tokens=6)
+    assert len(chunks) > 2
+    assert chunks[0][0].shape[-1] == (6 + 2 - 2) * HOP_LENGTH
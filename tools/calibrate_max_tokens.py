@@ -0,0 +1,104 @@
+"""在文本语料上统计每句 mel token 数与文本 token 数的比例，给出 --max_tokens_ratio / --max_tokens_margin 的建议值
+
+用法:
+    python tools/calibrate_max_tokens.py --model_dir /path/to/IndexTeam/Index-TTS --corpus corpus.txt --prompt tests/sample_prompt.wav
+    python tools/calibrate_max_tokens.py --model_dir ... --corpus requests.jsonl --field body --prompt ...
+
+corpus 为 .txt（每行一段文本）或 .jsonl（取 --field 字段）。统计时关闭按句上限，只受 max_tokens=768 限制，
+达到 768 的句子视为采样失败，不参与拟合。
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from indextts.infer_vllm import IndexTTS
+
+
+def load_corpus(path, field):
+    texts = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith(".jsonl"):
+                line = json.loads(line).get(field, "")
+            if line:
+                texts.append(line)
+    return texts
+
+
+async def collect(tts, texts, prompt, concurrency):
+    conditioning = tts.compute_conditioning(prompt)
+    speech_conditioning_latent = conditioning["speech_conditioning_latent"]
+
+    sentences = []
+    for text in texts:
+        sentences.extend(tts.tokenizer.split_sentences(tts.tokenizer.tokenize(text)))
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(sent):
+        text_tokens = tts.tokenizer.convert_tokens_to_ids(sent)
+        text_tokens = torch.tensor(text_tokens, dtype=torch.int32, device=tts.device).unsqueeze(0)
+        async with semaphore:
+            codes, _ = await tts.gpt.inference_speech(speech_conditioning_latent, text_tokens)
+        return text_tokens.shape[-1], len(codes)
+
+    return await asyncio.gather(*[run(sent) for sent in sentences])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_dir", type=str, required=True)
+    parser.add_argument("--corpus", type=str, required=True, help=".txt (one text per line) or .jsonl")
+    parser.add_argument("--field", type=str, default="text", help="Text field for .jsonl corpora")
+    parser.add_argument("--prompt", type=str, nargs="+", required=True, help="Reference audio paths")
+    parser.add_argument("--limit", type=int, default=0, help="Only use the first N texts, 0 uses all")
+    parser.add_argument("--percentile", type=float, default=99.0, help="Percentile of the per-sentence ratio used as max_tokens_ratio")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--gpu_memory_utilization", type=float, default=0.25)
+    args = parser.parse_args()
+
+    texts = load_corpus(args.corpus, args.field)
+    if args.limit > 0:
+        texts = texts[:args.limit]
+
+    tts = IndexTTS(model_dir=args.model_dir, cfg_path=os.path.join(args.model_dir, "config.yaml"),
+                   gpu_memory_utilization=args.gpu_memory_utilization, max_tokens_ratio=0)
+    cap = tts.gpt.sampling_params.max_tokens
+    samples = asyncio.run(collect(tts, texts, args.prompt, args.concurrency))
+
+    # 达到 max_tokens 的句子没有正常停止，属于需要被截断的失败情况
+    valid = [(n_text, n_mel) for n_text, n_mel in samples if n_mel < cap - 2]
+    failed = len(samples) - len(valid)
+    if len(valid) == 0:
+        print(">> no sentence stopped before max_tokens, nothing to calibrate")
+        return
+
+    n_text = np.array([s[0] for s in valid], dtype=np.float64)
+    n_mel = np.array([s[1] for s in valid], dtype=np.float64)
+    ratios = n_mel / n_text
+    ratio = float(np.percentile(ratios, args.percentile))
+    ratio = math.ceil(ratio * 10) / 10
+    # margin 取使语料中所有正常句子都不被截断的最小值
+    margin = int(max(0, np.max(n_mel - np.ceil(ratio * n_text))))
+
+    print(f">> sentences: {len(samples)} (hit max_tokens: {failed})")
+    print(f">> text tokens: mean {n_text.mean():.1f}, max {n_text.max():.0f}")
+    print(f">> mel tokens:  mean {n_mel.mean():.1f}, max {n_mel.max():.0f}")
+    print(f">> mel / text ratio: p50 {np.percentile(ratios, 50):.2f}, p90 {np.percentile(ratios, 90):.2f}, "
+          f"p99 {np.percentile(ratios, 99):.2f}, max {ratios.max():.2f}")
+    print(f">> suggested: --max_tokens_ratio {ratio} --max_tokens_margin {margin}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""长文本（有声书章节）合成：分句并行推理，按顺序边合成边写入 wav / flac，中断后重新执行同一命令即可续写
+
+用法:
+    python tools/long_form.py --model_dir /path/to/IndexTeam/Index-TTS --text chapter01.txt --prompt tests/sample_prompt.wav --output out/chapter01.flac
+
+进度记录在 <output>.progress.json，已写出的音频在 <output>.part.wav 中，全部完成后才生成 output。
+同一章节续写时需使用相同的文本、参考音频与采样参数（建议固定 --seed），否则从头开始。
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from indextts.infer_vllm import IndexTTS
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_dir", type=str, required=True)
+    parser.add_argument("--text", type=str, required=True, help="UTF-8 text file, paragraphs separated by newlines")
+    parser.add_argument("--prompt", type=str, nargs="+", required=True, help="Reference audio paths")
+    parser.add_argument("--output", type=str, required=True, help="Output .wav or .flac path")
+    parser.add_argument("--window", type=int, default=16, help="Sentences decoded ahead of the next one to write")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--gpu_memory_utilization", type=float, default=0.25)
+    args = parser.parse_args()
+
+    with open(args.text, "r", encoding="utf-8") as f:
+        text = f.read()
+
+    tts = IndexTTS(model_dir=args.model_dir, cfg_path=os.path.join(args.model_dir, "config.yaml"),
+                   gpu_memory_utilization=args.gpu_memory_utilization)
+    generation_config = {"seed": args.seed} if args.seed is not None else None
+    asyncio.run(tts.infer_long_form(text, args.output, audio_prompt=args.prompt, window=args.window,
+                                    generation_config=generation_config))
+
+
+if __name__ == "__main__":
+    main()